@@ -0,0 +1,11 @@
+"""
+gunicorn -c config/gunicorn.py config.wsgi
+
+Export PROMETHEUS_MULTIPROC_DIR (an empty directory) before starting gunicorn
+so /metrics adds up the values of every worker.
+"""
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
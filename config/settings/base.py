@@ -140,6 +140,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.common.BrokenLinkEmailsMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "menus.middleware.QueryCountMiddleware",
 ]
 
 # STATIC
@@ -292,3 +293,13 @@ REST_FRAMEWORK = {
 CORS_URLS_REGEX = r"^/api/.*$"
 # Your stuff...
 # ------------------------------------------------------------------------------
+# 'dense' reescribe el orden de los hermanos al mover un menu, 'gap' solo el menu movido
+MENUS_ORDERING = env("MENUS_ORDERING", default="dense")
+# Registra consultas, sentencias repetidas y tiempo de base de datos por accion de la API
+MENUS_QUERY_RECORDER = env.bool("MENUS_QUERY_RECORDER", default=False)
+# Cabecera Server-Timing con el tiempo de cada fase de las vistas de la API
+MENUS_SERVER_TIMING = env.bool("MENUS_SERVER_TIMING", default=False)
+# Ruta a una funcion hook(view, request, response, phases) que recibe los tiempos de cada peticion
+MENUS_TIMING_HOOK = env("MENUS_TIMING_HOOK", default=None)
+# Token que Prometheus envia como "Authorization: Bearer <token>"; sin token /metrics responde 404
+MENUS_METRICS_TOKEN = env("MENUS_METRICS_TOKEN", default=None)
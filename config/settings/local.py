@@ -58,3 +58,5 @@ INSTALLED_APPS += ["django_extensions"]  # noqa F405
 
 # Your stuff...
 # ------------------------------------------------------------------------------
+MENUS_QUERY_RECORDER = env.bool("MENUS_QUERY_RECORDER", default=True)
+MENUS_SERVER_TIMING = env.bool("MENUS_SERVER_TIMING", default=True)
@@ -150,3 +150,5 @@ LOGGING = {
 
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Los tiempos de cada fase de la API se publican en /metrics
+MENUS_TIMING_HOOK = env("MENUS_TIMING_HOOK", default="menus.metrics.observe_view_timing")
@@ -0,0 +1,124 @@
+import platform
+import statistics
+import time
+import uuid
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory
+
+from menus import tree_cache
+from menus.models import Menu
+from menus.serializers import MenuTreeSerializer
+from menus.synthetic import create_module_tree
+from menus.views import MenuViewSetApi
+
+SHAPES = ('wide', 'deep', 'balanced')
+SIZES = (1000, 100000, 1000000)
+
+
+class BenchmarkRollback(Exception):
+    pass
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {'repeat': repeat,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings),
+            'max': max(timings)}
+
+
+def benchmark_module(module, repeat):
+    queryset = Menu.objects.filter(module=module)
+    nodes_menu = list(queryset.order_by('module', 'parent', *Menu.objects.sort_fields()))
+    tree_menu = Menu.objects.get_tree_complete(queryset)
+    roots = list(queryset.filter(parent=None).order_by('order'))
+    last_root = roots[-1]
+
+    # La vista se llama directamente: no depende de ALLOWED_HOSTS ni del middleware
+    list_view = MenuViewSetApi.as_view({'get': 'list'})
+    request_factory = APIRequestFactory()
+
+    def api_menus(**params):
+        response = list_view(request_factory.get('/api/menus/', {'module__id': module.pk, **params}))
+        if hasattr(response, 'render'):
+            response.render()
+        assert response.status_code == 200, response.status_code
+        return len(response.content)
+
+    def move_last_to_first():
+        Menu.objects.change_order_to(pk=last_root.pk, new_order=1)
+        Menu.objects.change_order_to(pk=last_root.pk, new_order=len(roots))
+
+    def api_cold(**params):
+        tree_cache.bump_module_versions([module.pk])
+        api_menus(**params)
+
+    # Las escrituras van al final: dejan invalidaciones pendientes y el cache
+    # no guarda modulos pendientes dentro de la transaccion
+    operations = {
+        'build_tree_menu': lambda: Menu.objects.build_tree_menu(nodes_menu, None),
+        'get_tree_complete': lambda: Menu.objects.get_tree_complete(queryset),
+        'menu_tree_serializer': lambda: MenuTreeSerializer(tree_menu, many=True).data,
+        'api_menus_cold': api_cold,
+        'api_menus_warm': api_menus,
+        'api_menus_flat_cold': lambda: api_cold(format='flat'),
+        'api_menus_flat_warm': lambda: api_menus(format='flat'),
+        'next_order_num': lambda: Menu.objects.next_order_num(module=module),
+        'change_order_to': move_last_to_first,
+    }
+    # Tamano de la respuesta de cada formato para compararlo junto al tiempo
+    sizes = {'api_menus': api_menus(), 'api_menus_flat': api_menus(format='flat')}
+    timings = {name: measure(function, repeat) for name, function in operations.items()}
+    for name, timing in timings.items():
+        prefix = name.rsplit('_', 1)[0]
+        if prefix in sizes:
+            timing['bytes'] = sizes[prefix]
+    return timings
+
+
+def run_benchmarks(shapes=SHAPES, sizes=SIZES, repeat=5, log=None):
+    """
+    Time the menu hot paths for every shape and size. The synthetic data is
+    created inside a transaction that is always rolled back.
+    """
+    results = []
+    try:
+        with transaction.atomic():
+            for shape in shapes:
+                for num_nodes in sizes:
+                    start = time.perf_counter()
+                    module = create_module_tree(f'B{uuid.uuid4().hex[:12]}', shape, num_nodes)
+                    setup = time.perf_counter() - start
+                    if log:
+                        log(f'{shape} {num_nodes}: data created in {setup:.2f}s')
+
+                    timings = benchmark_module(module, repeat)
+                    results.extend({'shape': shape, 'nodes': num_nodes, 'operation': name, **timing}
+                                   for name, timing in timings.items())
+            raise BenchmarkRollback
+    except BenchmarkRollback:
+        pass
+
+    database = connection.vendor
+    if connection.vendor == 'postgresql':
+        database = f'{database} {connection.pg_version}'
+    return {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': database,
+            'ordering': getattr(settings, 'MENUS_ORDERING', 'dense'),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
@@ -0,0 +1,10 @@
+import pytest
+from django.core.cache import cache
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Los arboles se guardan por id de modulo y los ids se repiten entre pruebas
+    cache.clear()
+    yield
+    cache.clear()
@@ -2,3 +2,33 @@
 class ErrorMessage():
     PK_NOT_EXIST = "The {} with the pk = {} doesnt exist"
     UNIQUE_ERROR = {'unique': 'The Module already exists'}
+    REORDER_MISMATCH = "The menus must be all the children of the parent, each one once"
+    MOVE_CYCLE = "A menu can't be moved under itself or one of its descendants"
+    MOVE_OTHER_MODULE = "A menu can't be moved to another module"
+
+
+class OrderingMode():
+    DENSE = 'dense'
+    GAP = 'gap'
+    GAP_SIZE = 1 << 16
+
+
+class ExportLayout():
+    NESTED = 'nested'
+    NDJSON = 'ndjson'
+    CONTENT_TYPES = {
+        NESTED: 'application/json',
+        NDJSON: 'application/x-ndjson',
+    }
+
+
+class TreeFields():
+    # Campo de la respuesta del arbol -> columna de la tabla de menus
+    COLUMNS = {
+        'pk': 'id',
+        'name': 'name',
+        'module': 'module_id',
+        'order': 'order',
+        'parent': 'parent_id',
+        'deep': 'depth',
+    }
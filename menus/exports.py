@@ -0,0 +1,103 @@
+import json
+
+from menus.consts import ExportLayout
+from menus.models import Menu
+
+CHUNK_SIZE = 64 * 1024
+
+
+def dumps(data):
+    # Mismo formato compacto que el JSONRenderer de DRF
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def iter_tree_orders(records):
+    """
+    Add to every iter_tree record the position of the menu among its siblings.
+    """
+    counts = []
+    module_id = None
+    for module, menu, depth, path in records:
+        if module != module_id:
+            module_id, counts = module, []
+        del counts[depth + 1:]
+        if len(counts) == depth:
+            counts.append(0)
+        counts[depth] += 1
+        yield module, menu, depth, path, counts[depth]
+
+
+def iter_nested_json(records, dense_order=False):
+    """
+    Yield the list of modules with their nested menus, the same document the
+    menu list returns, node by node from the depth-first iter_tree records.
+    """
+    yield '['
+    module_id = None
+    # Profundidad del ultimo menu abierto; su sub_menu sigue abierto
+    open_depth = -1
+    for module, menu, depth, path, index in iter_tree_orders(records):
+        if module != module_id:
+            if module_id is not None:
+                yield ']}' * (open_depth + 1) + ']},'
+            yield f'{{"module":{dumps(module)},"menus":['
+            module_id, open_depth = module, -1
+        elif depth <= open_depth:
+            yield ']}' * (open_depth - depth + 1) + ','
+
+        node = dumps({'pk': menu.pk,
+                      'name': menu.name,
+                      'module': menu.module_id,
+                      'order': index if dense_order else menu.order,
+                      'parent': menu.parent_id,
+                      'deep': menu.depth})
+        yield node[:-1] + ',"sub_menu":['
+        open_depth = depth
+
+    if module_id is not None:
+        yield ']}' * (open_depth + 1) + ']}'
+    yield ']'
+
+
+def iter_ndjson(records, dense_order=False):
+    """
+    Yield one flat JSON record per line for every menu.
+    """
+    for module, menu, depth, path, index in iter_tree_orders(records):
+        yield dumps({'module': module,
+                     'pk': menu.pk,
+                     'name': menu.name,
+                     'parent': menu.parent_id,
+                     'order': index if dense_order else menu.order,
+                     'deep': depth,
+                     'path': path}) + '\n'
+
+
+def iter_chunks(parts, size=CHUNK_SIZE):
+    """
+    Join the small text parts into encoded chunks of about size bytes. The
+    first part goes out alone so the client receives bytes right away.
+    """
+    parts = iter(parts)
+    first = next(parts, None)
+    if first is None:
+        return
+    yield first.encode()
+
+    buffer, length = [], 0
+    for part in parts:
+        buffer.append(part)
+        length += len(part)
+        if length >= size:
+            yield ''.join(buffer).encode()
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def export_catalog(module_ids=None, layout=ExportLayout.NESTED):
+    records = Menu.objects.iter_tree(module_ids)
+    dense_order = Menu.objects.gap_ordering()
+    if layout == ExportLayout.NDJSON:
+        return iter_chunks(iter_ndjson(records, dense_order))
+    return iter_chunks(iter_nested_json(records, dense_order))
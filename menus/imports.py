@@ -0,0 +1,208 @@
+from dataclasses import dataclass, field
+from typing import Any, List
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from menus import metrics, tree_cache
+from menus.consts import OrderingMode
+from menus.models import Menu, Module, SiblingCounter
+
+BATCH_SIZE = 1000
+
+
+class MenuImportError(Exception):
+    """
+    The document has invalid items; errors is a list of {'item', 'errors'}.
+    """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+@dataclass
+class ImportNode:
+    key: Any
+    parent_key: Any
+    name: Any
+    sort_key: Any
+    item: str
+    children: List['ImportNode'] = field(default_factory=list)
+
+
+def item_error(item, name, *messages):
+    return {'item': item, 'errors': {name: list(messages)}}
+
+
+def parse_nested(menus):
+    """
+    Read menus written as in the menu list: [{'name': ..., 'sub_menu': [...]}].
+    """
+    nodes, errors = [], []
+    pending = [(menus, None, 'menus')]
+    while pending:
+        items, parent_key, locator = pending.pop()
+        if not isinstance(items, list):
+            errors.append(item_error(locator, 'sub_menu' if parent_key else 'menus', 'Expected a list of menus.'))
+            continue
+        for index, item in enumerate(items):
+            item_locator = f'{locator}[{index}]'
+            if not isinstance(item, dict):
+                errors.append(item_error(item_locator, 'non_field_errors', 'Expected a menu object.'))
+                continue
+            nodes.append(ImportNode(item_locator, parent_key, item.get('name'), index, item_locator))
+            pending.append((item.get('sub_menu') or [], item_locator, f'{item_locator}.sub_menu'))
+    return nodes, errors
+
+
+def parse_flat(records):
+    """
+    Read flat records like the ndjson export: {'pk': ..., 'parent': ..., 'name': ..., 'order': ...},
+    where pk and parent are keys of the document, not database ids.
+    """
+    if not isinstance(records, list):
+        return [], [item_error('records', 'records', 'Expected a list of records.')]
+
+    nodes, errors, keys = [], [], set()
+    for index, record in enumerate(records):
+        locator = f'records[{index}]'
+        if not isinstance(record, dict):
+            errors.append(item_error(locator, 'non_field_errors', 'Expected a menu object.'))
+            continue
+        key, parent_key, order = record.get('pk'), record.get('parent'), record.get('order', 0)
+        if not isinstance(key, (str, int)) or isinstance(key, bool):
+            errors.append(item_error(locator, 'pk', 'Expected a string or integer key.'))
+            continue
+        if parent_key is not None and (not isinstance(parent_key, (str, int)) or isinstance(parent_key, bool)):
+            errors.append(item_error(locator, 'parent', 'Expected null or a string or integer key.'))
+            continue
+        if key in keys:
+            errors.append(item_error(locator, 'pk', f'Duplicated key {key!r}.'))
+            continue
+        if not isinstance(order, int) or isinstance(order, bool):
+            errors.append(item_error(locator, 'order', 'A valid integer is required.'))
+            continue
+        keys.add(key)
+        nodes.append(ImportNode(key, parent_key, record.get('name'), (order, index), locator))
+    return nodes, errors
+
+
+def validate_names(nodes):
+    name_field = Menu._meta.get_field('name')
+    errors = []
+    for node in nodes:
+        if not isinstance(node.name, str):
+            errors.append(item_error(node.item, 'name', name_field.error_messages['blank']))
+            continue
+        try:
+            node.name = name_field.clean(node.name, None)
+        except ValidationError as e:
+            errors.append(item_error(node.item, 'name', *e.messages))
+    return errors
+
+
+def link_nodes(nodes):
+    """
+    Attach every node to its parent and return the roots sorted. Nodes whose
+    parent is missing or that are part of a cycle are reported.
+    """
+    by_key = {node.key: node for node in nodes}
+    roots, errors = [], []
+    for node in nodes:
+        if node.parent_key is None:
+            roots.append(node)
+        elif node.parent_key in by_key:
+            by_key[node.parent_key].children.append(node)
+        else:
+            errors.append(item_error(node.item, 'parent', f'Unknown parent {node.parent_key!r}.'))
+
+    # Los nodos que no se alcanzan desde una raiz ni desde un padre desconocido forman un ciclo
+    reached = set()
+    pending = roots + [node for node in nodes if node.parent_key is not None and node.parent_key not in by_key]
+    while pending:
+        node = pending.pop()
+        reached.add(id(node))
+        node.children.sort(key=lambda child: child.sort_key)
+        pending.extend(node.children)
+    errors.extend(item_error(node.item, 'parent', 'The parent chain forms a cycle.')
+                  for node in nodes if id(node) not in reached and node.parent_key in by_key)
+    roots.sort(key=lambda root: root.sort_key)
+    return roots, errors
+
+
+def resolve_module(document):
+    """
+    Return (module, errors): an existing module for 'module', or an unsaved one for 'name'.
+    """
+    if document.get('module') is not None:
+        module = Module.objects.filter(pk=document['module']).first() if str(document['module']).isdigit() else None
+        if module is None:
+            return None, [item_error('module', 'module', f'Unknown module {document["module"]!r}.')]
+        return module, []
+
+    module = Module(name=document.get('name'))
+    try:
+        module.full_clean()
+    except ValidationError as e:
+        return None, [{'item': 'module', 'errors': e.message_dict}]
+    return module, []
+
+
+@metrics.observe_write('menu', 'import')
+def import_menus(document, batch_size=BATCH_SIZE):
+    """
+    Validate a whole tree document and insert it in one transaction. The
+    document names an existing 'module' id or the 'name' of a new module, and
+    has nested 'menus' or flat 'records'. Raise MenuImportError with every
+    invalid item before writing anything. Returns {'module': id, 'created': n}.
+    """
+    if not isinstance(document, dict):
+        raise MenuImportError([item_error('document', 'non_field_errors', 'Expected an object.')])
+
+    if 'records' in document:
+        nodes, errors = parse_flat(document['records'])
+    else:
+        nodes, errors = parse_nested(document.get('menus'))
+    module, module_errors = resolve_module(document)
+    errors = module_errors + errors + validate_names(nodes)
+    roots, link_errors = link_nodes(nodes)
+    errors += link_errors
+    if errors:
+        raise MenuImportError(errors)
+
+    with transaction.atomic():
+        if module.pk is None:
+            module = Module.objects.execute_create(module.name)
+            first_order = 1
+            counters = [SiblingCounter(module=module, parent_key=0, last_order=len(roots))]
+        else:
+            first_order = Menu.objects.reserve_orders(module=module, count=len(roots)) - len(roots) + 1
+            counters = []
+        created = insert_levels(module, roots, first_order, counters, batch_size)
+        SiblingCounter.objects.bulk_create(counters, batch_size=batch_size)
+    tree_cache.invalidate_modules(module.pk)
+    return {'module': module.pk, 'created': created}
+
+
+def insert_levels(module, roots, first_order, counters, batch_size):
+    # Un bulk_create por nivel: los padres ya tienen id cuando se insertan sus hijos
+    created = 0
+    level = [(node, None, first_order + index) for index, node in enumerate(roots)]
+    while level:
+        menus = []
+        for node, parent, order in level:
+            menus.append(Menu(name=node.name, module=module, parent_id=parent and parent.pk, order=order,
+                              position=order * OrderingMode.GAP_SIZE,
+                              path=parent.path_children() if parent else '',
+                              depth=parent.depth + 1 if parent else 0))
+        Menu.objects.bulk_create(menus, batch_size=batch_size)
+        created += len(menus)
+
+        next_level = []
+        for (node, parent, order), menu in zip(level, menus):
+            if node.children:
+                counters.append(SiblingCounter(module=module, parent_key=menu.pk, last_order=len(node.children)))
+            next_level.extend((child, menu, index) for index, child in enumerate(node.children, 1))
+        level = next_level
+    return created
@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from menus.benchmarks import SHAPES, SIZES, run_benchmarks
+
+
+def comma_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+class Command(BaseCommand):
+    help = ('Time the menu tree hot paths on synthetic trees and write the results as JSON. '
+            'Run it with DEBUG off, e.g. --settings=config.settings.test.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shapes', default=','.join(SHAPES),
+                            help='Comma separated tree shapes: wide, deep, balanced.')
+        parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                            help='Comma separated number of menus per tree.')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', help='File for the JSON results, stdout by default.')
+
+    def handle(self, *args, **options):
+        shapes = comma_list(options['shapes'])
+        unknown = set(shapes) - set(SHAPES)
+        if unknown:
+            raise CommandError(f'Unknown shapes: {", ".join(sorted(unknown))}')
+        try:
+            sizes = comma_list(options['sizes'], int)
+        except ValueError:
+            raise CommandError('--sizes must be comma separated integers')
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+
+        report = run_benchmarks(shapes, sizes, options['repeat'], log=self.stderr.write)
+        content = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(content)
+            self.stderr.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+        else:
+            self.stdout.write(content)
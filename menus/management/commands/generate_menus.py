@@ -0,0 +1,51 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from menus.models import Module
+from menus.synthetic import BATCH_SIZE, TreeShape, generate_modules
+
+
+class Command(BaseCommand):
+    help = ('Generate modules with consistent menu trees for load tests. '
+            'The same seed always produces the same trees.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modules', type=int, default=1, help='Number of modules to create.')
+        parser.add_argument('--nodes', type=int, default=1000, help='Menus per module.')
+        parser.add_argument('--roots', type=int, default=10, help='Root menus per module.')
+        parser.add_argument('--fan-out', type=int, default=10, help='Average children per menu.')
+        parser.add_argument('--depth', type=int, default=5, help='Maximum number of levels.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='Load', help='Prefix of the module names.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        for option in ('modules', 'nodes', 'roots', 'fan_out', 'depth', 'batch_size'):
+            if options[option] < 1:
+                raise CommandError(f'--{option.replace("_", "-")} must be at least 1')
+
+        names = [f'{options["prefix"]} {number}' for number in range(1, options['modules'] + 1)]
+        max_length = Module._meta.get_field('name').max_length
+        if len(names[-1]) > max_length:
+            raise CommandError(f'Module names are limited to {max_length} characters: {names[-1]!r}')
+        existing = list(Module.objects.filter(name__in=names).values_list('name', flat=True)[:5])
+        if existing:
+            raise CommandError(f'Modules already exist: {", ".join(existing)}. Use another --prefix.')
+
+        tree = TreeShape(roots=options['roots'], fan_out=options['fan_out'], max_depth=options['depth'])
+        start = time.perf_counter()
+        with transaction.atomic():
+            created = generate_modules(names, options['nodes'], tree, random.Random(options['seed']),
+                                       options['batch_size'])
+        elapsed = time.perf_counter() - start
+
+        total = sum(created.values())
+        if total < options['nodes'] * options['modules']:
+            self.stderr.write(self.style.WARNING(
+                f'--depth {options["depth"]} only fits {total} menus; raise --depth or --fan-out for more.'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(created)} modules and {total} menus in {elapsed:.2f}s '
+            f'({total / max(elapsed, 1e-9):.0f} menus/s)'))
@@ -0,0 +1,61 @@
+import json
+import sys
+import time
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+
+from menus.imports import BATCH_SIZE, MenuImportError, import_menus
+
+
+class Command(BaseCommand):
+    help = ('Import a menu tree from a JSON document ({"menus": [...]} nested or {"records": [...]} flat) '
+            'or from the .ndjson export. Nothing is written if any menu is invalid.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, or - to read stdin.')
+        target = parser.add_mutually_exclusive_group()
+        target.add_argument('--module', type=int, help='Id of the module that receives the menus.')
+        target.add_argument('--name', help='Name of a new module for the menus.')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        document = self.read_document(options['path'])
+        if options['module'] is not None:
+            document.pop('name', None)
+            document['module'] = options['module']
+        elif options['name'] is not None:
+            document.pop('module', None)
+            document['name'] = options['name']
+
+        start = time.perf_counter()
+        try:
+            result = import_menus(document, options['batch_size'])
+        except MenuImportError as e:
+            lines = [f'{error["item"]}: {field}: {" ".join(messages)}'
+                     for error in e.errors for field, messages in error['errors'].items()]
+            raise CommandError('Invalid menus, nothing was imported:\n' + '\n'.join(lines))
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {result["created"]} menus into module {result["module"]} in {elapsed:.2f}s'))
+
+    def read_document(self, path):
+        try:
+            with open(path, encoding='utf-8') if path != '-' else nullcontext(sys.stdin) as source:
+                if path.endswith('.ndjson'):
+                    return {'records': [json.loads(line) for line in source if line.strip()]}
+                document = json.load(source)
+        except OSError as e:
+            raise CommandError(f'Cannot read {path}: {e}')
+        except ValueError as e:
+            raise CommandError(f'{path} is not valid JSON: {e}')
+
+        # Un arreglo suelto se toma como la lista de menus anidados
+        if isinstance(document, list):
+            return {'menus': document}
+        if not isinstance(document, dict):
+            raise CommandError(f'{path} must contain an object or a list of menus')
+        return document
@@ -0,0 +1,68 @@
+"""
+Prometheus metrics of the menu operations.
+
+With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty
+directory before starting them: every worker writes its values there and
+/metrics aggregates all of them. /metrics only answers when MENUS_METRICS_TOKEN
+is set, to requests that send it as a bearer token.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+WRITE_SECONDS = Histogram(
+    'menus_write_seconds', 'Latency of the manager write operations.', ['model', 'operation'])
+REORDER_ROWS = Histogram(
+    'menus_reorder_rows', 'Rows rewritten by each menu reorder.', ['mode'],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 10000))
+CACHE_REQUESTS = Counter(
+    'menus_cache_requests', 'Module entries looked up in the tree cache.', ['kind', 'result'])
+TREE_BUILDS = Counter(
+    'menus_tree_builds', 'Module entries built because they were not cached.', ['kind'])
+BUILD_SECONDS = Histogram(
+    'menus_build_seconds', 'Time spent building the entries missing from the tree cache.', ['kind'])
+REQUEST_SECONDS = Histogram(
+    'menus_request_phase_seconds', 'Time of each phase of the API requests.', ['view', 'action', 'phase'])
+
+
+def observe_write(model, operation):
+    # Sirve como decorador de los metodos execute_* de los managers
+    return WRITE_SECONDS.labels(model, operation).time()
+
+
+def observe_cache(kind, hits, misses):
+    if hits:
+        CACHE_REQUESTS.labels(kind, 'hit').inc(hits)
+    if misses:
+        CACHE_REQUESTS.labels(kind, 'miss').inc(misses)
+        TREE_BUILDS.labels(kind).inc(misses)
+
+
+def observe_view_timing(view, request, response, phases):
+    """
+    MENUS_TIMING_HOOK that records the phases measured by the API views.
+    """
+    view_name = view.__class__.__name__
+    action = getattr(view, 'action', None) or request.method.lower()
+    for phase, duration in phases.items():
+        REQUEST_SECONDS.labels(view_name, action, phase).observe(duration)
+
+
+def get_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render_metrics():
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
@@ -0,0 +1,41 @@
+import logging
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from menus.query_recorder import QueryRecorder, get_query_budget, resolve_action
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCountMiddleware:
+    """
+    Log the number of queries, the repeated statements and the database time
+    of each viewset action, warning when the action exceeds its query budget.
+    Enabled with the MENUS_QUERY_RECORDER setting.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'MENUS_QUERY_RECORDER', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+
+        view_class, action = getattr(request, 'query_action', (None, None))
+        if view_class is not None:
+            self.log_report(f'{view_class.__name__}.{action}', get_query_budget(view_class, action), recorder)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_action = resolve_action(view_func, request.method)
+
+    def log_report(self, label, budget, recorder):
+        over_budget = budget is not None and recorder.count > budget
+        level = logging.WARNING if over_budget or recorder.duplicates else logging.DEBUG
+        logger.log(level, '%s: %d queries (budget %s), %.1f ms, %d repeated statements',
+                   label, recorder.count, budget, recorder.duration * 1000, len(recorder.duplicates))
+        for sql, count in recorder.duplicates.items():
+            logger.log(level, '%s: %d times: %s', label, count, sql)
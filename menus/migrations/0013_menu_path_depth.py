@@ -0,0 +1,54 @@
+# Generated by Django 4.0.5 on 2026-10-18 14:23
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.db import migrations, models
+
+BACKFILL_PATH_SQL = '''
+WITH RECURSIVE tree AS (
+    SELECT id, ''::text AS path, 0 AS depth FROM menus_menu WHERE parent_id IS NULL
+    UNION ALL
+    SELECT menu.id, tree.path || tree.id || '/', tree.depth + 1
+    FROM menus_menu menu JOIN tree ON menu.parent_id = tree.id
+)
+UPDATE menus_menu SET path = tree.path, depth = tree.depth
+FROM tree WHERE menus_menu.id = tree.id
+'''
+
+# Solo se indexa un prefijo del path: un path profundo pasa el limite de una llave btree.
+# Django 4.0 envuelve OpClass entre parentesis y PostgreSQL no acepta esa sintaxis
+PATH_PREFIX_INDEX_SQL = '''
+CREATE INDEX menu_path_prefix_idx ON menus_menu (SUBSTRING(path, 1, 1024) text_pattern_ops)
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menus', '0012_alter_menu_module_alter_menu_name_alter_module_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='menu',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='menu',
+            name='path',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunSQL(BACKFILL_PATH_SQL, migrations.RunSQL.noop),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(PATH_PREFIX_INDEX_SQL, 'DROP INDEX menu_path_prefix_idx'),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='menu',
+                    index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Substr('path', 1, 1024), name='text_pattern_ops'), name='menu_path_prefix_idx'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.5 on 2026-10-18 14:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menus', '0013_menu_path_depth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='menu',
+            name='position',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunSQL('UPDATE menus_menu SET position = "order" * 65536', migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.5 on 2026-10-18 14:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+SEED_COUNTERS_SQL = '''
+INSERT INTO menus_siblingcounter (module_id, parent_key, last_order)
+SELECT module_id, COALESCE(parent_id, 0), GREATEST(MAX("order"), MAX(position) / 65536)
+FROM menus_menu GROUP BY module_id, COALESCE(parent_id, 0)
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menus', '0014_menu_position'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiblingCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('parent_key', models.PositiveIntegerField(default=0)),
+                ('last_order', models.PositiveIntegerField(default=0)),
+                ('module', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='menus.module')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='siblingcounter',
+            constraint=models.UniqueConstraint(fields=('module', 'parent_key'), name='unique_sibling_counter'),
+        ),
+        migrations.RunSQL(SEED_COUNTERS_SQL, migrations.RunSQL.noop),
+    ]
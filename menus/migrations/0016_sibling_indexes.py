@@ -0,0 +1,73 @@
+# Generated by Django 4.0.5 on 2026-10-18 14:28
+
+from django.db import migrations, models
+import django.db.models.constraints
+
+# Renumera los grupos de hermanos que tengan posiciones repetidas antes de crear la restriccion
+DEDUPE_POSITIONS_SQL = '''
+UPDATE menus_menu menu SET position = ranked.num * 65536, "order" = ranked.num
+FROM (
+    SELECT id, ROW_NUMBER() OVER (PARTITION BY module_id, parent_id ORDER BY position, id) AS num
+    FROM menus_menu
+    WHERE (module_id, COALESCE(parent_id, 0)) IN (
+        SELECT module_id, COALESCE(parent_id, 0) FROM menus_menu
+        GROUP BY module_id, COALESCE(parent_id, 0) HAVING COUNT(*) > COUNT(DISTINCT position))
+) ranked
+WHERE menu.id = ranked.id;
+
+UPDATE menus_siblingcounter counter SET last_order = GREATEST(counter.last_order, totals.last_order)
+FROM (
+    SELECT module_id, COALESCE(parent_id, 0) AS parent_key, MAX("order") AS last_order
+    FROM menus_menu GROUP BY module_id, COALESCE(parent_id, 0)
+) totals
+WHERE counter.module_id = totals.module_id AND counter.parent_key = totals.parent_key;
+'''
+
+UNIQUE_SIBLING_SQL = '''
+ALTER TABLE menus_menu ADD CONSTRAINT unique_sibling_position
+UNIQUE {nulls} (module_id, parent_id, position) DEFERRABLE INITIALLY DEFERRED
+'''
+
+
+def add_unique_sibling_position(apps, schema_editor):
+    # Desde PostgreSQL 15 los menus raiz (parent NULL) tambien quedan cubiertos
+    nulls = 'NULLS NOT DISTINCT' if schema_editor.connection.pg_version >= 150000 else ''
+    schema_editor.execute(UNIQUE_SIBLING_SQL.format(nulls=nulls))
+
+
+def remove_unique_sibling_position(apps, schema_editor):
+    schema_editor.execute('ALTER TABLE menus_menu DROP CONSTRAINT unique_sibling_position')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menus', '0015_sibling_counter'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='menu',
+            index=models.Index(fields=['module', 'parent', 'order'], name='menu_sibling_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='menu',
+            index=models.Index(condition=models.Q(('parent', None)), fields=['module', 'order'], name='menu_root_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='menu',
+            index=models.Index(condition=models.Q(('parent', None)), fields=['module', 'position'], name='menu_root_position_idx'),
+        ),
+        migrations.RunSQL(DEDUPE_POSITIONS_SQL, migrations.RunSQL.noop),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(add_unique_sibling_position, remove_unique_sibling_position),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='menu',
+                    constraint=models.UniqueConstraint(deferrable=django.db.models.constraints.Deferrable['DEFERRED'], fields=('module', 'parent', 'position'), name='unique_sibling_position'),
+                ),
+            ],
+        ),
+    ]
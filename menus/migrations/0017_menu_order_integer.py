@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 15:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('menus', '0016_sibling_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='menu',
+            name='order',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -3,8 +3,13 @@ Basic building blocks for generic class based views.
 We don't bind behaviour to http method handlers yet,
 which allows mixin classes to be composed in interesting ways.
 """
+import hashlib
+
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models.deletion import ProtectedError
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from rest_framework import status
 from rest_framework.mixins import (
     CreateModelMixin,
@@ -16,44 +21,150 @@ from rest_framework.mixins import (
 from rest_framework.response import Response
 from rest_framework.settings import api_settings
 
+from menus import tree_cache
+from menus.timing import NULL_TIMER, get_timing_hook, new_timer
+
+
+class ServerTimingMixin:
+    """
+    Time the phases of each request (queryset, perform_list, serialize, render...)
+    and expose them as a Server-Timing header and through MENUS_TIMING_HOOK.
+    """
+    timer = NULL_TIMER
+
+    def initial(self, request, *args, **kwargs):
+        self.timer = new_timer()
+        super().initial(request, *args, **kwargs)
+
+    def phase(self, name):
+        return self.timer.phase(name)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if not self.timer.enabled:
+            return response
+
+        # Se renderiza aqui para medirlo; Django no vuelve a renderizar la respuesta
+        if not getattr(response, 'is_rendered', True):
+            with self.phase('render'):
+                response.render()
+        phases = self.timer.finish()
+        if getattr(settings, 'MENUS_SERVER_TIMING', False):
+            response['Server-Timing'] = self.timer.header()
+        hook = get_timing_hook()
+        if hook is not None:
+            hook(self, request, response, phases)
+        return response
+
+
+class ConditionalModelMixin(ServerTimingMixin):
+    """
+    Compute ETag / Last-Modified validators from the per-module change stamps,
+    so unchanged resources are answered with 304 without being built.
+    """
 
-class ListModelMixinCustom:
+    def get_validators(self, module_ids):
+        if module_ids is None or tree_cache.pending_invalidations().intersection(module_ids):
+            return None
+        stamps = tree_cache.get_module_stamps(module_ids)
+        if any(version is None for version, modified in stamps.values()):
+            return None
+
+        # La representacion depende tambien de la accion, el media type y los parametros
+        media_type = getattr(self.request, 'accepted_media_type', '')
+        stamp = ','.join(f'{module_id}:{version}' for module_id, (version, modified) in stamps.items())
+        variant = f'{self.action}|{media_type}|{self.request.GET.urlencode()}|{stamp}'
+        etag = '"{}"'.format(hashlib.sha1(variant.encode()).hexdigest())
+        modified = [modified for version, modified in stamps.values() if modified is not None]
+        last_modified = int(max(modified)) if modified else None
+        return etag, last_modified
+
+    def get_not_modified(self, validators):
+        if validators is None:
+            return None
+        etag, last_modified = validators
+        return get_conditional_response(self.request, etag=etag, last_modified=last_modified)
+
+    def set_validators(self, response, validators):
+        if validators is not None and response.status_code == status.HTTP_200_OK:
+            etag, last_modified = validators
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+class ListModelMixinCustom(ConditionalModelMixin):
     """
     List a queryset.
     """
 
     def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
+        with self.phase('queryset'):
+            queryset = self.filter_queryset(self.get_queryset())
+            module_ids = self.get_list_module_ids()
 
+        validators = self.get_validators(module_ids)
+        not_modified = self.get_not_modified(validators)
+        if not_modified is not None:
+            return not_modified
+
+        response = self.list_response(queryset)
+        return self.set_validators(response, validators)
+
+    def list_response(self, queryset):
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+            with self.phase('serialize'):
+                data = self.get_serializer(page, many=True).data
+            return self.get_paginated_response(data)
+
+        return Response(self.get_list_data(queryset))
 
-        result_list = self.perform_list(queryset)
+    def get_list_module_ids(self):
+        return None
 
-        serializer = self.get_serializer(result_list, many=True)
+    def get_list_data(self, queryset):
+        with self.phase('perform_list'):
+            result_list = self.perform_list(queryset)
 
-        return Response(serializer.data)
+        with self.phase('serialize'):
+            serializer = self.get_serializer(result_list, many=True)
+            return serializer.data
 
     def perform_list(self, queryset):
         return queryset
 
 
-class RetrieveModelMixinCustom(RetrieveModelMixin):
+class RetrieveModelMixinCustom(ConditionalModelMixin, RetrieveModelMixin):
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        serializer = self.get_serializer(instance)
-        return Response(serializer.data)
+        with self.phase('queryset'):
+            instance = self.get_object()
+
+        validators = self.get_validators(self.get_instance_module_ids(instance))
+        not_modified = self.get_not_modified(validators)
+        if not_modified is not None:
+            return not_modified
+
+        with self.phase('serialize'):
+            data = self.get_serializer(instance).data
+        return self.set_validators(Response(data), validators)
+
+    def get_instance_module_ids(self, instance):
+        return None
 
 
-class CreateModelMixinCustom(CreateModelMixin):
+class CreateModelMixinCustom(ServerTimingMixin, CreateModelMixin):
     def create(self, request, *args, **kwargs):
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        serializer = self.perform_create(serializer)
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+        with self.phase('validate'):
+            serializer = self.get_serializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+        with self.phase('perform'):
+            serializer = self.perform_create(serializer)
+        with self.phase('serialize'):
+            data = serializer.data
+        headers = self.get_success_headers(data)
+        return Response(data, status=status.HTTP_201_CREATED, headers=headers)
 
     def perform_create(self, serializer):
         new_module = self.model_operations.objects.execute_create(
@@ -62,7 +173,7 @@ class CreateModelMixinCustom(CreateModelMixin):
         return serializer
 
 
-class UpdateModelMixinCustom(UpdateModelMixin):
+class UpdateModelMixinCustom(ServerTimingMixin, UpdateModelMixin):
     def perform_update(self, pk, serializer):
         list_method_update = {
             'PUT': self.model_operations.objects.execute_update,
@@ -86,14 +197,17 @@ class UpdateModelMixinCustom(UpdateModelMixin):
         )
 
         pk = kwargs['pk']
-        serializer = self.get_serializer(data=request.data, partial=partial)
-        serializer.is_valid(raise_exception=True)
-        serializer = self.perform_update(pk, serializer)
+        with self.phase('validate'):
+            serializer = self.get_serializer(data=request.data, partial=partial)
+            serializer.is_valid(raise_exception=True)
+        with self.phase('perform'):
+            serializer = self.perform_update(pk, serializer)
 
-        return Response(serializer.data)
+        with self.phase('serialize'):
+            return Response(serializer.data)
 
 
-class DestroyModelMixinCustom(DestroyModelMixin):
+class DestroyModelMixinCustom(ServerTimingMixin, DestroyModelMixin):
     def destroy(self, request, *args, **kwargs):
         assert 'pk' in kwargs, (
             'Expected view %s to be called with a URL keyword argument '
@@ -105,7 +219,8 @@ class DestroyModelMixinCustom(DestroyModelMixin):
         pk = kwargs['pk']
 
         try:
-            self.perform_destroy(pk)
+            with self.phase('perform'):
+                self.perform_destroy(pk)
             return Response(status=status.HTTP_204_NO_CONTENT)
         except ObjectDoesNotExist as e:
             return Response({'message': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
@@ -4,4 +4,4 @@ from .custom_fields import CharFieldTrim
 from .custom_managers import GenericManager
 
 from .modules import Module  # isort: skip
-from .menus import Menu  # isort: skip
+from .menus import Menu, SiblingCounter  # isort: skip
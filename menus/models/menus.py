@@ -1,85 +1,481 @@
 from abc import ABC, abstractmethod
 from ast import arg
+from collections import defaultdict
 from dataclasses import dataclass
 from typing import List
 
-from django.db import models
-from django.db.models import F, Max
-from django.db.models.functions import Coalesce
+from django.conf import settings
+from django.contrib.postgres.indexes import OpClass
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+from django.db.models import Exists, F, OuterRef, Q, Value
+from django.db.models.functions import Concat, Substr
 
-from menus.consts import ErrorMessage
+from menus import metrics, tree_cache
+from menus.consts import ErrorMessage, OrderingMode, TreeFields
 from menus.models import Module
 from menus.models.custom_fields import CharFieldTrim
 from menus.models.custom_managers import GenericManager
 
+# Caracteres del path que guarda su indice: una llave btree no puede pasar de
+# unos 2700 bytes y el path de un arbol profundo no tiene limite
+PATH_INDEX_LENGTH = 1024
+
+SUBTREE_SQL = '''
+WITH RECURSIVE subtree AS (
+    SELECT id, depth FROM {table} WHERE id = %(pk)s
+    UNION ALL
+    SELECT menu.id, menu.depth FROM {table} menu JOIN subtree ON menu.parent_id = subtree.id
+    WHERE %(max_depth)s::integer IS NULL
+       OR menu.depth <= (SELECT depth FROM {table} WHERE id = %(pk)s) + %(max_depth)s::integer
+)
+SELECT menu.id, menu.name, menu.module_id, menu.parent_id, menu."order", menu.position, menu.path, menu.depth
+FROM {table} menu JOIN subtree ON menu.id = subtree.id
+ORDER BY menu.parent_id, {order_by}
+'''
+
+ITER_TREE_SQL = '''
+WITH RECURSIVE tree AS (
+    SELECT {menu_columns}, ARRAY[{sort_key}]::bigint[] AS sort_key
+    FROM {table} menu WHERE parent_id IS NULL AND (%(modules)s::integer[] IS NULL OR module_id = ANY(%(modules)s))
+    UNION ALL
+    SELECT {menu_columns}, tree.sort_key || ARRAY[{sort_key}]::bigint[]
+    FROM {table} menu JOIN tree ON menu.parent_id = tree.id
+)
+SELECT {columns} FROM tree
+ORDER BY module_id, sort_key
+'''
+
+PROJECTED_TREE_SQL = '''
+WITH RECURSIVE tree AS (
+    SELECT {columns}, 0 AS level FROM {table} menu WHERE {start}
+    UNION ALL
+    SELECT {columns}, tree.level + 1 FROM {table} menu JOIN tree ON menu.parent_id = tree.id
+    WHERE %(max_depth)s::integer IS NULL OR tree.level < %(max_depth)s::integer
+)
+SELECT {names} FROM tree
+ORDER BY module_id, parent_id, {order_by}
+'''
+
+REBALANCE_SQL = '''
+UPDATE {table} menu
+SET position = ranked.num * %(gap)s, "order" = ranked.num
+FROM (
+    SELECT id, ROW_NUMBER() OVER (PARTITION BY module_id, parent_id ORDER BY position, id) AS num
+    FROM {table} WHERE {where}
+) ranked
+WHERE menu.id = ranked.id
+'''
+
+REORDER_SQL = '''
+UPDATE {table} menu
+SET "order" = new.num, position = new.num * %(gap)s
+FROM unnest(%(menus)s::integer[]) WITH ORDINALITY AS new (id, num)
+WHERE menu.id = new.id AND (menu."order" <> new.num OR menu.position <> new.num * %(gap)s)
+'''
+
+DELETE_SUBTREE_SQL = '''
+WITH deleted AS (
+    DELETE FROM {table} WHERE module_id = %(module)s
+    AND (id = %(pk)s OR (SUBSTRING(path, 1, {index_length}) LIKE %(key)s AND path LIKE %(prefix)s))
+    RETURNING id
+), counters AS (
+    DELETE FROM {counter_table} WHERE module_id = %(module)s AND parent_key IN (SELECT id FROM deleted)
+)
+SELECT COUNT(*) FROM deleted
+'''
+
+# Con llave primaria los joins contra el mapeo no dependen de las estadisticas del modulo origen
+CLONE_IDS_SQL = '''
+CREATE TEMP TABLE {ids} (old_id bigint PRIMARY KEY, new_id bigint NOT NULL) ON COMMIT DROP;
+INSERT INTO {ids} SELECT id, nextval(pg_get_serial_sequence('{table}', 'id'))
+FROM {table} WHERE module_id = %(source)s;
+ANALYZE {ids};
+'''
+
+COPY_MODULE_SQL = '''
+WITH menus AS (
+    INSERT INTO {table} (id, name, module_id, parent_id, "order", position, path, depth)
+    SELECT ids.new_id, menu.name, %(target)s, parent.new_id, menu."order", menu.position, '', menu.depth
+    FROM {ids} ids JOIN {table} menu ON menu.id = ids.old_id
+    LEFT JOIN {ids} parent ON parent.old_id = menu.parent_id
+    RETURNING id
+), counters AS (
+    INSERT INTO {counter_table} (module_id, parent_key, last_order)
+    SELECT %(target)s, COALESCE(ids.new_id, 0), counter.last_order
+    FROM {counter_table} counter LEFT JOIN {ids} ids ON ids.old_id = counter.parent_key
+    WHERE counter.module_id = %(source)s AND (counter.parent_key = 0 OR ids.new_id IS NOT NULL)
+)
+SELECT COUNT(*) FROM menus
+'''
+
+MODULE_PATHS_SQL = '''
+WITH RECURSIVE tree AS (
+    SELECT id, ''::text AS path FROM {table} WHERE module_id = %(module)s AND parent_id IS NULL
+    UNION ALL
+    SELECT menu.id, tree.path || tree.id || '/' FROM {table} menu JOIN tree ON menu.parent_id = tree.id
+)
+UPDATE {table} menu SET path = tree.path FROM tree WHERE menu.id = tree.id AND tree.path <> ''
+'''
+
+NEXT_ORDER_SQL = '''
+UPDATE {table} SET last_order = last_order + %(count)s
+WHERE module_id = %(module)s AND parent_key = %(parent_key)s
+RETURNING last_order
+'''
+
+SEED_ORDER_SQL = '''
+INSERT INTO {table} (module_id, parent_key, last_order)
+SELECT %(module)s, %(parent_key)s,
+       GREATEST(COALESCE(MAX("order"), 0), COALESCE(MAX(position), 0) / %(gap)s) + %(count)s
+FROM {menu_table} WHERE module_id = %(module)s AND parent_id IS NOT DISTINCT FROM %(parent)s
+ON CONFLICT (module_id, parent_key) DO UPDATE SET last_order = {table}.last_order + %(count)s
+RETURNING last_order
+'''
+
+LOCK_ORDER_SQL = '''
+SELECT last_order FROM {table} WHERE module_id = %(module)s AND parent_key = %(parent_key)s FOR UPDATE
+'''
+
+# Baja el contador al ultimo orden (o posicion, en modo gap) que sigue en uso
+RELEASE_ORDER_SQL = '''
+UPDATE {table} SET last_order = (
+    SELECT GREATEST(COALESCE(MAX("order"), 0), COALESCE(MAX(position), 0) / %(gap)s)
+    FROM {menu_table} WHERE module_id = %(module)s AND {parent}
+)
+WHERE module_id = %(module)s AND parent_key = %(parent_key)s
+'''
+
 
 class MenuManager(GenericManager):
 
+    @metrics.observe_write('menu', 'create')
     def execute_create(self, name, module=None, parent=None):
-        if parent:
+        # El modulo del padre solo se consulta si no es el que ya llego
+        if parent and getattr(module, 'pk', None) != parent.module_id:
             module = parent.module
 
-        order = self.next_order_num(module=module, parent=parent)
+        with transaction.atomic():
+            order = self.next_order_num(module=module, parent=parent)
+            position = self.next_position(order)
 
-        menu = self.model(name=name, module=module, parent=parent, order=order)
-        menu.full_clean()
-        menu.save()
+            menu = self.model(name=name, module=module, parent=parent, order=order, position=position)
+            menu.full_clean()
+            menu.save()
+        tree_cache.invalidate_modules(menu.module_id)
         return menu
 
+    @metrics.observe_write('menu', 'delete')
     def execute_delete(self, pk):
         menu = self.find_by_pk(pk)
-        menu.delete()
+        menu_id = menu.pk
+        with transaction.atomic():
+            menu.delete()
+            SiblingCounter.objects.filter(module_id=menu.module_id, parent_key=menu_id).delete()
+            self.release_orders(module=menu.module_id, parent=menu.parent_id)
+        tree_cache.invalidate_modules(menu.module_id)
 
+    @metrics.observe_write('menu', 'delete_subtree')
+    def execute_delete_subtree(self, pk):
+        """
+        Delete the menu with all its descendants and close the gap it leaves
+        among its siblings. Returns the number of deleted menus.
+        """
+        menu = self.find_by_pk(pk)
+        # El path de los descendientes empieza con el del menu; solo tiene digitos y '/'
+        prefix = menu.path_children()
+        params = {'module': menu.module_id, 'pk': menu.pk, 'prefix': f'{prefix}%',
+                  'key': f'{prefix[:PATH_INDEX_LENGTH]}%'}
+        sql = DELETE_SUBTREE_SQL.format(table=self.model._meta.db_table, counter_table=SiblingCounter._meta.db_table,
+                                        index_length=PATH_INDEX_LENGTH)
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                deleted = cursor.fetchone()[0]
+            if not self.gap_ordering():
+                self.filter(module_id=menu.module_id, parent_id=menu.parent_id, order__gt=menu.order).update(
+                    order=F('order') - 1, position=(F('order') - 1) * OrderingMode.GAP_SIZE)
+            self.release_orders(module=menu.module_id, parent=menu.parent_id)
+        tree_cache.invalidate_modules(menu.module_id)
+        return deleted
+
+    @metrics.observe_write('menu', 'update')
     def execute_update(self, pk, name):
         menu = self.find_by_pk(pk)
         menu.name = name
-        menu.full_clean()
+        # Solo cambia el nombre; no hace falta revalidar las relaciones ni la posicion
+        menu.full_clean(exclude=['module', 'parent', 'position'])
         menu.save(update_fields=['name'])
+        tree_cache.invalidate_modules(menu.module_id)
         return menu
 
+    @metrics.observe_write('menu', 'partial_update')
     def execute_partial_update(self, *args, **kwargs):
         pk = kwargs['pk']
         order = kwargs['order']
         self.change_order_to(pk=pk, new_order=order)
 
+    @metrics.observe_write('menu', 'move')
+    def execute_move(self, pk, new_parent=None, position=None):
+        """
+        Move the menu with its subtree under new_parent (to the roots when it is
+        None), at the 1-based position among the new siblings or at the end.
+        The number of statements does not depend on the size of the subtree.
+        """
+        with transaction.atomic():
+            menu, parent = self.lock_for_move(pk, getattr(new_parent, 'pk', new_parent))
+            if parent is not None and parent.module_id != menu.module_id:
+                raise ValidationError(ErrorMessage.MOVE_OTHER_MODULE)
+            if parent is not None and (parent.pk == menu.pk or menu.pk in parent.ancestor_ids()):
+                raise ValidationError(ErrorMessage.MOVE_CYCLE)
+
+            if getattr(parent, 'pk', None) == menu.parent_id:
+                if position is not None:
+                    # Igual que entre padres distintos, la posicion queda entre el primero y el ultimo hermano
+                    last_order = self.filter(module_id=menu.module_id, parent_id=menu.parent_id).count()
+                    self.change_order_to(pk=menu.pk, new_order=min(max(position, 1), last_order))
+                    menu.refresh_from_db(fields=['order', 'position'])
+                return menu
+
+            old_parent_id, old_order = menu.parent_id, menu.order
+            old_depth, old_prefix = menu.depth, menu.path_children()
+            menu.parent = parent
+            menu.set_path()
+            if self.gap_ordering():
+                menu.order = self.next_order_num(module=menu.module_id, parent=menu.parent_id)
+                menu.position = self.next_position(menu.order)
+            else:
+                # Cierra el hueco entre los hermanos anteriores y abre el lugar entre los nuevos
+                self.filter(module_id=menu.module_id, parent_id=old_parent_id, order__gt=old_order).update(
+                    order=F('order') - 1, position=(F('order') - 1) * OrderingMode.GAP_SIZE)
+                last_order = self.next_order_num(module=menu.module_id, parent=menu.parent_id)
+                menu.order = last_order if position is None else min(max(position, 1), last_order)
+                if menu.order < last_order:
+                    self.filter(module_id=menu.module_id, parent_id=menu.parent_id, order__gte=menu.order).update(
+                        order=F('order') + 1, position=(F('order') + 1) * OrderingMode.GAP_SIZE)
+                menu.position = menu.order * OrderingMode.GAP_SIZE
+
+            # El subarbol cambia el prefijo de su path y la profundidad en un solo UPDATE
+            self.filter_path_prefix(old_prefix).filter(module_id=menu.module_id).update(
+                path=Concat(Value(menu.path_children()), Substr('path', len(old_prefix) + 1)),
+                depth=F('depth') + (menu.depth - old_depth))
+            self.filter(pk=menu.pk).update(parent=parent, path=menu.path, depth=menu.depth,
+                                           order=menu.order, position=menu.position)
+            self.release_orders(module=menu.module_id, parent=old_parent_id)
+            if self.gap_ordering() and position is not None:
+                # En modo gap basta con elegir una posicion entre los nuevos hermanos
+                self.move_between_gaps(menu, position)
+                menu.refresh_from_db(fields=['order', 'position'])
+        tree_cache.invalidate_modules(menu.module_id)
+        return menu
+
+    def lock_for_move(self, pk, parent_pk=None):
+        # Bloquea en orden de pk el menu, el nuevo padre y los ancestros del padre: dos
+        # movimientos que juntos formarian un ciclo comparten alguna fila bloqueada y el
+        # segundo revisa los ancestros con el path que dejo el primero
+        parent = self.find_by_pk(parent_pk) if parent_pk is not None else None
+        pks = {int(pk)}
+        while True:
+            if parent is not None:
+                pks |= {parent.pk, *parent.ancestor_ids()}
+            locked = {menu.pk: menu for menu in self.select_for_update().filter(pk__in=pks).order_by('pk')}
+            for missing in (int(pk), getattr(parent, 'pk', None)):
+                if missing is not None and missing not in locked:
+                    name_model = self.model._meta.model_name
+                    raise self.model.DoesNotExist(ErrorMessage.PK_NOT_EXIST.format(name_model, missing))
+            if parent is None:
+                return locked[int(pk)], None
+            # Si otro movimiento cambio los ancestros del padre mientras se esperaba, se bloquean los nuevos
+            parent = locked[parent.pk]
+            if pks.issuperset(parent.ancestor_ids()):
+                return locked[int(pk)], parent
+
     def execute_retrieve(self, *args, **kwargs):
-        module = kwargs['pk']
-        return self.get_tree_by_module(module)
+        return self.get_subtree(kwargs['pk'], max_depth=kwargs.get('max_depth'))
+
+    def gap_ordering(self):
+        return getattr(settings, 'MENUS_ORDERING', OrderingMode.DENSE) == OrderingMode.GAP
+
+    def sort_fields(self):
+        if self.gap_ordering():
+            return ('position', 'id')
+        return ('order',)
 
     def next_order_num(self, module=None, parent=None):
-        if parent:
-            module = parent.module
-        order = self.filter(module=module, parent=parent).aggregate(
-            num=Coalesce(Max('order'), 0))['num']
-        return order + 1
+        return self.reserve_orders(module=module, parent=parent)
+
+    def reserve_orders(self, module=None, parent=None, count=1):
+        # Reserva los siguientes count ordenes del contador del grupo de hermanos y
+        # devuelve el ultimo; la fila del contador queda bloqueada hasta el commit,
+        # asi no se repiten ordenes. module y parent pueden ser instancias o ids
+        module_id = getattr(parent, 'module_id', None) or getattr(module, 'pk', module)
+        if module_id is None:
+            return count
+
+        parent_id = getattr(parent, 'pk', parent)
+        params = {'module': module_id, 'parent_key': parent_id or 0, 'count': count}
+        with connection.cursor() as cursor:
+            cursor.execute(NEXT_ORDER_SQL.format(table=SiblingCounter._meta.db_table), params)
+            row = cursor.fetchone()
+            if row is None:
+                params['parent'] = parent_id
+                params['gap'] = OrderingMode.GAP_SIZE
+                cursor.execute(SEED_ORDER_SQL.format(table=SiblingCounter._meta.db_table,
+                                                     menu_table=self.model._meta.db_table), params)
+                row = cursor.fetchone()
+        return row[0]
+
+    def release_orders(self, module, parent=None):
+        # Despues de borrar o sacar hermanos el contador vuelve al ultimo orden en uso,
+        # asi no deja huecos ni crece sin limite. Se bloquea primero la fila del
+        # contador para que la segunda sentencia vea los menus ya confirmados
+        module_id, parent_id = getattr(module, 'pk', module), getattr(parent, 'pk', parent)
+        params = {'module': module_id, 'parent_key': parent_id or 0, 'parent': parent_id,
+                  'gap': OrderingMode.GAP_SIZE}
+        condition = 'parent_id IS NULL' if parent_id is None else 'parent_id = %(parent)s'
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_ORDER_SQL.format(table=SiblingCounter._meta.db_table), params)
+            if cursor.fetchone() is None:
+                return
+            cursor.execute(RELEASE_ORDER_SQL.format(table=SiblingCounter._meta.db_table, parent=condition,
+                                                    menu_table=self.model._meta.db_table), params)
+
+    def next_position(self, order):
+        # Los ordenes del contador crecen siempre, asi la nueva posicion queda al final
+        return order * OrderingMode.GAP_SIZE
 
     def change_order_to(self, pk, new_order):
-        menu = self.find_by_pk(pk)
-        sort_order = sorted([menu.order, new_order])
-        add_order = -1 if menu.order < new_order else 1
-
-        self.filter(module=menu.module, parent=menu.parent,
-                    order__gte=sort_order[0], order__lte=sort_order[1]
-                    ).update(order=F('order')+add_order)
-        self.filter(pk=menu.id).update(order=new_order)
-
-    def build_tree_menu(self, nodes_menu, id_parent, deep):
-        tree_menu = [TreeMenu(module=node.module.id,
-                              pk=node.id,
-                              name=node.name,
-                              order=node.order,
-                              parent=node.parent_id,
-                              deep=deep,
-                              sub_menu=self.build_tree_menu(nodes_menu, node.id, deep+1))
-                     for node in nodes_menu if node.parent_id == id_parent]
+        # La restriccion de posiciones se verifica al commit: fuera de una transaccion
+        # (shell, comandos) cada UPDATE haria su propio commit con posiciones repetidas
+        with transaction.atomic():
+            menu = self.find_by_pk(pk)
+            if self.gap_ordering():
+                moved = self.move_between_gaps(menu, new_order)
+                metrics.REORDER_ROWS.labels(OrderingMode.GAP).observe(moved)
+                tree_cache.invalidate_modules(menu.module_id)
+                return
+
+            sort_order = sorted([menu.order, new_order])
+            add_order = -1 if menu.order < new_order else 1
+
+            moved = self.filter(module_id=menu.module_id, parent_id=menu.parent_id,
+                                order__gte=sort_order[0], order__lte=sort_order[1]
+                                ).exclude(pk=menu.pk).update(order=F('order')+add_order,
+                                                             position=(F('order')+add_order) * OrderingMode.GAP_SIZE)
+            moved += self.filter(pk=menu.id).update(order=new_order, position=new_order * OrderingMode.GAP_SIZE)
+        metrics.REORDER_ROWS.labels(OrderingMode.DENSE).observe(moved)
+        tree_cache.invalidate_modules(menu.module_id)
+
+    def move_between_gaps(self, menu, new_order):
+        # Solo se escribe la fila movida; los hermanos se reescriben cuando no quedan huecos
+        new_order = max(new_order, 1)
+        siblings = self.filter(module_id=menu.module_id, parent_id=menu.parent_id).exclude(pk=menu.pk)
+        neighbors = list(siblings.order_by('position', 'id').values_list(
+            'position', flat=True)[max(new_order - 2, 0):new_order])
+
+        if new_order == 1:
+            before, after = None, next(iter(neighbors), None)
+        else:
+            before, after = next(iter(neighbors), None), next(iter(neighbors[1:]), None)
+
+        if after is None:
+            # Al final se usa una posicion nueva del contador
+            position = self.next_position(self.next_order_num(module=menu.module_id, parent=menu.parent_id))
+        elif before is None:
+            position = after - OrderingMode.GAP_SIZE
+        elif after - before > 1:
+            position = (before + after) // 2
+        else:
+            rebalanced = self.rebalance_positions(module=menu.module_id, parent=menu.parent_id)
+            return rebalanced + self.move_between_gaps(menu, new_order)
+
+        return self.filter(pk=menu.pk).update(position=position, order=new_order)
+
+    @metrics.observe_write('menu', 'reorder')
+    def execute_reorder(self, module, parent, menus):
+        """
+        Give the children of parent (the roots of module when parent is None)
+        the orders 1..n following the ids in menus, with a single UPDATE.
+        Returns the number of menus that changed.
+        """
+        module, parent = getattr(module, 'pk', module), getattr(parent, 'pk', parent)
+        with transaction.atomic():
+            siblings = self.filter(module_id=module, parent_id=parent).select_for_update()
+            if len(menus) != len(set(menus)) or set(siblings.values_list('id', flat=True)) != set(menus):
+                raise ValidationError(ErrorMessage.REORDER_MISMATCH)
+
+            # Solo se escriben los menus que cambian de lugar
+            params = {'menus': list(menus), 'gap': OrderingMode.GAP_SIZE}
+            with connection.cursor() as cursor:
+                cursor.execute(REORDER_SQL.format(table=self.model._meta.db_table), params)
+                moved = cursor.rowcount
+        metrics.REORDER_ROWS.labels('bulk').observe(moved)
+        tree_cache.invalidate_modules(module)
+        return moved
+
+    def copy_module_menus(self, source, target):
+        """
+        Copy every menu of the source module, with its sibling counters, into
+        the target module in one INSERT ... SELECT, through a temporary table
+        that maps the old ids to new ones. Returns the number of copied menus.
+        """
+        tables = {'table': self.model._meta.db_table, 'counter_table': SiblingCounter._meta.db_table,
+                  'ids': 'menu_clone_ids'}
+        params = {'source': getattr(source, 'pk', source), 'target': getattr(target, 'pk', target)}
+        with connection.cursor() as cursor:
+            cursor.execute(CLONE_IDS_SQL.format(**tables), params)
+            cursor.execute(COPY_MODULE_SQL.format(**tables), params)
+            copied = cursor.fetchone()[0]
+            cursor.execute('DROP TABLE {ids}'.format(**tables))
+            # Los paths se arman con los ids nuevos una vez insertados todos los menus
+            cursor.execute(MODULE_PATHS_SQL.format(**tables), {'module': params['target']})
+        return copied
+
+    def rebalance_positions(self, module=None, parent=None):
+        # Renumera position y order de cada grupo de hermanos en un solo UPDATE
+        where, params = ['TRUE'], {'gap': OrderingMode.GAP_SIZE}
+        if module is not None:
+            where.append('module_id = %(module)s')
+            params['module'] = getattr(module, 'pk', module)
+            where.append('parent_id IS NOT DISTINCT FROM %(parent)s')
+            params['parent'] = getattr(parent, 'pk', parent)
+        sql = REBALANCE_SQL.format(table=self.model._meta.db_table, where=' AND '.join(where))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def build_tree_menu(self, nodes_menu, id_parent, dense_order=False):
+        # Agrupa los hijos por padre en una sola pasada, conservando el orden
+        # del queryset, y arma el arbol sin recursion
+        children_by_parent = defaultdict(list)
+        for node in nodes_menu:
+            children_by_parent[node.parent_id].append(node)
+
+        # Las raices de varios modulos comparten parent None; se numeran por modulo
+        dense_orders = defaultdict(int)
+        tree_menu = []
+        pending = [(tree_menu, id_parent)]
+        while pending:
+            sub_menu, parent_id = pending.pop()
+            for node in children_by_parent.get(parent_id, ()):
+                dense_orders[node.module_id, parent_id] += 1
+                item = TreeMenu(module=node.module_id,
+                                pk=node.id,
+                                name=node.name,
+                                order=dense_orders[node.module_id, parent_id] if dense_order else node.order,
+                                parent=node.parent_id,
+                                deep=node.depth,
+                                sub_menu=[])
+                sub_menu.append(item)
+                pending.append((item.sub_menu, node.id))
         return tree_menu
 
     def get_tree_complete(self, queryset):
-        nodes_menu = queryset.select_related('module').order_by('module', 'parent', 'order')
+        nodes_menu = queryset.order_by('module', 'parent', *self.sort_fields())
         lista_menus = []
 
         tree_menu_temp = self.build_tree_menu(
-            nodes_menu, None, 0)
+            nodes_menu, None, dense_order=self.gap_ordering())
 
         for node in tree_menu_temp:
             num_items = len(lista_menus)
@@ -92,6 +488,226 @@ class MenuManager(GenericManager):
 
         return lista_menus
 
+    def iter_tree(self, module_ids=None, chunk_size=2000):
+        """
+        Yield (module_id, menu, depth, ancestor_ids) for every menu of the given
+        modules in depth-first order, reading the rows from a server-side
+        cursor. Only a chunk of rows and the current branch stay in memory.
+        """
+        fields = [field.attname for field in self.model._meta.concrete_fields]
+        sort_key = 'menu.position, menu.id' if self.gap_ordering() else 'menu."order", menu.id'
+        columns = ', '.join(f'"{field}"' for field in fields)
+        sql = ITER_TREE_SQL.format(table=self.model._meta.db_table, sort_key=sort_key, columns=columns,
+                                   menu_columns=', '.join(f'menu."{field}"' for field in fields))
+        params = {'modules': None if module_ids is None else list(module_ids)}
+
+        # Ids de la rama actual, de la raiz al padre del menu
+        branch = []
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    menu = self.model.from_db(self.db, fields, row)
+                    del branch[menu.depth:]
+                    yield menu.module_id, menu, menu.depth, tuple(branch)
+                    branch.append(menu.pk)
+
+    def get_subtree(self, pk, max_depth=None):
+        order_by = ', '.join(f'menu."{field}"' for field in self.sort_fields())
+        sql = SUBTREE_SQL.format(table=self.model._meta.db_table, order_by=order_by)
+        pk = int(pk)
+        nodes_menu = list(self.raw(sql, {'pk': pk, 'max_depth': max_depth}))
+        root = next((node for node in nodes_menu if node.id == pk), None)
+        if root is None:
+            name_model = self.model._meta.model_name
+            raise self.model.DoesNotExist(ErrorMessage.PK_NOT_EXIST.format(name_model, pk))
+
+        if self.gap_ordering():
+            root.order = self.dense_order(root)
+
+        return TreeMenu(module=root.module_id,
+                        pk=root.id,
+                        name=root.name,
+                        order=root.order,
+                        parent=root.parent_id,
+                        deep=root.depth,
+                        sub_menu=self.build_tree_menu(nodes_menu, root.id, dense_order=self.gap_ordering()))
+
+    def dense_order(self, menu):
+        # Lugar 1..n del menu entre sus hermanos, el mismo que le da el arbol en modo gap
+        return self.filter(Q(position__lt=menu.position) | Q(position=menu.position, id__lt=menu.id),
+                           module_id=menu.module_id, parent_id=menu.parent_id).count() + 1
+
+    def get_children_page(self, module, parent=None, cursor=None, limit=100):
+        """
+        Return (menus, next_cursor) with up to limit children of parent (the
+        roots of module when parent is None), each one with has_children.
+        The cursor is (sort value, id, menus already returned) of the last
+        menu of the previous page; pages are read by keyset, never by OFFSET.
+        """
+        sort_field = 'position' if self.gap_ordering() else 'order'
+        children = self.filter(module_id=getattr(module, 'pk', module), parent_id=getattr(parent, 'pk', parent))
+        children = children.annotate(has_children=Exists(self.filter(parent_id=OuterRef('pk'))))
+        returned = 0
+        if cursor is not None:
+            value, last_id, returned = cursor
+            children = children.filter(Q(**{f'{sort_field}__gt': value}) | Q(**{sort_field: value, 'id__gt': last_id}))
+        menus = list(children.order_by(sort_field, 'id')[:limit + 1])
+
+        next_cursor = None
+        if len(menus) > limit:
+            menus = menus[:limit]
+            next_cursor = (getattr(menus[-1], sort_field), menus[-1].pk, returned + limit)
+        if self.gap_ordering():
+            # El cursor lleva cuantos menus se devolvieron antes para numerarlos sin contarlos
+            for number, menu in enumerate(menus, returned + 1):
+                menu.order = number
+        return menus, next_cursor
+
+    def projected_columns(self, fields, ordered=False):
+        # id, modulo y padre siempre se leen para armar el arbol; el resto solo si se pide
+        columns = ['id', 'module_id', 'parent_id']
+        columns += [TreeFields.COLUMNS[field] for field in fields if field != 'order' or not self.gap_ordering()]
+        if ordered:
+            # El ORDER BY sobre el CTE solo ve las columnas seleccionadas
+            columns += self.sort_fields()
+        return list(dict.fromkeys(columns))
+
+    def get_projected_rows(self, start, params, max_depth, fields):
+        """
+        Read the menus below the start condition, down to max_depth levels,
+        selecting only the columns the requested fields need.
+        """
+        columns = self.projected_columns(fields, ordered=True)
+        order_by = ', '.join(f'"{field}"' for field in self.sort_fields())
+        sql = PROJECTED_TREE_SQL.format(table=self.model._meta.db_table, start=start, order_by=order_by,
+                                        columns=', '.join(f'menu."{column}"' for column in columns),
+                                        names=', '.join(f'"{column}"' for column in columns))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, dict(params, max_depth=max_depth))
+            for row in cursor:
+                yield dict(zip(columns, row))
+
+    def build_projected_tree(self, rows, fields):
+        """
+        Nest the rows as dictionaries with only the given fields and their
+        sub_menu. Returns {(module_id, parent_id): [items]}.
+        """
+        dense_order = self.gap_ordering()
+        selected = [(field, TreeFields.COLUMNS[field]) for field in fields]
+        items_by_parent = defaultdict(list)
+        for row in rows:
+            siblings = items_by_parent[row['module_id'], row['parent_id']]
+            item = {field: len(siblings) + 1 if dense_order and field == 'order' else row[column]
+                    for field, column in selected}
+            item['sub_menu'] = items_by_parent[row['module_id'], row['id']]
+            siblings.append(item)
+        return items_by_parent
+
+    def get_projected_tree_rows(self, module_ids, max_depth=None, fields=tuple(TreeFields.COLUMNS)):
+        if max_depth is None:
+            return self.filter(module_id__in=module_ids).order_by(
+                'module', 'parent', *self.sort_fields()).values(*self.projected_columns(fields)).iterator()
+        return self.get_projected_rows('menu.parent_id IS NULL AND menu.module_id = ANY(%(modules)s)',
+                                       {'modules': list(module_ids)}, max_depth, fields)
+
+    def get_projected_trees(self, module_ids, max_depth=None, fields=tuple(TreeFields.COLUMNS)):
+        """
+        Return {module_id: [items]} with the menus of every module down to
+        max_depth, as dictionaries with only the given fields.
+        """
+        rows = self.get_projected_tree_rows(module_ids, max_depth, fields)
+        items_by_parent = self.build_projected_tree(rows, fields)
+        return {module_id: items_by_parent.get((module_id, None), []) for module_id in module_ids}
+
+    def get_flat_trees(self, module_ids, max_depth=None):
+        """
+        Return {module_id: columns} where columns has the ids, parent_index
+        (-1 for the roots), order and names of the menus in depth-first order.
+        A client rebuilds the tree in one pass over the arrays.
+        """
+        dense_order = self.gap_ordering()
+        children = defaultdict(list)
+        for row in self.get_projected_tree_rows(module_ids, max_depth, ('pk', 'name', 'order')):
+            children[row['module_id'], row['parent_id']].append(row)
+
+        trees = {}
+        for module_id in module_ids:
+            ids, parent_index, orders, names = [], [], [], []
+            # Pila de (indice del padre, hermanos pendientes) para recorrer en profundidad
+            pending = [(-1, enumerate(children.get((module_id, None), ()), 1))]
+            while pending:
+                parent, siblings = pending[-1]
+                number, row = next(siblings, (None, None))
+                if row is None:
+                    pending.pop()
+                    continue
+                pending.append((len(ids), enumerate(children.get((module_id, row['id']), ()), 1)))
+                ids.append(row['id'])
+                parent_index.append(parent)
+                orders.append(number if dense_order else row['order'])
+                names.append(row['name'])
+            trees[module_id] = {'ids': ids, 'parent_index': parent_index, 'order': orders, 'names': names}
+        return trees
+
+    def get_projected_subtree(self, pk, max_depth=None, fields=tuple(TreeFields.COLUMNS)):
+        """
+        Return the menu with its descendants down to max_depth levels as a
+        dictionary with only the given fields.
+        """
+        pk = int(pk)
+        rows = list(self.get_projected_rows('menu.id = %(pk)s', {'pk': pk}, max_depth, fields))
+        root = next((row for row in rows if row['id'] == pk), None)
+        if root is None:
+            name_model = self.model._meta.model_name
+            raise self.model.DoesNotExist(ErrorMessage.PK_NOT_EXIST.format(name_model, pk))
+
+        items_by_parent = self.build_projected_tree(rows, fields)
+        item, = items_by_parent[root['module_id'], root['parent_id']]
+        if self.gap_ordering() and 'order' in fields:
+            item['order'] = self.filter(
+                Q(position__lt=root['position']) | Q(position=root['position'], id__lt=root['id']),
+                module_id=root['module_id'], parent_id=root['parent_id']).count() + 1
+        return item
+
+    def filter_path_prefix(self, prefix):
+        # El indice solo cubre el inicio del path; la segunda condicion compara el path completo
+        return self.alias(path_key=Substr('path', 1, PATH_INDEX_LENGTH)).filter(
+            path_key__startswith=prefix[:PATH_INDEX_LENGTH], path__startswith=prefix)
+
+    def get_descendants(self, menu):
+        return self.filter_path_prefix(menu.path_children())
+
+    def get_ancestors(self, menu):
+        return self.filter(pk__in=menu.ancestor_ids()).order_by('depth')
+
+    def build_trees_by_module(self, module_ids):
+        trees = {module_id: [] for module_id in module_ids}
+        tree_complete = self.get_tree_complete(self.filter(module_id__in=module_ids))
+        trees.update((tree.module, tree.menus) for tree in tree_complete)
+        return trees
+
+    def get_trees_by_module(self, module_ids):
+        return tree_cache.get_or_build('tree', module_ids, self.build_trees_by_module)
+
+    def get_module_ids(self, module_id=None):
+        if module_id is not None:
+            # Un id de la URL que no existe no debe crear versiones en el cache;
+            # si ya tiene version el modulo existe y no se consulta
+            if tree_cache.has_module_version(module_id) or Module.objects.filter(pk=module_id).exists():
+                return [module_id]
+            return []
+        return Module.objects.get_module_ids()
+
+    def get_tree_cached(self, module_id=None):
+        module_ids = self.get_module_ids(module_id)
+        trees = self.get_trees_by_module(module_ids)
+        return [TreeModule(module=module_id, menus=trees[module_id])
+                for module_id in module_ids if trees[module_id]]
+
 
 @dataclass
 class TreeMenu:
@@ -120,6 +736,58 @@ class Menu(models.Model):
         Module, on_delete=models.PROTECT, related_name='modules')
     parent = models.ForeignKey(
         'self', null=True, default=None, blank=True, on_delete=models.PROTECT)
-    order = models.PositiveSmallIntegerField(default=0)
+    # Del mismo tipo que SiblingCounter.last_order, de donde sale
+    order = models.PositiveIntegerField(default=0)
+    # Llave de orden dispersa; en modo gap order se calcula a partir de ella
+    position = models.BigIntegerField(default=0)
+    # Ids de los ancestros separados por '/', p. ej. '1/5/' para un nieto de 1
+    path = models.TextField(default='', blank=True, editable=False)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
 
     objects = MenuManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['module', 'parent', 'order'], name='menu_sibling_order_idx'),
+            models.Index(fields=['module', 'order'], condition=Q(parent=None), name='menu_root_order_idx'),
+            models.Index(fields=['module', 'position'], condition=Q(parent=None), name='menu_root_position_idx'),
+            # Sirve los LIKE 'prefijo%' de los descendientes sin guardar el path completo en la llave
+            models.Index(OpClass(Substr('path', 1, PATH_INDEX_LENGTH), name='text_pattern_ops'),
+                         name='menu_path_prefix_idx'),
+        ]
+        constraints = [
+            # Se verifica al commit para que los reordenamientos por rango no choquen a mitad del UPDATE
+            models.UniqueConstraint(fields=['module', 'parent', 'position'], name='unique_sibling_position',
+                                    deferrable=models.Deferrable.DEFERRED),
+        ]
+
+    def path_children(self):
+        return f'{self.path}{self.pk}/'
+
+    def ancestor_ids(self):
+        return [int(pk) for pk in self.path.split('/') if pk]
+
+    def set_path(self):
+        if self.parent_id is None:
+            self.path, self.depth = '', 0
+        else:
+            self.path, self.depth = self.parent.path_children(), self.parent.depth + 1
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.parent_id is not None and not self.path:
+            self.set_path()
+        if self._state.adding and not self.position:
+            self.position = self.order * OrderingMode.GAP_SIZE
+        super().save(*args, **kwargs)
+
+
+class SiblingCounter(models.Model):
+    # Ultimo orden asignado a los hijos de un padre; parent_key es 0 en la raiz
+    module = models.ForeignKey(Module, on_delete=models.CASCADE, related_name='+')
+    parent_key = models.PositiveIntegerField(default=0)
+    last_order = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['module', 'parent_key'], name='unique_sibling_counter'),
+        ]
@@ -2,8 +2,9 @@
 
 from abc import ABC, abstractmethod
 
-from django.db import models
+from django.db import models, transaction
 
+from menus import metrics, tree_cache
 from menus.consts import ErrorMessage
 from menus.models.custom_fields import CharFieldTrim
 from menus.models.custom_managers import GenericManager
@@ -35,28 +36,49 @@ class ModuleManager(GenericOperationsABC, GenericManager):
     def get_all(self):
         return self.model.objects.all()
 
+    def get_module_ids(self):
+        return list(self.order_by('id').values_list('id', flat=True))
+
+    @metrics.observe_write('module', 'create')
     def execute_create(self, name):
         module = self.model(name=name)
         module.full_clean()
         module.save()
+        tree_cache.invalidate_modules(module.pk, tree_cache.CATALOG)
+        return module
+
+    @metrics.observe_write('module', 'clone')
+    def execute_clone(self, pk, name):
+        # menus.py importa este modulo; Menu se importa al usarse
+        from menus.models.menus import Menu
+
+        source = self.find_by_pk(pk)
+        with transaction.atomic():
+            module = self.execute_create(name)
+            Menu.objects.copy_module_menus(source, module)
         return module
 
     def execute_retrieve(self, *args, **kwargs):
         pass
 
+    @metrics.observe_write('module', 'update')
     def execute_update(self, pk, name):
         module = self.find_by_pk(pk)
         module.name = name
         module.full_clean()
         module.save(update_fields=['name'])
+        tree_cache.invalidate_modules(module.pk)
         return module
 
     def execute_partial_update(self, pk, order):
         pass
 
+    @metrics.observe_write('module', 'delete')
     def execute_delete(self, pk):
         module = self.find_by_pk(pk)
+        module_id = module.pk
         module.delete()
+        tree_cache.invalidate_modules(module_id, tree_cache.CATALOG)
 
 
 class Module(models.Model):
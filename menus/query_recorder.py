@@ -0,0 +1,65 @@
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.db import connections
+
+# El control de transacciones no cuenta como consulta de la vista
+IGNORED_SQL = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+class QueryRecorder:
+    """
+    Record the SQL run on every database connection of the current thread
+    while the context is active, with the time spent on each statement.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.stack = None
+
+    def __enter__(self):
+        self.stack = ExitStack()
+        for alias in connections:
+            self.stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stack.close()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if not sql.startswith(IGNORED_SQL):
+                self.queries.append((sql, time.perf_counter() - start))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for sql, duration in self.queries)
+
+    @property
+    def duplicates(self):
+        # La misma sentencia con otros parametros suele ser un N+1
+        counts = Counter(sql for sql, duration in self.queries)
+        return {sql: count for sql, count in counts.items() if count > 1}
+
+
+def resolve_action(view_func, method):
+    """
+    Return (viewset class, action) of a resolved DRF viewset view, or (None, None).
+    """
+    view_class = getattr(view_func, 'cls', None)
+    action = (getattr(view_func, 'actions', None) or {}).get(method.lower())
+    if view_class is None or action is None:
+        return None, None
+    return view_class, action
+
+
+def get_query_budget(view_class, action):
+    return getattr(view_class, 'query_budgets', {}).get(action)
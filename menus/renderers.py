@@ -0,0 +1,9 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class FlatTreeRenderer(JSONRenderer):
+    """
+    JSON chosen with ?format=flat; the menu list answers column arrays
+    instead of nested sub_menu lists.
+    """
+    format = 'flat'
@@ -1,6 +1,11 @@
+import base64
+import binascii
+import json
+
 from django.db import models
 from rest_framework import serializers
 
+from menus.consts import ExportLayout, TreeFields
 from menus.models import Menu, Module
 
 
@@ -16,6 +21,37 @@ class MenuSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'module', 'parent', 'order',)
         extra_kwargs = {"module": {"required": False, "allow_null": True}}
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # En modo gap la columna order no es 1..n; se responde el lugar que muestra el arbol
+        if Menu.objects.gap_ordering():
+            data['order'] = Menu.objects.dense_order(instance)
+        return data
+
+
+def tree_menus_to_data(tree_menus):
+    # Convierte los TreeMenu a diccionarios en una sola pasada iterativa,
+    # sin crear un serializer por nodo
+    if tree_menus is None:
+        return None
+
+    data = []
+    pending = [(data, tree_menus)]
+    while pending:
+        items, nodes = pending.pop()
+        for node in nodes:
+            sub_menu = None if node.sub_menu is None else []
+            items.append({'pk': node.pk,
+                          'name': node.name,
+                          'module': node.module,
+                          'order': node.order,
+                          'parent': node.parent,
+                          'deep': node.deep,
+                          'sub_menu': sub_menu})
+            if sub_menu is not None:
+                pending.append((sub_menu, node.sub_menu))
+    return data
+
 
 class ItemTreeSerializer(serializers.Serializer):
     pk = serializers.IntegerField()
@@ -27,12 +63,82 @@ class ItemTreeSerializer(serializers.Serializer):
     sub_menu = serializers.SerializerMethodField()
 
     def get_sub_menu(self, obj):
-        if obj.sub_menu is not None:
-            return ItemTreeSerializer(obj.sub_menu, many=True).data
-        else:
-            return None
+        return tree_menus_to_data(obj.sub_menu)
+
+    def to_representation(self, instance):
+        return tree_menus_to_data([instance])[0]
 
 
 class MenuTreeSerializer(serializers.Serializer):
     module = serializers.IntegerField()
     menus = ItemTreeSerializer(many=True)
+
+    def to_representation(self, instance):
+        return {'module': instance.module, 'menus': tree_menus_to_data(instance.menus)}
+
+
+class MenuListQuerySerializer(serializers.Serializer):
+    module__id = serializers.IntegerField(required=False, min_value=1, max_value=2147483647)
+
+
+class TreeQuerySerializer(serializers.Serializer):
+    # Limite de la columna depth; un valor mayor llegaria a PostgreSQL fuera de rango
+    max_depth = serializers.IntegerField(required=False, min_value=0, max_value=32767)
+    fields = serializers.CharField(required=False)
+
+    def validate_fields(self, value):
+        fields = {field.strip() for field in value.split(',') if field.strip()}
+        unknown = fields - TreeFields.COLUMNS.keys()
+        if unknown or not fields:
+            raise serializers.ValidationError(
+                f'Choose a comma separated list of {", ".join(TreeFields.COLUMNS)}.')
+        # Siempre en el orden de la respuesta completa
+        return tuple(field for field in TreeFields.COLUMNS if field in fields)
+
+
+class ReorderSerializer(serializers.Serializer):
+    module = serializers.IntegerField(min_value=1)
+    parent = serializers.IntegerField(min_value=1, allow_null=True, default=None)
+    menus = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+
+class MoveSerializer(serializers.Serializer):
+    parent = serializers.IntegerField(min_value=1, allow_null=True, default=None)
+    position = serializers.IntegerField(min_value=1, required=False, allow_null=True, default=None)
+
+
+class DestroyQuerySerializer(serializers.Serializer):
+    cascade = serializers.BooleanField(default=False)
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+class ChildrenQuerySerializer(serializers.Serializer):
+    cursor = serializers.CharField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+    def validate_cursor(self, value):
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(value.encode()))
+        except (binascii.Error, ValueError):
+            raise serializers.ValidationError('Invalid cursor.')
+        if not (isinstance(cursor, list) and len(cursor) == 3 and all(type(item) is int for item in cursor)):
+            raise serializers.ValidationError('Invalid cursor.')
+        return tuple(cursor)
+
+
+class ChildMenuSerializer(serializers.Serializer):
+    pk = serializers.IntegerField()
+    name = serializers.CharField()
+    module = serializers.IntegerField(source='module_id')
+    order = serializers.IntegerField()
+    parent = serializers.IntegerField(source='parent_id')
+    deep = serializers.IntegerField(source='depth')
+    has_children = serializers.BooleanField()
+
+
+class ExportQuerySerializer(serializers.Serializer):
+    layout = serializers.ChoiceField(choices=[ExportLayout.NESTED, ExportLayout.NDJSON], default=ExportLayout.NESTED)
+    module__id = serializers.IntegerField(required=False, min_value=1, max_value=2147483647)
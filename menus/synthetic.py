@@ -0,0 +1,113 @@
+from dataclasses import dataclass
+from io import StringIO
+from math import ceil
+
+from django.db import connection
+
+from menus import tree_cache
+from menus.consts import OrderingMode
+from menus.models import Menu, Module
+
+BATCH_SIZE = 50000
+MENU_COLUMNS = ('id', 'name', 'module_id', 'parent_id', 'order', 'position', 'path', 'depth')
+
+
+@dataclass
+class TreeShape:
+    roots: int
+    fan_out: int
+    max_depth: int
+
+
+def tree_shape(shape, num_nodes):
+    # wide: pocos padres con muchos hijos, deep: cadenas de 100 niveles, balanced: 10 hijos por nodo
+    if shape == 'wide':
+        return TreeShape(roots=min(10, num_nodes), fan_out=max(ceil((num_nodes - 10) / 10), 1), max_depth=2)
+    if shape == 'deep':
+        return TreeShape(roots=ceil(num_nodes / 100), fan_out=1, max_depth=100)
+    if shape == 'balanced':
+        return TreeShape(roots=min(10, num_nodes), fan_out=10, max_depth=num_nodes)
+    raise ValueError(f'Unknown tree shape {shape!r}')
+
+
+def create_module_tree(name, shape, num_nodes, batch_size=BATCH_SIZE):
+    """
+    Create a module with num_nodes menus laid out as the given shape.
+    """
+    tree = tree_shape(shape, num_nodes)
+    module = Module.objects.create(name=name)
+    generate_menu_tree(module.pk, num_nodes, tree, batch_size=batch_size)
+    return module
+
+
+def generate_modules(names, num_nodes, tree, rng=None, batch_size=BATCH_SIZE):
+    """
+    Create one module per name, each one with a tree of num_nodes menus.
+    Returns {module_id: menus created}.
+    """
+    modules = Module.objects.bulk_create([Module(name=name) for name in names])
+    created = {module.pk: generate_menu_tree(module.pk, num_nodes, tree, rng, batch_size) for module in modules}
+    tree_cache.invalidate_modules(*created, tree_cache.CATALOG)
+    return created
+
+
+def generate_menu_tree(module_id, num_nodes, tree, rng=None, batch_size=BATCH_SIZE):
+    """
+    Insert up to num_nodes menus in module_id level by level, with dense
+    orders, path and depth already set. Without rng every parent gets exactly
+    tree.fan_out children; with it the fan-out varies around tree.fan_out.
+    Only the previous level is kept in memory. Returns the menus created.
+    """
+    remaining = num_nodes
+    # (id, path, depth) de los padres del nivel anterior; None para la raiz
+    parents = [(None, '', -1)]
+    while parents and remaining:
+        level = []
+        for parent_id, parent_path, parent_depth in parents:
+            if parent_id is None:
+                count, path = tree.roots, ''
+            else:
+                count = tree.fan_out
+                if rng:
+                    count = rng.randint(max(tree.fan_out // 2, 1), tree.fan_out + tree.fan_out // 2)
+                path = f'{parent_path}{parent_id}/'
+            count = min(count, remaining)
+            remaining -= count
+            level.extend((parent_id, path, parent_depth + 1, order) for order in range(1, count + 1))
+            if not remaining:
+                break
+
+        ids = reserve_menu_ids(len(level))
+        for start in range(0, len(level), batch_size):
+            copy_menus(module_id, ids[start:start + batch_size], level[start:start + batch_size])
+        parents = [(menu_id, path, depth) for menu_id, (_, path, depth, _) in zip(ids, level)
+                   if depth + 1 < tree.max_depth]
+    return num_nodes - remaining
+
+
+def reserve_menu_ids(count):
+    # Cada id sale de su propio nextval, como en cualquier INSERT: los ids pueden no ser
+    # contiguos si otra transaccion usa la secuencia al mismo tiempo, pero nunca se repiten
+    if not count:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%(table)s, 'id')) FROM generate_series(1, %(count)s)",
+                       {'table': Menu._meta.db_table, 'count': count})
+        return [menu_id for menu_id, in cursor.fetchall()]
+
+
+def copy_menus(module_id, ids, level):
+    # COPY evita construir instancias del modelo y el RETURNING de bulk_create
+    gap = OrderingMode.GAP_SIZE
+    null = '\\N'
+    buffer = StringIO()
+    buffer.writelines(
+        f'{menu_id}\tMenu {order}\t{module_id}\t{null if parent_id is None else parent_id}'
+        f'\t{order}\t{order * gap}\t{path}\t{depth}\n'
+        for menu_id, (parent_id, path, depth, order) in zip(ids, level))
+    buffer.seek(0)
+    columns = ', '.join(connection.ops.quote_name(column) for column in MENU_COLUMNS)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {connection.ops.quote_name(Menu._meta.db_table)} ({columns}) FROM STDIN",
+            buffer)
@@ -0,0 +1,29 @@
+from contextlib import contextmanager
+
+from menus.query_recorder import QueryRecorder, get_query_budget
+
+VIEWSET_ACTIONS = ('list', 'create', 'retrieve', 'update', 'partial_update', 'destroy')
+
+
+class QueryBudgetTestMixin:
+    def assertViewSetHasBudgets(self, view_class):
+        actions = [action for action in VIEWSET_ACTIONS if hasattr(view_class, action)]
+        actions += [extra_action.__name__ for extra_action in view_class.get_extra_actions()]
+        missing = [action for action in actions if get_query_budget(view_class, action) is None]
+        self.assertEqual(missing, [], f'{view_class.__name__} actions without query budget')
+
+    @contextmanager
+    def assertQueryBudget(self, view_class, action, allow_duplicates=False):
+        budget = get_query_budget(view_class, action)
+        self.assertIsNotNone(budget, f'{view_class.__name__}.{action} has no query budget')
+
+        with QueryRecorder() as recorder:
+            yield recorder
+
+        queries = '\n'.join(f'{index}. {sql}' for index, (sql, duration) in enumerate(recorder.queries, start=1))
+        self.assertLessEqual(
+            recorder.count, budget,
+            f'{view_class.__name__}.{action} ran {recorder.count} queries, budget is {budget}:\n{queries}')
+        if not allow_duplicates:
+            self.assertEqual(recorder.duplicates, {},
+                             f'{view_class.__name__}.{action} repeated statements:\n{queries}')
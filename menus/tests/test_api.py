@@ -1,15 +1,25 @@
+import contextlib
+import gzip
 import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 from operator import itemgetter, mod
 # Django
 from re import I
-from socket import IP_RECVDSTADDR
 from urllib import response
 
 import mock
 import pytest
+from django.conf import settings
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework import status
+from prometheus_client import REGISTRY
+from rest_framework import serializers, status
 from rest_framework.exceptions import ErrorDetail
 from rest_framework.test import (
     APIClient,
@@ -18,9 +28,15 @@ from rest_framework.test import (
     URLPatternsTestCase,
 )
 
+from menus import exports, metrics, tree_cache
+from menus.consts import ErrorMessage, OrderingMode
 from menus.models import Menu, Module
-from menus.serializers import MenuSerializer
+from menus.models.menus import TreeMenu, TreeModule
+from menus.serializers import MenuSerializer, MenuTreeSerializer, encode_cursor
 from menus.tests.factories import MenuFactory, ModuleFactory
+from menus.tests.query_budget import QueryBudgetTestMixin
+from menus.timing import NULL_TIMER
+from menus.views import MenuViewSetApi, ModuleViewSetApi
 
 URL_MODULES = '/api/modules/'
 URL_MENU = '/api/menus/'
@@ -160,6 +176,44 @@ class ParametroModuleAPITest(APITestCase):
         self.assertEqual(resp_get.status_code, 200)
         self.assertEqual(resp_get.data, {'id': module1.pk, 'name': 'Module 1'})
 
+    def test_list_modules_not_modified(self):
+        ModuleFactory.create_batch(2)
+        resp_first = self.client.get(self.base_url_list)
+
+        resp_etag = self.client.get(self.base_url_list, HTTP_IF_NONE_MATCH=resp_first['ETag'])
+        resp_since = self.client.get(self.base_url_list, HTTP_IF_MODIFIED_SINCE=resp_first['Last-Modified'])
+
+        self.assertEqual(resp_first.status_code, 200)
+        self.assertEqual(resp_etag.status_code, 304)
+        self.assertEqual(resp_since.status_code, 304)
+        self.assertEqual(resp_etag.content, b'')
+
+    def test_list_modules_modified_after_create(self):
+        Module.objects.create(name='Module 1')
+        resp_first = self.client.get(self.base_url_list)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Module.objects.execute_create(name='Module 9')
+        resp_second = self.client.get(self.base_url_list, HTTP_IF_NONE_MATCH=resp_first['ETag'])
+
+        self.assertEqual(resp_second.status_code, 200)
+        self.assertEqual(len(resp_second.data), 2)
+        self.assertNotEqual(resp_second['ETag'], resp_first['ETag'])
+
+    def test_get_module_by_id_not_modified(self):
+        module1 = ModuleFactory()
+        base_url = self.base_url_detail(pk=module1.pk)
+        resp_first = self.client.get(base_url)
+
+        resp_etag = self.client.get(base_url, HTTP_IF_NONE_MATCH=resp_first['ETag'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Module.objects.execute_update(module1.pk, 'Module 9')
+        resp_changed = self.client.get(base_url, HTTP_IF_NONE_MATCH=resp_first['ETag'])
+
+        self.assertEqual(resp_etag.status_code, 304)
+        self.assertEqual(resp_changed.status_code, 200)
+        self.assertEqual(resp_changed.data['name'], 'Module 9')
+
     def test_get_module_by_id_not_exist(self):
         base_url = self.base_url_detail(pk=9999)
         resp_get = self.client.get(base_url)
@@ -293,10 +347,143 @@ class ParametroMenuAPITest(APITestCase):
 
         url_filter = f"{self.base_url_list}?module__id={module1.pk}"
 
-        with self.assertNumQueries(3):
+        # Sin version en el cache se confirma que el modulo existe
+        with self.assertNumQueries(4):
             resp_tree_menu = self.client.get(url_filter, format='json')
             self.assertEqual(resp_tree_menu.status_code, 200)
-            self.assertEqual(len(resp_tree_menu.data), 1)
+            self.assertEqual(len(json.loads(resp_tree_menu.content)), 1)
+
+    def test_list_filter_invalid_or_unknown_module(self):
+        ModuleFactory()
+
+        for module_id in ('1.5', '0', 'x', '99999999999'):
+            self.assertEqual(self.client.get(self.base_url_list, {'module__id': module_id}).status_code, 400)
+        resp = self.client.get(self.base_url_list, {'module__id': 999999})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), [])
+        self.assertFalse(tree_cache.has_module_version(999999))
+
+    def test_list_tree_cached_by_module(self):
+        module1 = ModuleFactory()
+        module2 = ModuleFactory()
+        MenuFactory(module=module1, order=1)
+        MenuFactory(module=module2, order=1)
+
+        url_filter = f"{self.base_url_list}?module__id={module1.pk}"
+        resp_first = self.client.get(url_filter)
+
+        with self.assertNumQueries(2):
+            resp_cached = self.client.get(url_filter)
+        resp_all = self.client.get(self.base_url_list)
+
+        self.assertEqual(resp_cached.status_code, 200)
+        self.assertEqual(json.loads(resp_cached.content), json.loads(resp_first.content))
+        self.assertEqual(json.loads(resp_all.content)[0], json.loads(resp_first.content)[0])
+        self.assertEqual(len(json.loads(resp_all.content)), 2)
+
+    def test_get_subtree_menu(self):
+        module1 = ModuleFactory()
+        menu1 = MenuFactory(module=module1, order=1)
+        menu1_1 = MenuFactory(parent=menu1, order=1)
+        menu1_1_1 = MenuFactory(parent=menu1_1, order=1)
+
+        url_tree = reverse('menus:menu-tree', kwargs={'pk': menu1_1.pk})
+        resp_tree = self.client.get(url_tree)
+        resp_depth = self.client.get(url_tree, {'max_depth': 0})
+
+        self.assertEqual(url_tree, f'{URL_MENU}{menu1_1.pk}/tree/')
+        self.assertEqual(resp_tree.status_code, 200)
+        self.assertEqual(json.loads(resp_tree.content), {
+            'pk': menu1_1.pk, 'name': menu1_1.name, 'module': module1.pk, 'order': 1,
+            'parent': menu1.pk, 'deep': 1, 'sub_menu': [
+                {'pk': menu1_1_1.pk, 'name': menu1_1_1.name, 'module': module1.pk, 'order': 1,
+                 'parent': menu1_1.pk, 'deep': 2, 'sub_menu': []}]})
+        self.assertEqual(resp_depth.data['sub_menu'], [])
+
+    def test_get_subtree_menu_not_exist(self):
+        resp_tree = self.client.get(reverse('menus:menu-tree', kwargs={'pk': 9999}))
+        resp_depth = self.client.get(reverse('menus:menu-tree', kwargs={'pk': 9999}), {'max_depth': -1})
+
+        self.assertEqual(resp_tree.status_code, 404)
+        self.assertEqual(resp_tree.data, {'message': 'The menu with the pk = 9999 doesnt exist'})
+        self.assertEqual(resp_depth.status_code, 400)
+
+    def test_get_subtree_max_depth_out_of_range(self):
+        menu1 = MenuFactory()
+        url_tree = reverse('menus:menu-tree', kwargs={'pk': menu1.pk})
+
+        self.assertEqual(self.client.get(url_tree, {'max_depth': 32767}).status_code, 200)
+        self.assertEqual(self.client.get(url_tree, {'max_depth': 99999999999}).status_code, 400)
+
+    def test_list_tree_pre_rendered(self):
+        module1 = ModuleFactory()
+        MenuFactory(module=module1, order=1)
+        url_filter = f"{self.base_url_list}?module__id={module1.pk}"
+
+        resp_first = self.client.get(url_filter)
+        with mock.patch.object(MenuViewSetApi, 'get_serializer') as mock_serializer:
+            resp_cached = self.client.get(url_filter)
+
+        mock_serializer.assert_not_called()
+        self.assertEqual(resp_cached.status_code, 200)
+        self.assertEqual(resp_cached.content, resp_first.content)
+        self.assertEqual(resp_cached['Content-Type'], 'application/json')
+        self.assertEqual(int(resp_cached['Content-Length']), len(resp_cached.content))
+        self.assertEqual(resp_cached['ETag'], resp_first['ETag'])
+        self.assertRegex(resp_cached['ETag'], r'^"[0-9a-f]{40}"$')
+
+    def test_list_tree_pre_rendered_change_after_commit(self):
+        module1 = ModuleFactory()
+        with self.captureOnCommitCallbacks(execute=True):
+            menu1 = Menu.objects.execute_create(name='Menu 1', module=module1)
+        resp_first = self.client.get(self.base_url_list)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Menu.objects.execute_update(menu1.pk, 'Menu 10')
+        resp_second = self.client.get(self.base_url_list)
+
+        self.assertNotEqual(resp_second['ETag'], resp_first['ETag'])
+        self.assertEqual(json.loads(resp_second.content)[0]['menus'][0]['name'], 'Menu 10')
+
+    def test_list_tree_not_modified(self):
+        module1 = ModuleFactory()
+        menu1 = MenuFactory(module=module1, order=1)
+        url_filter = f"{self.base_url_list}?module__id={module1.pk}"
+        resp_first = self.client.get(url_filter)
+
+        with self.assertNumQueries(2):
+            resp_etag = self.client.get(url_filter, HTTP_IF_NONE_MATCH=resp_first['ETag'])
+        resp_all = self.client.get(self.base_url_list, HTTP_IF_NONE_MATCH=resp_first['ETag'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Menu.objects.execute_update(menu1.pk, 'Menu 10')
+        resp_changed = self.client.get(url_filter, HTTP_IF_NONE_MATCH=resp_first['ETag'])
+
+        self.assertEqual(resp_etag.status_code, 304)
+        self.assertEqual(resp_all.status_code, 200)
+        self.assertEqual(resp_changed.status_code, 200)
+        self.assertIn('Last-Modified', resp_changed)
+
+    def test_get_menu_not_modified(self):
+        module1 = ModuleFactory()
+        with self.captureOnCommitCallbacks(execute=True):
+            menu1 = Menu.objects.execute_create(name='Menu 1', module=module1)
+        base_url = self.base_url_detail(pk=menu1.pk)
+        resp_first = self.client.get(base_url)
+
+        resp_etag = self.client.get(base_url, HTTP_IF_NONE_MATCH=resp_first['ETag'])
+
+        self.assertEqual(resp_first.status_code, 200)
+        self.assertEqual(resp_etag.status_code, 304)
+
+    def test_list_tree_browsable_api(self):
+        module1 = ModuleFactory()
+        MenuFactory(module=module1, order=1)
+
+        resp_html = self.client.get(self.base_url_list, HTTP_ACCEPT='text/html')
+
+        self.assertEqual(resp_html.status_code, 200)
+        self.assertIn('Menu 1', resp_html.content.decode())
 
     def test_post_menu(self):
         ModuleFactory()
@@ -485,3 +672,1012 @@ class ParametroMenuAPITest(APITestCase):
         self.assertEqual(resp_tree_menu.status_code, 200)
         self.assertEqual(resp_tree_menu.data, {
                          'id': menu1_1.pk, 'name': 'Menu 1.1', 'module': module1.pk, 'parent': menu1.pk, 'order': 1})
+
+
+class QueryBudgetAPITest(QueryBudgetTestMixin, APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        self.menu1 = MenuFactory(module=self.module1, order=1)
+        self.menu2 = MenuFactory(module=self.module1, order=2)
+        self.children = [MenuFactory(module=self.module1, parent=self.menu1, order=order) for order in range(1, 4)]
+
+    def test_viewsets_declare_budgets(self):
+        self.assertViewSetHasBudgets(ModuleViewSetApi)
+        self.assertViewSetHasBudgets(MenuViewSetApi)
+
+    def test_module_actions_within_budget(self):
+        module2 = ModuleFactory()
+        with self.assertQueryBudget(ModuleViewSetApi, 'list'):
+            self.assertEqual(self.client.get(URL_MODULES).status_code, 200)
+        with self.assertQueryBudget(ModuleViewSetApi, 'retrieve'):
+            self.assertEqual(self.client.get(f'{URL_MODULES}{module2.pk}/').status_code, 200)
+        # El serializer y full_clean validan el nombre unico con la misma consulta
+        with self.assertQueryBudget(ModuleViewSetApi, 'create', allow_duplicates=True):
+            self.assertEqual(self.client.post(URL_MODULES, {'name': 'Module 9'}).status_code, 201)
+        with self.assertQueryBudget(ModuleViewSetApi, 'update'):
+            self.assertEqual(self.client.put(f'{URL_MODULES}{module2.pk}/', {'name': 'Module 8'}).status_code, 200)
+        with self.assertQueryBudget(ModuleViewSetApi, 'destroy'):
+            self.assertEqual(self.client.delete(f'{URL_MODULES}{module2.pk}/').status_code, 204)
+
+    def test_module_clone_within_budget(self):
+        # El serializer y full_clean validan el nombre unico con la misma consulta
+        with self.assertQueryBudget(ModuleViewSetApi, 'clone', allow_duplicates=True):
+            resp = self.client.post(f'{URL_MODULES}{self.module1.pk}/clone/', {'name': 'Module 9'})
+        self.assertEqual(resp.status_code, 201)
+
+    def test_menu_reads_within_budget(self):
+        with self.assertQueryBudget(MenuViewSetApi, 'list'):
+            self.assertEqual(self.client.get(URL_MENU).status_code, 200)
+        with self.assertQueryBudget(MenuViewSetApi, 'retrieve'):
+            self.assertEqual(self.client.get(f'{URL_MENU}{self.children[0].pk}/').status_code, 200)
+        with self.assertQueryBudget(MenuViewSetApi, 'tree'):
+            self.assertEqual(self.client.get(f'{URL_MENU}{self.menu1.pk}/tree/').status_code, 200)
+        with self.assertQueryBudget(MenuViewSetApi, 'list'):
+            self.assertEqual(self.client.get(URL_MENU, {'format': 'flat'}).status_code, 200)
+
+    def test_menu_export_within_budget(self):
+        # Las consultas del export corren mientras se consume la respuesta
+        for layout in ('nested', 'ndjson'):
+            with self.assertQueryBudget(MenuViewSetApi, 'export'):
+                resp = self.client.get(f'{URL_MENU}export/', {'layout': layout})
+                self.assertEqual(resp.status_code, 200)
+                b''.join(resp.streaming_content)
+
+    def test_children_within_budget(self):
+        with self.assertQueryBudget(MenuViewSetApi, 'children'):
+            self.assertEqual(self.client.get(f'{URL_MENU}{self.menu1.pk}/children/').status_code, 200)
+        with self.assertQueryBudget(ModuleViewSetApi, 'children'):
+            self.assertEqual(self.client.get(f'{URL_MODULES}{self.module1.pk}/children/').status_code, 200)
+
+    def test_menu_writes_within_budget(self):
+        for _ in range(2):
+            with self.assertQueryBudget(MenuViewSetApi, 'create'):
+                resp = self.client.post(URL_MENU, {'name': 'Menu 1.4', 'module': self.module1.pk,
+                                                   'parent': self.menu1.pk})
+            self.assertEqual(resp.status_code, 201)
+        with self.assertQueryBudget(MenuViewSetApi, 'update'):
+            resp = self.client.put(f'{URL_MENU}{self.children[1].pk}/', {'name': 'Menu 1.2'})
+        self.assertEqual(resp.status_code, 200)
+        with self.assertQueryBudget(MenuViewSetApi, 'partial_update'):
+            self.assertEqual(self.client.patch(f'{URL_MENU}{self.children[2].pk}/', {'order': 1}).status_code, 200)
+        with self.assertQueryBudget(MenuViewSetApi, 'destroy'):
+            self.assertEqual(self.client.delete(f'{URL_MENU}{self.children[2].pk}/').status_code, 204)
+
+    def test_menu_import_within_budget(self):
+        menus = [{'name': 'Menu 3', 'sub_menu': [{'name': 'Menu 3.1', 'sub_menu': [{'name': 'Menu 3.1.1'}]}]}]
+        # Cada nivel se inserta con la misma sentencia
+        with self.assertQueryBudget(MenuViewSetApi, 'import_tree', allow_duplicates=True):
+            resp = self.client.post(f'{URL_MENU}import/', {'module': self.module1.pk, 'menus': menus}, format='json')
+        self.assertEqual(resp.status_code, 201)
+
+    def test_menu_reorder_within_budget(self):
+        new_order = [child.pk for child in reversed(self.children)]
+        with self.assertQueryBudget(MenuViewSetApi, 'reorder'):
+            resp = self.client.put(f'{URL_MENU}reorder/', {'module': self.module1.pk, 'parent': self.menu1.pk,
+                                                           'menus': new_order}, format='json')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_menu_move_parent_within_budget(self):
+        with self.assertQueryBudget(MenuViewSetApi, 'move'):
+            resp = self.client.post(f'{URL_MENU}{self.menu1.pk}/move/', {'parent': self.menu2.pk, 'position': 1},
+                                    format='json')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_menu_cascade_destroy_within_budget(self):
+        with self.assertQueryBudget(MenuViewSetApi, 'destroy'):
+            self.assertEqual(self.client.delete(f'{URL_MENU}{self.menu1.pk}/?cascade=true').status_code, 200)
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_menu_move_gap_ordering_within_budget(self):
+        for new_order in (1, 3, 2):
+            with self.assertQueryBudget(MenuViewSetApi, 'partial_update'):
+                resp = self.client.patch(f'{URL_MENU}{self.children[0].pk}/', {'order': new_order})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_repeated_statements_fail(self):
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(MenuViewSetApi, 'tree'):
+                for child in self.children:
+                    Menu.objects.get(pk=child.pk)
+
+    def test_over_budget_fails(self):
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(MenuViewSetApi, 'retrieve', allow_duplicates=True):
+                Menu.objects.get(pk=self.menu1.pk)
+                Menu.objects.get(pk=self.menu2.pk)
+
+    @override_settings(MENUS_QUERY_RECORDER=True)
+    def test_middleware_logs_report(self):
+        with self.assertLogs('menus.middleware', 'DEBUG') as logs:
+            self.client.get(f'{URL_MENU}{self.menu1.pk}/')
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].levelname, 'DEBUG')
+        self.assertIn('MenuViewSetApi.retrieve: 1 queries (budget 1)', logs.output[0])
+
+    @override_settings(MENUS_QUERY_RECORDER=True)
+    def test_middleware_warns_over_budget(self):
+        with mock.patch.dict(MenuViewSetApi.query_budgets, {'retrieve': 0}):
+            with self.assertLogs('menus.middleware', 'WARNING') as logs:
+                self.client.get(f'{URL_MENU}{self.menu1.pk}/')
+        self.assertIn('MenuViewSetApi.retrieve: 1 queries (budget 0)', logs.output[0])
+
+
+TIMING_HOOK_CALLS = []
+
+
+def record_timing(view, request, resp, phases):
+    TIMING_HOOK_CALLS.append((view.action, resp.status_code, phases))
+
+
+class ServerTimingAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        self.menu1 = MenuFactory(module=self.module1, order=1)
+        MenuFactory(module=self.module1, parent=self.menu1, order=1)
+        TIMING_HOOK_CALLS.clear()
+
+    def timing_phases(self, resp):
+        return [entry.split(';dur=')[0] for entry in resp['Server-Timing'].split(', ')]
+
+    def test_server_timing_off(self):
+        resp = self.client.get(URL_MENU)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(resp.has_header('Server-Timing'))
+        self.assertIs(NULL_TIMER.phase('queryset'), NULL_TIMER.phase('serialize'))
+
+    @override_settings(MENUS_SERVER_TIMING=True)
+    def test_server_timing_list(self):
+        resp = self.client.get(URL_MENU)
+        self.assertEqual(self.timing_phases(resp), ['queryset', 'perform_list', 'serialize', 'render', 'total'])
+        for entry in resp['Server-Timing'].split(', '):
+            self.assertRegex(entry, r'^[a-z_]+;dur=[0-9]+\.[0-9]{2}$')
+
+        # Con el contenido en cache no se construye ni se renderiza
+        resp = self.client.get(URL_MENU)
+        self.assertEqual(self.timing_phases(resp), ['queryset', 'total'])
+
+    @override_settings(MENUS_SERVER_TIMING=True)
+    def test_server_timing_retrieve_render(self):
+        resp = self.client.get(f'{URL_MENU}{self.menu1.pk}/')
+        self.assertEqual(self.timing_phases(resp), ['queryset', 'serialize', 'render', 'total'])
+        self.assertEqual(json.loads(resp.content)['name'], 'Menu 1')
+
+        resp = self.client.get(f'{URL_MENU}{self.menu1.pk}/tree/')
+        self.assertEqual(self.timing_phases(resp), ['queryset', 'serialize', 'render', 'total'])
+
+        resp = self.client.post(URL_MENU, {'name': 'Menu 2', 'module': self.module1.pk})
+        self.assertEqual(self.timing_phases(resp), ['validate', 'perform', 'serialize', 'render', 'total'])
+
+    @override_settings(MENUS_TIMING_HOOK='menus.tests.test_api.record_timing')
+    def test_timing_hook(self):
+        resp = self.client.get(f'{URL_MENU}{self.menu1.pk}/')
+        self.assertFalse(resp.has_header('Server-Timing'))
+
+        (action, status_code, phases), = TIMING_HOOK_CALLS
+        self.assertEqual((action, status_code), ('retrieve', 200))
+        self.assertEqual(list(phases), ['queryset', 'serialize', 'render', 'total'])
+        self.assertGreaterEqual(phases['total'], phases['queryset'] + phases['serialize'])
+
+
+class MetricsAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        self.menus = [MenuFactory(module=self.module1, order=order) for order in range(1, 4)]
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    @override_settings(MENUS_METRICS_TOKEN='secret')
+    def test_metrics_endpoint(self):
+        self.client.post(URL_MENU, {'name': 'Menu 4', 'module': self.module1.pk})
+
+        resp = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'menus_write_seconds_count{model="menu",operation="create"}', resp.content)
+
+    def test_metrics_endpoint_disabled_without_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with override_settings(MENUS_METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+    @override_settings(MENUS_METRICS_TOKEN='secret')
+    def test_metrics_endpoint_requires_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        resp = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer other')
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp['WWW-Authenticate'], 'Bearer')
+
+    def test_write_and_reorder_metrics(self):
+        creates = self.sample('menus_write_seconds_count', model='menu', operation='create')
+        reorders = self.sample('menus_reorder_rows_count', mode='dense')
+        reordered_rows = self.sample('menus_reorder_rows_sum', mode='dense')
+
+        self.client.post(URL_MENU, {'name': 'Menu 4', 'module': self.module1.pk})
+        self.client.patch(f'{URL_MENU}{self.menus[2].pk}/', {'order': 1})
+
+        self.assertEqual(self.sample('menus_write_seconds_count', model='menu', operation='create'), creates + 1)
+        self.assertEqual(self.sample('menus_reorder_rows_count', mode='dense'), reorders + 1)
+        self.assertEqual(self.sample('menus_reorder_rows_sum', mode='dense'), reordered_rows + 3)
+
+    def test_cache_metrics(self):
+        misses = self.sample('menus_cache_requests_total', kind='list', result='miss')
+        hits = self.sample('menus_cache_requests_total', kind='list', result='hit')
+        builds = self.sample('menus_tree_builds_total', kind='tree')
+
+        self.client.get(URL_MENU)
+        self.client.get(URL_MENU)
+
+        self.assertEqual(self.sample('menus_cache_requests_total', kind='list', result='miss'), misses + 1)
+        self.assertEqual(self.sample('menus_cache_requests_total', kind='list', result='hit'), hits + 1)
+        self.assertEqual(self.sample('menus_tree_builds_total', kind='tree'), builds + 1)
+
+    @override_settings(MENUS_TIMING_HOOK='menus.metrics.observe_view_timing')
+    def test_request_phase_metrics(self):
+        labels = {'view': 'MenuViewSetApi', 'action': 'retrieve'}
+        totals = self.sample('menus_request_phase_seconds_count', phase='total', **labels)
+
+        self.client.get(f'{URL_MENU}{self.menus[0].pk}/')
+
+        self.assertEqual(self.sample('menus_request_phase_seconds_count', phase='total', **labels), totals + 1)
+        self.assertGreater(self.sample('menus_request_phase_seconds_count', phase='serialize', **labels), 0)
+
+    def test_multiprocess_aggregation(self):
+        # Cada proceso escribe sus valores en el directorio compartido
+        script = ('from menus import metrics; '
+                  'metrics.observe_cache("tree", 2, 1); '
+                  'metrics.WRITE_SECONDS.labels("menu", "create").observe(0.5)')
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory)
+            for _ in range(2):
+                subprocess.run([sys.executable, '-c', script], env=env, check=True, cwd=settings.ROOT_DIR)
+
+            with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+                registry = metrics.get_registry()
+                content, content_type = metrics.render_metrics()
+
+            self.assertEqual(
+                registry.get_sample_value('menus_cache_requests_total', {'kind': 'tree', 'result': 'hit'}), 4)
+            self.assertEqual(
+                registry.get_sample_value('menus_write_seconds_sum', {'model': 'menu', 'operation': 'create'}), 1)
+        self.assertIn(b'menus_tree_builds_total{kind="tree"} 2.0', content)
+
+
+class ExportAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1, self.module2, self.module3 = ModuleFactory.create_batch(3)
+        self.menu1 = MenuFactory(module=self.module1, order=2)
+        self.menu2 = MenuFactory(module=self.module1, order=1)
+        self.menu1_1 = MenuFactory(parent=self.menu1, order=1)
+        self.menu1_1_1 = MenuFactory(parent=self.menu1_1, order=1)
+        self.menu1_2 = MenuFactory(parent=self.menu1, order=2)
+        self.menu3 = MenuFactory(module=self.module3, order=1, name='Menú ñ')
+        self.url = f'{URL_MENU}export/'
+
+    def export(self, **params):
+        resp = self.client.get(self.url, params)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        return resp, b''.join(resp.streaming_content)
+
+    def test_export_nested_same_as_list(self):
+        resp, content = self.export()
+        self.assertEqual(resp['Content-Type'], 'application/json')
+        self.assertEqual(resp['Content-Disposition'], 'attachment; filename="menus.json"')
+        self.assertEqual(json.loads(content), json.loads(self.client.get(URL_MENU).content))
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_export_nested_gap_ordering(self):
+        Menu.objects.filter(pk=self.menu1_2.pk).update(position=1)
+        resp, content = self.export()
+        self.assertEqual(json.loads(content), json.loads(self.client.get(URL_MENU).content))
+
+    def test_export_by_module(self):
+        resp, content = self.export(module__id=self.module3.pk)
+        listed = self.client.get(URL_MENU, {'module__id': self.module3.pk})
+        self.assertEqual(json.loads(content), json.loads(listed.content))
+
+        resp, content = self.export(module__id=self.module2.pk)
+        self.assertEqual(json.loads(content), [])
+
+    def test_export_ndjson(self):
+        resp, content = self.export(layout='ndjson')
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+
+        records = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([record['pk'] for record in records], [
+            self.menu2.pk, self.menu1.pk, self.menu1_1.pk, self.menu1_1_1.pk, self.menu1_2.pk, self.menu3.pk])
+        self.assertEqual(records[3], {'module': self.module1.pk, 'pk': self.menu1_1_1.pk, 'name': self.menu1_1_1.name,
+                                      'parent': self.menu1_1.pk, 'order': 1, 'deep': 2,
+                                      'path': [self.menu1.pk, self.menu1_1.pk]})
+        self.assertEqual(records[5]['name'], 'Menú ñ')
+
+    def test_export_gzip(self):
+        plain = b''.join(self.client.get(self.url, {'layout': 'ndjson'}).streaming_content)
+        resp = self.client.get(self.url, {'layout': 'ndjson'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp['Vary'])
+        self.assertEqual(gzip.decompress(b''.join(resp.streaming_content)), plain)
+
+    def test_export_starts_before_query(self):
+        resp = self.client.get(self.url)
+        content = iter(resp.streaming_content)
+        with self.assertNumQueries(0):
+            self.assertEqual(next(content), b'[')
+        self.assertEqual(json.loads(b'[' + b''.join(content))[0]['module'], self.module1.pk)
+
+    def test_export_chunks(self):
+        parts = (str(number) for number in range(10000))
+        chunks = list(exports.iter_chunks(parts, size=1000))
+        self.assertEqual(chunks[0], b'0')
+        self.assertTrue(all(1000 <= len(chunk) < 1010 for chunk in chunks[1:-1]))
+        self.assertEqual(b''.join(chunks), ''.join(str(number) for number in range(10000)).encode())
+
+    def test_export_invalid_layout(self):
+        resp = self.client.get(self.url, {'layout': 'xml'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_export_invalid_module(self):
+        for module_id in (0, 'x', 99999999999):
+            resp = self.client.get(self.url, {'module__id': module_id})
+            self.assertEqual(resp.status_code, 400, module_id)
+
+
+class ImportAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        self.menu1 = MenuFactory(module=self.module1, order=1)
+        self.url = f'{URL_MENU}import/'
+        self.menus = [
+            {'name': 'Sales', 'sub_menu': [
+                {'name': 'Orders', 'sub_menu': [{'name': 'Open'}, {'name': 'Closed'}]},
+                {'name': 'Invoices'},
+            ]},
+            {'name': 'Stock'},
+        ]
+
+    def import_menus(self, document):
+        return self.client.post(self.url, document, format='json')
+
+    def tree_names(self, module_id):
+        def names(menus):
+            return [(menu['name'], menu['order'], names(menu['sub_menu'])) for menu in menus]
+        data = self.client.get(URL_MENU, {'module__id': module_id}).json()
+        return names(data[0]['menus'])
+
+    def test_import_nested_new_module(self):
+        resp = self.import_menus({'name': 'Imported', 'menus': self.menus})
+
+        self.assertEqual(resp.status_code, 201)
+        module = Module.objects.get(name='Imported')
+        self.assertEqual(resp.json(), {'module': module.pk, 'created': 6})
+        self.assertEqual(self.tree_names(module.pk), [
+            ('Sales', 1, [('Orders', 1, [('Open', 1, []), ('Closed', 2, [])]), ('Invoices', 2, [])]),
+            ('Stock', 2, []),
+        ])
+        closed = Menu.objects.get(module=module, name='Closed')
+        self.assertEqual(closed.depth, 2)
+        self.assertEqual(closed.path, closed.parent.path_children())
+        self.assertEqual(closed.position, 2 * OrderingMode.GAP_SIZE)
+
+        # Los contadores quedan listos para los menus que se creen despues
+        orders = Menu.objects.get(module=module, name='Orders')
+        self.assertEqual(Menu.objects.execute_create('Pending', module=module, parent=orders).order, 3)
+        self.assertEqual(Menu.objects.execute_create('Reports', module=module).order, 3)
+
+    def test_import_existing_module_appends_roots(self):
+        resp = self.import_menus({'module': self.module1.pk, 'menus': self.menus})
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual([(name, order) for name, order, sub_menu in self.tree_names(self.module1.pk)],
+                         [(self.menu1.name, 1), ('Sales', 2), ('Stock', 3)])
+        self.assertEqual(Menu.objects.execute_create('Reports', module=self.module1).order, 4)
+
+    def test_import_flat_records(self):
+        # Los hijos pueden venir antes que su padre; order solo ordena a los hermanos
+        records = [
+            {'pk': 'b', 'parent': 'a', 'name': 'second', 'order': 20},
+            {'pk': 'c', 'parent': 'a', 'name': 'first', 'order': 10},
+            {'pk': 'a', 'parent': None, 'name': 'root'},
+            {'pk': 7, 'parent': 'c', 'name': 'leaf'},
+        ]
+        resp = self.import_menus({'name': 'Flat', 'records': records})
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(self.tree_names(resp.json()['module']), [
+            ('Root', 1, [('First', 1, [('Leaf', 1, [])]), ('Second', 2, [])]),
+        ])
+
+    def test_import_ndjson_export(self):
+        MenuFactory(parent=self.menu1, order=1, name='Child')
+        content = b''.join(self.client.get(f'{URL_MENU}export/', {'layout': 'ndjson'}).streaming_content)
+        records = [json.loads(line) for line in content.decode().splitlines()]
+
+        resp = self.import_menus({'name': 'Copy', 'records': records})
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(self.tree_names(resp.json()['module']), self.tree_names(self.module1.pk))
+
+    def test_import_reports_every_error(self):
+        menus = [
+            {'name': ''},
+            {'name': 'Long menu name here', 'sub_menu': [{'name': 'Fine'}, {'other': 1}]},
+            'menu',
+        ]
+        resp = self.import_menus({'name': self.module1.name, 'menus': menus})
+
+        self.assertEqual(resp.status_code, 400)
+        errors = {error['item']: error['errors'] for error in resp.json()['errors']}
+        self.assertEqual(set(errors), {'module', 'menus[0]', 'menus[1]', 'menus[1].sub_menu[1]', 'menus[2]'})
+        self.assertIn('name', errors['module'])
+        self.assertIn('name', errors['menus[0]'])
+        self.assertIn('name', errors['menus[1]'])
+        self.assertEqual(Module.objects.count(), 1)
+        self.assertEqual(Menu.objects.count(), 1)
+
+    def test_import_invalid_records(self):
+        records = [
+            {'pk': 1, 'parent': None, 'name': 'root'},
+            {'pk': 1, 'parent': None, 'name': 'again'},
+            {'pk': 2, 'parent': 9, 'name': 'orphan'},
+            {'pk': 3, 'parent': 4, 'name': 'loop'},
+            {'pk': 4, 'parent': 3, 'name': 'loop'},
+            {'pk': 5, 'parent': 2, 'name': 'below orphan'},
+            {'pk': 6, 'parent': 1, 'name': 'bad order', 'order': 'x'},
+            {'parent': 1, 'name': 'no key'},
+            {'pk': [1], 'parent': None, 'name': 'list key'},
+            {'pk': 7, 'parent': [1], 'name': 'list parent'},
+            {'pk': 8, 'parent': {'x': 1}, 'name': 'object parent'},
+            {'pk': 9, 'parent': True, 'name': 'bool parent'},
+        ]
+        resp = self.import_menus({'module': self.module1.pk, 'records': records})
+
+        self.assertEqual(resp.status_code, 400)
+        errors = {error['item']: error['errors'] for error in resp.json()['errors']}
+        self.assertEqual(errors, {
+            'records[1]': {'pk': ['Duplicated key 1.']},
+            'records[2]': {'parent': ['Unknown parent 9.']},
+            'records[3]': {'parent': ['The parent chain forms a cycle.']},
+            'records[4]': {'parent': ['The parent chain forms a cycle.']},
+            'records[6]': {'order': ['A valid integer is required.']},
+            'records[7]': {'pk': ['Expected a string or integer key.']},
+            'records[8]': {'pk': ['Expected a string or integer key.']},
+            'records[9]': {'parent': ['Expected null or a string or integer key.']},
+            'records[10]': {'parent': ['Expected null or a string or integer key.']},
+            'records[11]': {'parent': ['Expected null or a string or integer key.']},
+        })
+        self.assertEqual(Menu.objects.count(), 1)
+
+    def test_import_unknown_module(self):
+        resp = self.import_menus({'module': 999, 'menus': self.menus})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json()['errors'], [{'item': 'module', 'errors': {'module': ['Unknown module 999.']}}])
+
+    def test_import_invalidates_list(self):
+        before = self.client.get(URL_MENU).json()
+        self.import_menus({'module': self.module1.pk, 'menus': self.menus})
+        after = self.client.get(URL_MENU).json()
+        self.assertEqual(len(after[0]['menus']), len(before[0]['menus']) + 2)
+
+    def test_import_inserts_by_level(self):
+        menus = [{'name': f'Menu {number}', 'sub_menu': [{'name': 'Child'}] * 3} for number in range(50)]
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.import_menus({'module': self.module1.pk, 'menus': menus})
+        self.assertEqual(resp.status_code, 201)
+        inserts = [query for query in queries if query['sql'].startswith(f'INSERT INTO "{Menu._meta.db_table}"')]
+        self.assertEqual(len(inserts), 2)
+
+
+class ReorderAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        self.menus = [MenuFactory(module=self.module1, order=order) for order in range(1, 4)]
+        self.children = [MenuFactory(parent=self.menus[0], order=order) for order in range(1, 4)]
+        self.url = f'{URL_MENU}reorder/'
+
+    def test_reorder_children(self):
+        self.client.get(URL_MENU)
+        new_order = [self.children[2].pk, self.children[0].pk, self.children[1].pk]
+
+        resp = self.client.put(self.url, {'module': self.module1.pk, 'parent': self.menus[0].pk,
+                                          'menus': new_order}, format='json')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {'module': self.module1.pk, 'parent': self.menus[0].pk,
+                                       'menus': new_order, 'moved': 3})
+        sub_menu = self.client.get(URL_MENU).json()[0]['menus'][0]['sub_menu']
+        self.assertEqual([(menu['pk'], menu['order']) for menu in sub_menu],
+                         [(pk, order) for order, pk in enumerate(new_order, 1)])
+
+    def test_reorder_roots(self):
+        new_order = [menu.pk for menu in reversed(self.menus)]
+        resp = self.client.put(self.url, {'module': self.module1.pk, 'menus': new_order}, format='json')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([menu['pk'] for menu in self.client.get(URL_MENU).json()[0]['menus']], new_order)
+
+    def test_reorder_invalid(self):
+        resp = self.client.put(self.url, {'module': self.module1.pk, 'menus': []}, format='json')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.put(self.url, {'module': self.module1.pk, 'parent': self.menus[0].pk,
+                                          'menus': [self.children[0].pk]}, format='json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json(), {'message': ErrorMessage.REORDER_MISMATCH})
+
+
+class MoveAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        self.menu1 = Menu.objects.execute_create(name='Menu 1', module=self.module1)
+        self.menu2 = Menu.objects.execute_create(name='Menu 2', module=self.module1)
+        self.menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=self.menu1)
+        self.menu1_1_1 = Menu.objects.execute_create(name='Menu 1.1.1', parent=self.menu1_1)
+
+    def move_url(self, menu):
+        return f'{URL_MENU}{menu.pk}/move/'
+
+    def test_move_menu(self):
+        self.client.get(URL_MENU)
+        resp = self.client.post(self.move_url(self.menu1_1), {'parent': self.menu2.pk}, format='json')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {'id': self.menu1_1.pk, 'name': 'Menu 1.1', 'module': self.module1.pk,
+                                       'parent': self.menu2.pk, 'order': 1})
+        menus = self.client.get(URL_MENU).json()[0]['menus']
+        self.assertEqual(menus[0]['sub_menu'], [])
+        moved, = menus[1]['sub_menu']
+        self.assertEqual((moved['pk'], moved['deep'], moved['sub_menu'][0]['deep']), (self.menu1_1.pk, 1, 2))
+
+    def test_move_to_root(self):
+        resp = self.client.post(self.move_url(self.menu1_1), {'parent': None, 'position': 1}, format='json')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([menu['pk'] for menu in self.client.get(URL_MENU).json()[0]['menus']],
+                         [self.menu1_1.pk, self.menu1.pk, self.menu2.pk])
+
+    def test_move_invalid(self):
+        resp = self.client.post(self.move_url(self.menu1), {'parent': self.menu1_1_1.pk}, format='json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json(), {'message': ErrorMessage.MOVE_CYCLE})
+
+        other = Menu.objects.execute_create(name='Other', module=ModuleFactory())
+        resp = self.client.post(self.move_url(self.menu1), {'parent': other.pk}, format='json')
+        self.assertEqual(resp.json(), {'message': ErrorMessage.MOVE_OTHER_MODULE})
+
+        resp = self.client.post(f'{URL_MENU}999999/move/', {'parent': self.menu1.pk}, format='json')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.post(self.move_url(self.menu1), {'parent': 999999}, format='json')
+        self.assertEqual(resp.status_code, 404)
+
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_single_menu_order_dense_gap_ordering(self):
+        # En modo gap la columna order no se renumera; las respuestas usan el lugar del arbol
+        resp = self.client.post(self.move_url(self.menu2), {'parent': None, 'position': 1}, format='json')
+        self.assertEqual(resp.json()['order'], 1)
+        self.assertEqual(self.client.get(f'{URL_MENU}{self.menu1.pk}/').json()['order'], 2)
+
+        self.client.delete(f'{URL_MENU}{self.menu2.pk}/?cascade=true')
+        resp = self.client.post(URL_MENU, {'name': 'Menu 3', 'module': self.module1.pk})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json()['order'], 2)
+        self.assertEqual(self.client.put(f'{URL_MENU}{resp.json()["id"]}/', {'name': 'Menu 3 bis'}).json()['order'], 2)
+        menus = self.client.get(URL_MENU).json()[0]['menus']
+        self.assertEqual([(menu['name'], menu['order']) for menu in menus], [('Menu 1', 1), ('Menu 3 bis', 2)])
+
+
+class CascadeDeleteAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        self.menu1 = Menu.objects.execute_create(name='Menu 1', module=self.module1)
+        self.menu2 = Menu.objects.execute_create(name='Menu 2', module=self.module1)
+        self.menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=self.menu1)
+        self.menu1_1_1 = Menu.objects.execute_create(name='Menu 1.1.1', parent=self.menu1_1)
+
+    def test_delete_cascade(self):
+        self.client.get(URL_MENU)
+        resp = self.client.delete(f'{URL_MENU}{self.menu1.pk}/?cascade=true')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {'deleted': 3})
+        menus = self.client.get(URL_MENU).json()[0]['menus']
+        self.assertEqual([(menu['pk'], menu['order']) for menu in menus], [(self.menu2.pk, 1)])
+
+    def test_delete_without_cascade_protected(self):
+        for url in (f'{URL_MENU}{self.menu1.pk}/', f'{URL_MENU}{self.menu1.pk}/?cascade=false'):
+            self.assertEqual(self.client.delete(url).status_code, 400)
+        self.assertEqual(Menu.objects.count(), 4)
+
+    def test_delete_cascade_invalid(self):
+        self.assertEqual(self.client.delete(f'{URL_MENU}999999/?cascade=true').status_code, 404)
+        self.assertEqual(self.client.delete(f'{URL_MENU}{self.menu1.pk}/?cascade=maybe').status_code, 400)
+
+
+class CloneModuleAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        self.menu1 = Menu.objects.execute_create(name='Menu 1', module=self.module1)
+        self.menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=self.menu1)
+        self.url = f'{URL_MODULES}{self.module1.pk}/clone/'
+
+    def strip_ids(self, menus):
+        return [(menu['name'], menu['order'], menu['deep'], self.strip_ids(menu['sub_menu'])) for menu in menus]
+
+    def test_clone_module(self):
+        self.client.get(URL_MODULES)
+        resp = self.client.post(self.url, {'name': 'Copy'})
+
+        self.assertEqual(resp.status_code, 201)
+        clone = Module.objects.get(name='Copy')
+        self.assertEqual(resp.json(), {'id': clone.pk, 'name': 'Copy'})
+        self.assertIn({'id': clone.pk, 'name': 'Copy'}, self.client.get(URL_MODULES).json())
+        original, copy = self.client.get(URL_MENU).json()
+        self.assertEqual(copy['module'], clone.pk)
+        self.assertEqual(self.strip_ids(copy['menus']), self.strip_ids(original['menus']))
+
+    def test_clone_invalid(self):
+        self.assertEqual(self.client.post(self.url, {'name': self.module1.name}).status_code, 400)
+        self.assertEqual(self.client.post(f'{URL_MODULES}999999/clone/', {'name': 'Copy'}).status_code, 404)
+
+
+class ChildrenAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1 = ModuleFactory()
+        # Las invalidaciones se ejecutan para que las respuestas lleven ETag
+        with self.captureOnCommitCallbacks(execute=True):
+            self.menu1 = Menu.objects.execute_create(name='Menu 1', module=self.module1)
+            self.menu2 = Menu.objects.execute_create(name='Menu 2', module=self.module1)
+            self.children = [Menu.objects.execute_create(name=f'Child {num}', parent=self.menu1)
+                             for num in range(1, 8)]
+            self.grandchild = Menu.objects.execute_create(name='Grandchild', parent=self.children[2])
+
+    def read_pages(self, url, **params):
+        pages = []
+        while url:
+            resp = self.client.get(url, params)
+            self.assertEqual(resp.status_code, 200)
+            pages.append(resp.json()['results'])
+            url, params = resp.json()['next'], {}
+        return pages
+
+    def test_menu_children(self):
+        resp = self.client.get(f'{URL_MENU}{self.menu1.pk}/children/')
+
+        self.assertEqual(resp.status_code, 200)
+        results = resp.json()['results']
+        self.assertIsNone(resp.json()['next'])
+        self.assertEqual([menu['pk'] for menu in results], [menu.pk for menu in self.children])
+        self.assertEqual(results[2], {'pk': self.children[2].pk, 'name': 'Child 3', 'module': self.module1.pk,
+                                      'order': 3, 'parent': self.menu1.pk, 'deep': 1, 'has_children': True})
+        self.assertEqual([menu['has_children'] for menu in results].count(True), 1)
+
+    def test_module_roots(self):
+        results = self.client.get(f'{URL_MODULES}{self.module1.pk}/children/').json()['results']
+        self.assertEqual([(menu['pk'], menu['parent'], menu['has_children']) for menu in results],
+                         [(self.menu1.pk, None, True), (self.menu2.pk, None, False)])
+
+    def test_children_keyset_pages(self):
+        pages = self.read_pages(f'{URL_MENU}{self.menu1.pk}/children/', limit=3)
+
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual([menu['pk'] for page in pages for menu in page], [menu.pk for menu in self.children])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.read_pages(f'{URL_MENU}{self.menu1.pk}/children/', limit=3)
+        self.assertFalse([query for query in queries if 'OFFSET' in query['sql']])
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_children_gap_ordering(self):
+        Menu.objects.change_order_to(pk=self.children[6].pk, new_order=1)
+
+        pages = self.read_pages(f'{URL_MENU}{self.menu1.pk}/children/', limit=4)
+
+        menus = [menu for page in pages for menu in page]
+        expected = [self.children[6].pk] + [menu.pk for menu in self.children[:6]]
+        self.assertEqual([menu['pk'] for menu in menus], expected)
+        self.assertEqual([menu['order'] for menu in menus], list(range(1, 8)))
+
+    def test_children_not_modified(self):
+        url = f'{URL_MENU}{self.menu1.pk}/children/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Menu.objects.execute_create(name='Child 8', parent=self.menu1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_children_invalid(self):
+        self.assertEqual(self.client.get(f'{URL_MENU}999999/children/').status_code, 404)
+        self.assertEqual(self.client.get(f'{URL_MODULES}999999/children/').status_code, 404)
+        for params in ({'cursor': 'nope'}, {'cursor': encode_cursor(['a', 1, 2])}, {'limit': 0}, {'limit': 5000}):
+            resp = self.client.get(f'{URL_MENU}{self.menu1.pk}/children/', params)
+            self.assertEqual(resp.status_code, 400, params)
+
+
+class TreeProjectionAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1, self.module2 = ModuleFactory.create_batch(2)
+        self.menu1 = Menu.objects.execute_create(name='Menu 1', module=self.module1)
+        self.menu2 = Menu.objects.execute_create(name='Menu 2', module=self.module1)
+        self.menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=self.menu1)
+        self.menu1_2 = Menu.objects.execute_create(name='Menu 1.2', parent=self.menu1)
+        self.menu1_1_1 = Menu.objects.execute_create(name='Menu 1.1.1', parent=self.menu1_1)
+        self.menu3 = Menu.objects.execute_create(name='Menu 3', module=self.module2)
+
+    def project(self, menus, fields, max_depth, depth=0):
+        # Recorta una respuesta completa como deberia hacerlo el servidor
+        return [dict({field: menu[field] for field in fields},
+                     sub_menu=self.project(menu['sub_menu'], fields, max_depth, depth + 1) if depth < max_depth else [])
+                for menu in menus]
+
+    def test_list_max_depth_and_fields(self):
+        full = self.client.get(URL_MENU).json()
+        for fields, max_depth in ((('pk', 'name'), 0), (('pk', 'name'), 1), (('order', 'parent', 'deep'), 5)):
+            resp = self.client.get(URL_MENU, {'fields': ','.join(fields), 'max_depth': max_depth})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json(), [{'module': tree['module'],
+                                            'menus': self.project(tree['menus'], fields, max_depth)}
+                                           for tree in full])
+
+    def test_list_all_fields_same_as_full(self):
+        full = self.client.get(URL_MENU).json()
+        self.assertEqual(self.client.get(URL_MENU, {'max_depth': 10}).json(), full)
+        self.assertEqual(self.client.get(URL_MENU, {'fields': 'deep,parent,order,module,name,pk'}).json(), full)
+        self.assertEqual(self.client.get(URL_MENU, {'module__id': self.module2.pk, 'fields': 'name'}).json(),
+                         [{'module': self.module2.pk, 'menus': [{'name': 'Menu 3', 'sub_menu': []}]}])
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_list_projection_gap_ordering(self):
+        Menu.objects.change_order_to(pk=self.menu1_2.pk, new_order=1)
+        full = self.client.get(URL_MENU).json()
+        resp = self.client.get(URL_MENU, {'fields': 'pk,order', 'max_depth': 1})
+        self.assertEqual(resp.json(), [{'module': tree['module'],
+                                        'menus': self.project(tree['menus'], ('pk', 'order'), 1)}
+                                       for tree in full])
+
+    def test_projected_variants_cached_apart(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Menu.objects.execute_update(self.menu1.pk, 'Menu 1')
+        names = self.client.get(URL_MENU, {'fields': 'name', 'max_depth': 0}).content
+        pks = self.client.get(URL_MENU, {'fields': 'pk', 'max_depth': 0}).content
+        self.assertNotEqual(names, pks)
+        self.assertEqual(self.client.get(URL_MENU, {'fields': 'name', 'max_depth': 0}).content, names)
+        self.assertEqual(self.client.get(URL_MENU).json()[0]['menus'][0]['name'], 'Menu 1')
+
+    def test_projection_pushed_down(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(URL_MENU, {'fields': 'pk', 'max_depth': 0})
+        menu_sql = [query['sql'] for query in queries if 'menus_menu' in query['sql']]
+        self.assertEqual(len(menu_sql), 1)
+        self.assertNotIn('"name"', menu_sql[0])
+        self.assertNotIn('"path"', menu_sql[0])
+        self.assertIn('WITH RECURSIVE', menu_sql[0])
+
+    def test_tree_fields(self):
+        full = self.client.get(f'{URL_MENU}{self.menu1.pk}/tree/').json()
+
+        resp = self.client.get(f'{URL_MENU}{self.menu1.pk}/tree/', {'fields': 'pk,name', 'max_depth': 1})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), self.project([full], ('pk', 'name'), 1)[0])
+        resp = self.client.get(f'{URL_MENU}{self.menu1.pk}/tree/', {'fields': 'pk,name,module,order,parent,deep'})
+        self.assertEqual(resp.json(), full)
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_tree_fields_gap_ordering(self):
+        Menu.objects.change_order_to(pk=self.menu2.pk, new_order=1)
+        full = self.client.get(f'{URL_MENU}{self.menu1.pk}/tree/').json()
+        resp = self.client.get(f'{URL_MENU}{self.menu1.pk}/tree/', {'fields': 'pk,order'})
+        self.assertEqual(resp.json(), self.project([full], ('pk', 'order'), 10)[0])
+        self.assertEqual(resp.json()['order'], 2)
+
+    def test_invalid_projection(self):
+        for params in ({'fields': 'pk,path'}, {'fields': ','}, {'max_depth': -1}, {'max_depth': 'x'},
+                       {'max_depth': 99999999999}, {'fields': 'pk', 'max_depth': 99999999999}):
+            self.assertEqual(self.client.get(URL_MENU, params).status_code, 400, params)
+            self.assertEqual(self.client.get(f'{URL_MENU}{self.menu1.pk}/tree/', params).status_code, 400, params)
+        self.assertEqual(self.client.get(f'{URL_MENU}999999/tree/', {'fields': 'pk'}).status_code, 404)
+
+
+class FlatListAPITest(APITestCase):
+
+    def setUp(self):
+        ModuleFactory.reset_sequence()
+        MenuFactory.reset_sequence()
+        self.module1, self.module2, self.module3 = ModuleFactory.create_batch(3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.menu1 = Menu.objects.execute_create(name='Menu 1', module=self.module1)
+            self.menu2 = Menu.objects.execute_create(name='Menu 2', module=self.module1)
+            self.menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=self.menu1)
+            self.menu1_2 = Menu.objects.execute_create(name='Menu 1.2', parent=self.menu1)
+            self.menu1_1_1 = Menu.objects.execute_create(name='Menu 1.1.1', parent=self.menu1_1)
+            self.menu3 = Menu.objects.execute_create(name='Menu 3', module=self.module2)
+
+    def rebuild(self, tree):
+        # Arma el arbol anidado en una pasada, como lo haria el cliente
+        roots, nodes = [], []
+        for menu_id, parent, order, name in zip(tree['ids'], tree['parent_index'], tree['order'], tree['names']):
+            node = {'pk': menu_id, 'name': name, 'order': order, 'sub_menu': []}
+            nodes.append(node)
+            (nodes[parent]['sub_menu'] if parent >= 0 else roots).append(node)
+        return {'module': tree['module'], 'menus': roots}
+
+    def nested(self, params=None):
+        return self.client.get(URL_MENU, dict(params or {}, fields='pk,name,order')).json()
+
+    def test_flat_rebuilds_nested_list(self):
+        resp = self.client.get(URL_MENU, {'format': 'flat'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'application/json')
+        self.assertEqual([self.rebuild(tree) for tree in resp.json()], self.nested())
+
+    def test_flat_depth_first_order(self):
+        tree = self.client.get(URL_MENU, {'format': 'flat', 'module__id': self.module1.pk}).json()[0]
+
+        self.assertEqual(tree, {
+            'module': self.module1.pk,
+            'ids': [self.menu1.pk, self.menu1_1.pk, self.menu1_1_1.pk, self.menu1_2.pk, self.menu2.pk],
+            'parent_index': [-1, 0, 1, 0, -1],
+            'order': [1, 1, 1, 2, 2],
+            'names': ['Menu 1', 'Menu 1.1', 'Menu 1.1.1', 'Menu 1.2', 'Menu 2'],
+        })
+
+    def test_flat_max_depth_and_filter(self):
+        resp = self.client.get(URL_MENU, {'format': 'flat', 'max_depth': 1, 'module__id': self.module1.pk})
+
+        self.assertEqual([self.rebuild(tree) for tree in resp.json()],
+                         self.nested({'max_depth': 1, 'module__id': self.module1.pk}))
+        self.assertNotIn(self.menu1_1_1.pk, resp.json()[0]['ids'])
+        self.assertEqual(self.client.get(URL_MENU, {'format': 'flat', 'module__id': self.module3.pk}).json(), [])
+
+    def test_flat_invalid_max_depth(self):
+        for max_depth in (-1, 'x', 99999999999):
+            resp = self.client.get(URL_MENU, {'format': 'flat', 'max_depth': max_depth})
+            self.assertEqual(resp.status_code, 400, max_depth)
+            self.assertIn('max_depth', resp.json())
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_flat_gap_ordering(self):
+        Menu.objects.change_order_to(pk=self.menu1_2.pk, new_order=1)
+        resp = self.client.get(URL_MENU, {'format': 'flat', 'module__id': self.module1.pk})
+
+        self.assertEqual(resp.json()[0]['order'], [1, 1, 2, 1, 2])
+        self.assertEqual([self.rebuild(tree) for tree in resp.json()], self.nested({'module__id': self.module1.pk}))
+
+    def test_flat_cached_apart_and_invalidated(self):
+        nested = self.client.get(URL_MENU).content
+        flat = self.client.get(URL_MENU, {'format': 'flat'})
+        self.assertNotEqual(flat.content, nested)
+        self.assertEqual(self.client.get(URL_MENU).content, nested)
+        resp = self.client.get(URL_MENU, {'format': 'flat'}, HTTP_IF_NONE_MATCH=flat['ETag'])
+        self.assertEqual(resp.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Menu.objects.execute_update(self.menu2.pk, 'Menu 2 bis')
+        resp = self.client.get(URL_MENU, {'format': 'flat'}, HTTP_IF_NONE_MATCH=flat['ETag'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Menu 2 bis', resp.json()[0]['names'])
+
+    def test_flat_reads_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(URL_MENU, {'format': 'flat'})
+        menu_sql = [query['sql'] for query in queries if 'menus_menu' in query['sql']]
+        self.assertEqual(len(menu_sql), 1)
+        self.assertNotIn('"path"', menu_sql[0])
+        self.assertNotIn('"depth"', menu_sql[0])
+
+
+class LegacyItemTreeSerializer(serializers.Serializer):
+    # Serializer recursivo anterior, se conserva como referencia
+    pk = serializers.IntegerField()
+    name = serializers.CharField()
+    module = serializers.IntegerField()
+    order = serializers.IntegerField()
+    parent = serializers.IntegerField()
+    deep = serializers.IntegerField()
+    sub_menu = serializers.SerializerMethodField()
+
+    def get_sub_menu(self, obj):
+        if obj.sub_menu is not None:
+            return LegacyItemTreeSerializer(obj.sub_menu, many=True).data
+        else:
+            return None
+
+
+class LegacyMenuTreeSerializer(serializers.Serializer):
+    module = serializers.IntegerField()
+    menus = LegacyItemTreeSerializer(many=True)
+
+
+class MenuTreeSerializerTest(SimpleTestCase):
+
+    def make_tree(self, num_modules, fan_out, levels):
+        pk = 0
+        modules = []
+        for module in range(1, num_modules + 1):
+            menus = []
+            pending = [(menus, None, 0)]
+            while pending:
+                items, parent, deep = pending.pop()
+                for order in range(1, fan_out + 1):
+                    pk += 1
+                    item = TreeMenu(pk=pk, module=module, name=f'Menu {pk}', order=order,
+                                    parent=parent, deep=deep, sub_menu=[])
+                    items.append(item)
+                    if deep + 1 < levels:
+                        pending.append((item.sub_menu, pk, deep + 1))
+            modules.append(TreeModule(module=module, menus=menus))
+        return modules
+
+    def test_tree_serializer_same_json(self):
+        tree = self.make_tree(num_modules=3, fan_out=3, levels=4)
+        tree[0].menus[0].sub_menu[0].sub_menu = None
+
+        data = MenuTreeSerializer(tree, many=True).data
+        legacy_data = LegacyMenuTreeSerializer(tree, many=True).data
+
+        self.assertEqual(json.dumps(data), json.dumps(legacy_data))
+
+    def count_calls(self, serializer_class, tree):
+        # Cuenta los serializers creados y los campos convertidos uno a uno
+        calls = {}
+        patches = [(serializers.BaseSerializer, '__init__'),
+                   (serializers.IntegerField, 'to_representation'),
+                   (serializers.CharField, 'to_representation')]
+        with contextlib.ExitStack() as stack:
+            for klass, name in patches:
+                calls[klass.__name__] = stack.enter_context(
+                    mock.patch.object(klass, name, autospec=True, side_effect=getattr(klass, name)))
+            data = serializer_class(tree, many=True).data
+        return data, {name: patched.call_count for name, patched in calls.items()}
+
+    def test_tree_serializer_dont_serialize_per_node(self):
+        small_tree = self.make_tree(num_modules=2, fan_out=3, levels=3)
+        tree = self.make_tree(num_modules=2, fan_out=6, levels=4)
+
+        small_data, small_calls = self.count_calls(MenuTreeSerializer, small_tree)
+        data, calls = self.count_calls(MenuTreeSerializer, tree)
+        legacy_data, legacy_calls = self.count_calls(LegacyMenuTreeSerializer, tree)
+
+        # 3108 nodos: el serializer anterior crea un serializer por nodo y convierte cada campo
+        self.assertEqual(data, legacy_data)
+        self.assertEqual(small_data, LegacyMenuTreeSerializer(small_tree, many=True).data)
+        self.assertEqual(calls, small_calls)
+        self.assertEqual(calls['IntegerField'] + calls['CharField'], 0)
+        self.assertGreaterEqual(legacy_calls['CharField'], 3108)
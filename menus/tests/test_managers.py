@@ -2,23 +2,43 @@
 
 # Core Django
 # Third app
+import importlib
+import json
+import os
+import tempfile
+import threading
 import unittest
+from io import StringIO
 from ipaddress import ip_address
+from types import SimpleNamespace
 from unittest.mock import patch
 
 import factory
 import psycopg2
 import pytest
 from django.core import exceptions
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError, connection, transaction
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import Max
 from django.db.models.deletion import ProtectedError
-from django.test import SimpleTestCase, TestCase, skipIfDBFeature
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+    skipIfDBFeature,
+)
+from django.test.utils import CaptureQueriesContext
 from django_mock_queries.mocks import ModelMocker, mocked_relations
 from django_mock_queries.query import MockModel, MockSet
 
-from menus.models import Menu, Module
+from menus import tree_cache
+from menus.consts import ErrorMessage, OrderingMode
+from menus.models import Menu, Module, SiblingCounter
 from menus.models.menus import TreeMenu
+from menus.synthetic import create_module_tree, reserve_menu_ids
 from menus.tests.factories import MenuFactory, ModuleFactory
 
 
@@ -81,6 +101,109 @@ class TestModuleOperations(TestCase):
             Module.objects.execute_delete(pk=1)
 
 
+class TestModuleClone(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.menu1, self.menu2 = [Menu.objects.execute_create(name=f'Menu {num}', module=self.module1)
+                                  for num in range(1, 3)]
+        self.menu2_1 = Menu.objects.execute_create(name='Menu 2.1', parent=self.menu2)
+        self.menu2_1_1 = Menu.objects.execute_create(name='Menu 2.1.1', parent=self.menu2_1)
+        self.menu2_2 = Menu.objects.execute_create(name='Menu 2.2', parent=self.menu2)
+        Menu.objects.change_order_to(pk=self.menu2_2.pk, new_order=1)
+
+    def tree(self, module):
+        def items(menus):
+            return [(menu.name, menu.order, menu.deep, items(menu.sub_menu)) for menu in menus]
+        tree, = Menu.objects.get_tree_complete(Menu.objects.filter(module=module))
+        return items(tree.menus)
+
+    def test_clone_module(self):
+        clone = Module.objects.execute_clone(pk=self.module1.pk, name='Copy')
+
+        self.assertEqual(clone.name, 'Copy')
+        self.assertEqual(self.tree(clone), self.tree(self.module1))
+        copied = Menu.objects.filter(module=clone).select_related('parent')
+        self.assertFalse(set(copied.values_list('id', flat=True)) & {self.menu1.pk, self.menu2.pk})
+        for menu in copied:
+            self.assertEqual(menu.path, menu.parent.path_children() if menu.parent else '')
+            self.assertTrue(menu.parent is None or menu.parent.module_id == clone.pk)
+
+        # Los contadores se copian con los ids nuevos
+        new_menu2 = copied.get(name='Menu 2')
+        self.assertEqual(Menu.objects.execute_create(name='Menu 2.3', parent=new_menu2).order, 3)
+        self.assertEqual(Menu.objects.execute_create(name='Menu 3', module=clone).order, 3)
+        self.assertEqual(Menu.objects.filter(module=self.module1).count(), 5)
+
+    def test_clone_statements_independent_of_size(self):
+        empty = ModuleFactory()
+        with CaptureQueriesContext(connection) as small:
+            Module.objects.execute_clone(pk=empty.pk, name='Empty copy')
+        with CaptureQueriesContext(connection) as big:
+            Module.objects.execute_clone(pk=self.module1.pk, name='Copy')
+        self.assertEqual(len(big), len(small))
+
+    def test_clone_invalid(self):
+        with self.assertRaises(ValidationError):
+            Module.objects.execute_clone(pk=self.module1.pk, name=self.module1.name)
+        with self.assertRaises(Module.DoesNotExist):
+            Module.objects.execute_clone(pk=999999, name='Copy')
+        self.assertEqual(Module.objects.count(), 1)
+
+
+class TestModuleCloneConcurrency(TransactionTestCase):
+
+    def clone_module(self, pk, errors):
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL lock_timeout = '200ms'")
+                Module.objects.execute_clone(pk=pk, name='Copy')
+        except Exception as ex:  # pragma: no cover
+            errors.append(ex)
+        finally:
+            connections.close_all()
+
+    def reserve_ids(self, barrier, reserved):
+        try:
+            barrier.wait()
+            with transaction.atomic():
+                reserved.append(reserve_menu_ids(2000))
+        finally:
+            connections.close_all()
+
+    def test_clone_dont_wait_for_reserved_ids(self):
+        module1 = Module.objects.create(name='Module 1')
+        Menu.objects.execute_create(name='Menu 1', module=module1)
+        errors = []
+
+        # La reserva de ids no bloquea la tabla: el clon termina mientras sigue abierta
+        with transaction.atomic():
+            reserved = reserve_menu_ids(10)
+            thread = threading.Thread(target=self.clone_module, args=(module1.pk, errors))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(errors, [])
+        clone = Module.objects.get(name='Copy')
+        self.assertNotIn(Menu.objects.get(module=clone).pk, reserved)
+
+    def test_concurrent_reservations_dont_repeat_ids(self):
+        num_threads = 4
+        barrier = threading.Barrier(num_threads)
+        reserved = []
+
+        threads = [threading.Thread(target=self.reserve_ids, args=(barrier, reserved)) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ids = [menu_id for block in reserved for menu_id in block]
+        self.assertEqual(len(ids), num_threads * 2000)
+        self.assertEqual(len(set(ids)), len(ids))
+
+
 class TestModuleQueries(TestCase):
 
     def test_find_by_pk(self):
@@ -107,7 +230,8 @@ class TestMenuOperations(TestCase):
         self.assertEqual(menu1.module, module1)
         self.assertTrue(Menu.objects.count() == 1)
 
-    @patch.object(Menu.objects, 'next_order_num')
+    # Las posiciones de los menus raiz tambien son unicas: el mock entrega ordenes distintos
+    @patch.object(Menu.objects, 'next_order_num', side_effect=[1, 2])
     def test_create_two_menu_wit_parent_none(self, mock_next_order_num):
         module1 = ModuleFactory()
 
@@ -384,3 +508,959 @@ class TestMenuQueries(TestCase):
 
         self.assertEqual(len(m2_tree1.sub_menu), 0)
         self.assertEqual(m2_tree1.path(), f'{m2_menu1.name}')
+
+
+class TestMenuSubtree(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.menu1 = MenuFactory(module=self.module1, order=1)
+        self.menu2 = MenuFactory(module=self.module1, order=2)
+        self.menu1_1 = MenuFactory(parent=self.menu1, order=2)
+        self.menu1_2 = MenuFactory(parent=self.menu1, order=1)
+        self.menu1_1_1 = MenuFactory(parent=self.menu1_1, order=1)
+        MenuFactory(parent=self.menu2, order=1)
+
+    def test_get_subtree_one_query(self):
+        with self.assertNumQueries(1):
+            subtree = Menu.objects.execute_retrieve(pk=self.menu1.pk)
+
+        tree_complete = Menu.objects.get_tree_complete(Menu.objects.all())
+        self.assertEqual(subtree, tree_complete[0].menus[0])
+
+    def test_get_subtree_inner_node_keep_deep(self):
+        subtree = Menu.objects.get_subtree(self.menu1_1.pk)
+
+        self.assertEqual(subtree, TreeMenu(
+            pk=self.menu1_1.pk, module=self.module1.pk, name=self.menu1_1.name, order=2,
+            parent=self.menu1.pk, deep=1, sub_menu=[
+                TreeMenu(pk=self.menu1_1_1.pk, module=self.module1.pk, name=self.menu1_1_1.name,
+                         order=1, parent=self.menu1_1.pk, deep=2, sub_menu=[])]))
+
+    def test_get_subtree_max_depth(self):
+        subtree = Menu.objects.get_subtree(self.menu1.pk, max_depth=1)
+        self.assertEqual([menu.pk for menu in subtree.sub_menu], [self.menu1_2.pk, self.menu1_1.pk])
+        self.assertEqual(subtree.sub_menu[1].sub_menu, [])
+
+        subtree = Menu.objects.get_subtree(self.menu1.pk, max_depth=0)
+        self.assertEqual(subtree.sub_menu, [])
+
+    def test_get_subtree_not_exist(self):
+        with self.assertRaisesMessage(Menu.DoesNotExist, "The menu with the pk = 999 doesnt exist"):
+            Menu.objects.get_subtree(999)
+
+
+class TestMenuIterTree(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.module2 = ModuleFactory()
+        self.menu1 = MenuFactory(module=self.module1, order=2)
+        self.menu2 = MenuFactory(module=self.module1, order=1)
+        self.menu1_1 = MenuFactory(parent=self.menu1, order=2)
+        self.menu1_2 = MenuFactory(parent=self.menu1, order=1)
+        self.menu1_1_1 = MenuFactory(parent=self.menu1_1, order=1)
+        self.menu2_1 = MenuFactory(parent=self.menu2, order=1)
+        self.menu3 = MenuFactory(module=self.module2, order=1)
+
+    def test_iter_tree_depth_first(self):
+        records = [(module, menu.pk, depth, path) for module, menu, depth, path in Menu.objects.iter_tree()]
+
+        self.assertEqual(records, [
+            (self.module1.pk, self.menu2.pk, 0, ()),
+            (self.module1.pk, self.menu2_1.pk, 1, (self.menu2.pk,)),
+            (self.module1.pk, self.menu1.pk, 0, ()),
+            (self.module1.pk, self.menu1_2.pk, 1, (self.menu1.pk,)),
+            (self.module1.pk, self.menu1_1.pk, 1, (self.menu1.pk,)),
+            (self.module1.pk, self.menu1_1_1.pk, 2, (self.menu1.pk, self.menu1_1.pk)),
+            (self.module2.pk, self.menu3.pk, 0, ()),
+        ])
+
+    def test_iter_tree_same_order_as_tree_complete(self):
+        def walk(menus):
+            for menu in menus:
+                yield menu.pk
+                yield from walk(menu.sub_menu)
+
+        tree_complete = Menu.objects.get_tree_complete(Menu.objects.all())
+        expected = [pk for tree in tree_complete for pk in walk(tree.menus)]
+        self.assertEqual([menu.pk for module, menu, depth, path in Menu.objects.iter_tree(chunk_size=2)], expected)
+
+    def test_iter_tree_by_module(self):
+        records = list(Menu.objects.iter_tree(module_ids=[self.module2.pk]))
+        self.assertEqual([(module, menu) for module, menu, depth, path in records], [(self.module2.pk, self.menu3)])
+        self.assertEqual(list(Menu.objects.iter_tree(module_ids=[])), [])
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_iter_tree_gap_ordering(self):
+        Menu.objects.filter(pk=self.menu1_1.pk).update(position=1)
+        pks = [menu.pk for module, menu, depth, path in Menu.objects.iter_tree(module_ids=[self.module1.pk])]
+        self.assertEqual(pks[2:], [self.menu1.pk, self.menu1_1.pk, self.menu1_1_1.pk, self.menu1_2.pk])
+
+    def test_iter_tree_server_side_cursor(self):
+        with patch.object(connection, 'chunked_cursor', wraps=connection.chunked_cursor) as chunked_cursor:
+            records = Menu.objects.iter_tree(chunk_size=3)
+            with self.assertNumQueries(1):
+                module, menu, depth, path = next(records)
+            records.close()
+
+        chunked_cursor.assert_called_once_with()
+        self.assertEqual(menu, self.menu2)
+
+
+class TestMenuPath(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.menu1 = Menu.objects.execute_create(name='Menu 1', module=self.module1)
+        self.menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=self.menu1)
+        self.menu1_1_1 = Menu.objects.execute_create(name='Menu 1.1.1', parent=self.menu1_1)
+        self.menu2 = Menu.objects.execute_create(name='Menu 2', module=self.module1)
+
+    def test_create_set_path_and_depth(self):
+        self.assertEqual((self.menu1.path, self.menu1.depth), ('', 0))
+        self.assertEqual((self.menu1_1.path, self.menu1_1.depth), (f'{self.menu1.pk}/', 1))
+        self.assertEqual((self.menu1_1_1.path, self.menu1_1_1.depth),
+                         (f'{self.menu1.pk}/{self.menu1_1.pk}/', 2))
+
+    def test_factory_set_path_and_depth(self):
+        menu2_1 = MenuFactory(parent=self.menu2, order=1)
+        self.assertEqual((menu2_1.path, menu2_1.depth), (f'{self.menu2.pk}/', 1))
+
+    def test_get_descendants_and_ancestors(self):
+        descendants = Menu.objects.get_descendants(self.menu1).order_by('depth')
+        ancestors = Menu.objects.get_ancestors(self.menu1_1_1)
+
+        self.assertQuerysetEqual(descendants, [self.menu1_1, self.menu1_1_1])
+        self.assertQuerysetEqual(ancestors, [self.menu1, self.menu1_1])
+        self.assertFalse(Menu.objects.get_descendants(self.menu2).exists())
+
+    def test_backfill_path_migration(self):
+        migration = importlib.import_module('menus.migrations.0013_menu_path_depth')
+        Menu.objects.update(path='', depth=0)
+
+        with connection.cursor() as cursor:
+            cursor.execute(migration.BACKFILL_PATH_SQL)
+
+        paths = Menu.objects.order_by('id').values_list('path', 'depth')
+        self.assertQuerysetEqual(paths, [
+            ('', 0), (f'{self.menu1.pk}/', 1), (f'{self.menu1.pk}/{self.menu1_1.pk}/', 2), ('', 0)])
+
+
+class TestMenuDeepPath(TestCase):
+    # Cadena de 1000 menus: su path pasa el limite de una llave btree
+    BASE, DEPTH = 1000000, 1000
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO menus_menu (id, name, module_id, parent_id, \"order\", position, path, depth) "
+                "SELECT %(base)s + num, 'Menu', %(module)s, NULLIF(%(base)s + num - 1, %(base)s), 1, 65536, "
+                "COALESCE((SELECT string_agg((%(base)s + g)::text || '/', '' ORDER BY g) "
+                "          FROM generate_series(1, num - 1) g), ''), num - 1 "
+                "FROM generate_series(1, %(depth)s) num",
+                {'base': self.BASE, 'module': self.module1.pk, 'depth': self.DEPTH})
+        self.root = Menu.objects.get(pk=self.BASE + 1)
+        self.deepest = Menu.objects.get(pk=self.BASE + self.DEPTH)
+
+    def test_deep_path_exceeds_index_key(self):
+        self.assertGreater(len(self.deepest.path), 2704)
+
+    def test_create_move_and_delete_deep_menus(self):
+        child = Menu.objects.execute_create(name='Menu deep', parent=self.deepest)
+        self.assertEqual(child.depth, self.DEPTH)
+        self.assertEqual(Menu.objects.get_descendants(self.root).count(), self.DEPTH)
+
+        middle = Menu.objects.get(pk=self.BASE + 500)
+        middle = Menu.objects.execute_move(middle.pk, new_parent=self.root.pk)
+        self.assertEqual(Menu.objects.get_descendants(middle).count(), self.DEPTH - 499)
+        self.assertEqual(Menu.objects.get(pk=child.pk).depth, self.DEPTH - 498)
+
+        self.assertEqual(Menu.objects.execute_delete_subtree(middle.pk), self.DEPTH - 498)
+        self.assertEqual(Menu.objects.filter(module=self.module1).count(), 499)
+
+    def test_descendants_use_path_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        self.assertIn('menu_path_prefix_idx', Menu.objects.get_descendants(self.deepest.parent).explain())
+
+
+@override_settings(MENUS_ORDERING='gap')
+class TestMenuGapOrdering(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.menus = [Menu.objects.execute_create(name=f'Menu {num}', module=self.module1)
+                      for num in range(1, 6)]
+
+    def tree_names(self):
+        tree, = Menu.objects.get_tree_complete(Menu.objects.all())
+        self.assertEqual([menu.order for menu in tree.menus], list(range(1, len(tree.menus) + 1)))
+        return [menu.name for menu in tree.menus]
+
+    def test_move_last_to_first_write_one_row(self):
+        positions = dict(Menu.objects.values_list('id', 'position'))
+
+        # 3 consultas mas el SAVEPOINT/RELEASE del bloque atomico
+        with self.assertNumQueries(5):
+            Menu.objects.change_order_to(pk=self.menus[4].pk, new_order=1)
+
+        new_positions = dict(Menu.objects.values_list('id', 'position'))
+        changed = [pk for pk in positions if positions[pk] != new_positions[pk]]
+        self.assertEqual(changed, [self.menus[4].pk])
+        self.assertEqual(self.tree_names(), ['Menu 5', 'Menu 1', 'Menu 2', 'Menu 3', 'Menu 4'])
+
+    def test_move_intermediate_and_last(self):
+        Menu.objects.change_order_to(pk=self.menus[1].pk, new_order=4)
+        self.assertEqual(self.tree_names(), ['Menu 1', 'Menu 3', 'Menu 4', 'Menu 2', 'Menu 5'])
+
+        Menu.objects.change_order_to(pk=self.menus[0].pk, new_order=9)
+        self.assertEqual(self.tree_names(), ['Menu 3', 'Menu 4', 'Menu 2', 'Menu 5', 'Menu 1'])
+
+    def test_rebalance_when_gaps_run_out(self):
+        menus_by_name = {menu.name: menu for menu in self.menus}
+        expected = list(menus_by_name)
+        for _ in range(41):
+            Menu.objects.change_order_to(pk=menus_by_name[expected[-1]].pk, new_order=2)
+            expected.insert(1, expected.pop())
+
+        self.assertEqual(self.tree_names(), expected)
+        positions = list(Menu.objects.order_by('position').values_list('position', flat=True))
+        self.assertEqual(len(set(positions)), 5)
+
+    def test_rebalance_positions_keep_order(self):
+        Menu.objects.change_order_to(pk=self.menus[4].pk, new_order=1)
+
+        Menu.objects.rebalance_positions(module=self.module1)
+
+        menus_order = Menu.objects.order_by('position').values_list('name', 'order', 'position')
+        self.assertQuerysetEqual(menus_order, [
+            ('Menu 5', 1, 65536), ('Menu 1', 2, 131072), ('Menu 2', 3, 196608),
+            ('Menu 3', 4, 262144), ('Menu 4', 5, 327680)])
+
+    def test_subtree_dense_order(self):
+        Menu.objects.change_order_to(pk=self.menus[4].pk, new_order=1)
+        child = Menu.objects.execute_create(name='Child', parent=self.menus[3])
+
+        subtree = Menu.objects.get_subtree(self.menus[3].pk)
+
+        self.assertEqual(subtree.order, 5)
+        self.assertEqual(subtree.sub_menu[0].pk, child.pk)
+        self.assertEqual(subtree.sub_menu[0].order, 1)
+
+
+class TestMenuReorder(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.menus = [Menu.objects.execute_create(name=f'Menu {num}', module=self.module1)
+                      for num in range(1, 6)]
+        self.children = [Menu.objects.execute_create(name=f'Child {num}', parent=self.menus[0])
+                         for num in range(1, 4)]
+
+    def sibling_names(self, parent=None):
+        menus = Menu.objects.filter(module=self.module1, parent=parent).order_by('order')
+        self.assertEqual([menu.position for menu in menus], [menu.order * 65536 for menu in menus])
+        return [menu.name for menu in menus]
+
+    def test_reorder_roots_one_update(self):
+        new_order = [self.menus[4].pk, self.menus[0].pk, self.menus[2].pk, self.menus[1].pk, self.menus[3].pk]
+
+        # SELECT ... FOR UPDATE y el UPDATE, mas el savepoint y su release
+        with self.assertNumQueries(4):
+            moved = Menu.objects.execute_reorder(module=self.module1.pk, parent=None, menus=new_order)
+
+        self.assertEqual(moved, 4)
+        self.assertEqual(self.sibling_names(), ['Menu 5', 'Menu 1', 'Menu 3', 'Menu 2', 'Menu 4'])
+        self.assertEqual(self.sibling_names(self.menus[0]), ['Child 1', 'Child 2', 'Child 3'])
+
+    def test_reorder_children_keeps_orders_dense(self):
+        Menu.objects.execute_delete(pk=self.children[1].pk)
+        Menu.objects.execute_reorder(module=self.module1, parent=self.menus[0],
+                                     menus=[self.children[2].pk, self.children[0].pk])
+
+        self.assertEqual(self.sibling_names(self.menus[0]), ['Child 3', 'Child 1'])
+        self.assertEqual(Menu.objects.execute_create(name='Child 4', parent=self.menus[0]).order, 4)
+
+    def test_reorder_same_order_writes_nothing(self):
+        self.assertEqual(Menu.objects.execute_reorder(
+            module=self.module1.pk, parent=self.menus[0].pk, menus=[menu.pk for menu in self.children]), 0)
+
+    def test_reorder_rejects_other_menus(self):
+        roots = [menu.pk for menu in self.menus]
+        for menus in (roots[:-1], roots + [self.children[0].pk], roots + roots[:1]):
+            with self.assertRaises(ValidationError):
+                Menu.objects.execute_reorder(module=self.module1.pk, parent=None, menus=menus)
+        self.assertEqual(self.sibling_names(), [f'Menu {num}' for num in range(1, 6)])
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_reorder_gap_ordering(self):
+        Menu.objects.change_order_to(pk=self.menus[4].pk, new_order=2)
+        Menu.objects.execute_reorder(module=self.module1.pk, parent=None,
+                                     menus=[menu.pk for menu in reversed(self.menus)])
+
+        tree, = Menu.objects.get_tree_complete(Menu.objects.filter(parent=None))
+        self.assertEqual([(menu.name, menu.order) for menu in tree.menus],
+                         [(f'Menu {num}', order) for order, num in enumerate(range(5, 0, -1), 1)])
+
+
+class TestMenuMove(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.menu1, self.menu2, self.menu3 = [Menu.objects.execute_create(name=f'Menu {num}', module=self.module1)
+                                              for num in range(1, 4)]
+        self.menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=self.menu1)
+        self.menu1_1_1 = Menu.objects.execute_create(name='Menu 1.1.1', parent=self.menu1_1)
+        self.menu1_2 = Menu.objects.execute_create(name='Menu 1.2', parent=self.menu1)
+        self.menu2_1 = Menu.objects.execute_create(name='Menu 2.1', parent=self.menu2)
+        self.menu2_2 = Menu.objects.execute_create(name='Menu 2.2', parent=self.menu2)
+
+    def children(self, parent):
+        menus = Menu.objects.filter(module=self.module1, parent=parent).order_by(*Menu.objects.sort_fields())
+        return [(menu.name, menu.order) for menu in menus]
+
+    def assertConsistentPaths(self):
+        for menu in Menu.objects.select_related('parent'):
+            expected = (menu.parent.path_children(), menu.parent.depth + 1) if menu.parent else ('', 0)
+            self.assertEqual((menu.path, menu.depth), expected, menu.name)
+
+    def test_move_subtree_to_other_parent(self):
+        menu = Menu.objects.execute_move(pk=self.menu1_1.pk, new_parent=self.menu2.pk, position=2)
+
+        self.assertEqual((menu.parent_id, menu.order, menu.depth), (self.menu2.pk, 2, 1))
+        self.assertEqual(self.children(self.menu1), [('Menu 1.2', 1)])
+        self.assertEqual(self.children(self.menu2), [('Menu 2.1', 1), ('Menu 1.1', 2), ('Menu 2.2', 3)])
+        self.assertEqual(Menu.objects.get(pk=self.menu1_1_1.pk).path,
+                         f'{self.menu2.pk}/{self.menu1_1.pk}/')
+        self.assertConsistentPaths()
+
+    def test_move_to_root_and_back(self):
+        Menu.objects.execute_move(pk=self.menu1_1.pk)
+        self.assertEqual(self.children(None), [('Menu 1', 1), ('Menu 2', 2), ('Menu 3', 3), ('Menu 1.1', 4)])
+        self.assertEqual(Menu.objects.get(pk=self.menu1_1_1.pk).depth, 1)
+
+        Menu.objects.execute_move(pk=self.menu1_1.pk, new_parent=self.menu3, position=1)
+        self.assertEqual(self.children(None), [('Menu 1', 1), ('Menu 2', 2), ('Menu 3', 3)])
+        self.assertEqual(self.children(self.menu3), [('Menu 1.1', 1)])
+        self.assertEqual(Menu.objects.get(pk=self.menu1_1_1.pk).depth, 2)
+        self.assertConsistentPaths()
+
+    def test_move_same_parent_changes_order(self):
+        Menu.objects.execute_move(pk=self.menu2_2.pk, new_parent=self.menu2.pk, position=1)
+        self.assertEqual(self.children(self.menu2), [('Menu 2.2', 1), ('Menu 2.1', 2)])
+
+    def test_move_same_parent_clamps_position(self):
+        Menu.objects.execute_move(pk=self.menu1.pk, new_parent=None, position=10)
+        self.assertEqual(self.children(None), [('Menu 2', 1), ('Menu 3', 2), ('Menu 1', 3)])
+        self.assertEqual(Menu.objects.execute_create(name='Menu 4', module=self.module1).order, 4)
+
+        Menu.objects.execute_move(pk=self.menu1.pk, new_parent=None, position=-5)
+        self.assertEqual(self.children(None)[0], ('Menu 1', 1))
+
+    def test_move_rejects_cycles(self):
+        for new_parent in (self.menu1, self.menu1_1, self.menu1_1_1):
+            with self.assertRaisesMessage(ValidationError, ErrorMessage.MOVE_CYCLE):
+                Menu.objects.execute_move(pk=self.menu1.pk, new_parent=new_parent.pk)
+        self.assertConsistentPaths()
+
+    def test_move_rejects_other_module(self):
+        other = Menu.objects.execute_create(name='Other', module=ModuleFactory())
+        with self.assertRaisesMessage(ValidationError, ErrorMessage.MOVE_OTHER_MODULE):
+            Menu.objects.execute_move(pk=self.menu1.pk, new_parent=other.pk)
+        with self.assertRaises(Menu.DoesNotExist):
+            Menu.objects.execute_move(pk=999999, new_parent=self.menu1.pk)
+
+    def test_move_statements_independent_of_subtree(self):
+        def count_move(pk, new_parent):
+            with CaptureQueriesContext(connection) as queries:
+                Menu.objects.execute_move(pk=pk, new_parent=new_parent, position=1)
+            return len(queries)
+
+        small = count_move(self.menu1_2.pk, self.menu3.pk)
+        big = Menu.objects.execute_create(name='Big', module=self.module1)
+        create_children = [big]
+        for _ in range(3):
+            create_children = [Menu.objects.execute_create(name='Node', parent=parent)
+                               for parent in create_children for _ in range(3)]
+        self.assertEqual(count_move(big.pk, self.menu3.pk), small)
+        self.assertConsistentPaths()
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_move_gap_ordering(self):
+        # En modo gap solo cuenta position; order se recalcula al leer el arbol
+        Menu.objects.execute_move(pk=self.menu1_1.pk, new_parent=self.menu2.pk, position=2)
+        self.assertEqual([name for name, order in self.children(self.menu2)], ['Menu 2.1', 'Menu 1.1', 'Menu 2.2'])
+
+        Menu.objects.execute_move(pk=self.menu2_1.pk, new_parent=self.menu3.pk)
+        self.assertEqual([name for name, order in self.children(self.menu2)], ['Menu 1.1', 'Menu 2.2'])
+        self.assertEqual([name for name, order in self.children(self.menu3)], ['Menu 2.1'])
+        self.assertConsistentPaths()
+
+    def test_create_after_move_dont_leave_hole(self):
+        Menu.objects.execute_move(pk=self.menu1_2.pk, new_parent=self.menu2.pk)
+        Menu.objects.execute_move(pk=self.menu3.pk, new_parent=self.menu2.pk, position=1)
+
+        self.assertEqual(Menu.objects.execute_create(name='Menu 1.3', parent=self.menu1).order, 2)
+        self.assertEqual(Menu.objects.execute_create(name='Menu 4', module=self.module1).order, 3)
+        self.assertEqual(self.children(None), [('Menu 1', 1), ('Menu 2', 2), ('Menu 4', 3)])
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_create_after_move_gap_ordering(self):
+        Menu.objects.execute_move(pk=self.menu2_2.pk, new_parent=self.menu3.pk)
+
+        menu = Menu.objects.execute_create(name='Menu 2.3', parent=self.menu2)
+        self.assertEqual((menu.order, menu.position), (2, 2 * OrderingMode.GAP_SIZE))
+
+
+class TestMenuMoveConcurrency(TransactionTestCase):
+
+    def move_menu(self, pk, new_parent, errors):
+        try:
+            Menu.objects.execute_move(pk=pk, new_parent=new_parent)
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            connections.close_all()
+
+    # En modo gap ningun UPDATE de hermanos cruza las dos transacciones; solo los bloqueos del movimiento
+    @override_settings(MENUS_ORDERING='gap')
+    def test_crossed_moves_dont_create_cycle(self):
+        module1 = Module.objects.create(name='Module 1')
+        menu1, menu2 = [Menu.objects.execute_create(name=f'Menu {num}', module=module1) for num in (1, 2)]
+        menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=menu1)
+        menu2_1 = Menu.objects.execute_create(name='Menu 2.1', parent=menu2)
+        errors = []
+
+        # Menu 1 bajo Menu 2.1 sin confirmar mientras otro hilo mueve Menu 2 bajo Menu 1.1
+        with transaction.atomic():
+            Menu.objects.execute_move(pk=menu1.pk, new_parent=menu2_1.pk)
+            thread = threading.Thread(target=self.move_menu, args=(menu2.pk, menu1_1.pk, errors))
+            thread.start()
+            thread.join(timeout=0.5)
+        thread.join()
+
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ValidationError)
+        self.assertEqual(errors[0].messages, [ErrorMessage.MOVE_CYCLE])
+        for menu in Menu.objects.all():
+            self.assertNotIn(menu.pk, menu.ancestor_ids())
+        self.assertEqual(Menu.objects.get(pk=menu1_1.pk).path, f'{menu2.pk}/{menu2_1.pk}/{menu1.pk}/')
+
+
+class TestMenuDeleteSubtree(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.menu1, self.menu2, self.menu3 = [Menu.objects.execute_create(name=f'Menu {num}', module=self.module1)
+                                              for num in range(1, 4)]
+        self.menu2_1 = Menu.objects.execute_create(name='Menu 2.1', parent=self.menu2)
+        self.menu2_1_1 = Menu.objects.execute_create(name='Menu 2.1.1', parent=self.menu2_1)
+        self.menu2_2 = Menu.objects.execute_create(name='Menu 2.2', parent=self.menu2)
+        self.menu3_1 = Menu.objects.execute_create(name='Menu 3.1', parent=self.menu3)
+        self.other = Menu.objects.execute_create(name='Other', module=ModuleFactory())
+
+    def test_delete_subtree(self):
+        self.assertEqual(Menu.objects.execute_delete_subtree(self.menu2.pk), 4)
+
+        self.assertQuerysetEqual(Menu.objects.filter(module=self.module1).order_by('order', 'depth').values_list(
+            'name', 'order', 'position'), [('Menu 1', 1, 65536), ('Menu 3.1', 1, 65536), ('Menu 3', 2, 131072)])
+        self.assertTrue(Menu.objects.filter(pk=self.other.pk).exists())
+        self.assertFalse(SiblingCounter.objects.filter(parent_key__in=[self.menu2.pk, self.menu2_1.pk]).exists())
+        # El contador de los hermanos baja con la compactacion: el nuevo menu no deja hueco
+        Menu.objects.execute_create(name='Menu 4', module=self.module1)
+        self.assertEqual(list(Menu.objects.filter(module=self.module1, parent=None).order_by('order').values_list(
+            'name', 'order')), [('Menu 1', 1), ('Menu 3', 2), ('Menu 4', 3)])
+
+    def test_delete_subtree_leaf(self):
+        self.assertEqual(Menu.objects.execute_delete_subtree(self.menu2_1_1.pk), 1)
+        self.assertEqual(Menu.objects.filter(module=self.module1).count(), 6)
+
+    def test_delete_subtree_statements_independent_of_size(self):
+        with CaptureQueriesContext(connection) as small:
+            Menu.objects.execute_delete_subtree(self.menu3.pk)
+        with CaptureQueriesContext(connection) as big:
+            Menu.objects.execute_delete_subtree(self.menu2.pk)
+        self.assertEqual(len(big), len(small))
+
+    def test_delete_subtree_not_exist(self):
+        with self.assertRaises(Menu.DoesNotExist):
+            Menu.objects.execute_delete_subtree(999999)
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_delete_subtree_gap_ordering(self):
+        Menu.objects.execute_delete_subtree(self.menu1.pk)
+        tree, = Menu.objects.get_tree_complete(Menu.objects.filter(module=self.module1))
+        self.assertEqual([(menu.name, menu.order) for menu in tree.menus], [('Menu 2', 1), ('Menu 3', 2)])
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_create_after_delete_last_subtree_gap_ordering(self):
+        Menu.objects.execute_delete_subtree(self.menu3.pk)
+
+        menu = Menu.objects.execute_create(name='Menu 4', module=self.module1)
+        self.assertEqual((menu.order, menu.position), (3, 3 * OrderingMode.GAP_SIZE))
+
+
+class TestSiblingPositionConstraint(TransactionTestCase):
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'NULLS NOT DISTINCT es de PostgreSQL')
+    def test_root_menus_dont_repeat_position(self):
+        if connection.pg_version < 150000:
+            self.skipTest('NULLS NOT DISTINCT requiere PostgreSQL 15')
+        module1 = Module.objects.create(name='Module 1')
+        Menu.objects.create(name='Menu 1', module=module1, order=1, position=OrderingMode.GAP_SIZE)
+
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Menu.objects.create(name='Menu 2', module=module1, order=1, position=OrderingMode.GAP_SIZE)
+        self.assertEqual(Menu.objects.filter(module=module1, parent=None).count(), 1)
+
+
+class TestMenuOrderCounter(TestCase):
+
+    def test_next_order_num_one_query(self):
+        module1 = ModuleFactory()
+        Menu.objects.execute_create(name='Menu 1', module=module1)
+
+        with self.assertNumQueries(1):
+            order = Menu.objects.next_order_num(module=module1)
+
+        self.assertEqual(order, 2)
+        self.assertEqual(Menu.objects.next_order_num(module=module1), 3)
+
+    def test_next_order_num_seed_from_existing_menus(self):
+        module1 = ModuleFactory()
+        menu1 = MenuFactory(module=module1, order=4)
+        MenuFactory(parent=menu1, order=7)
+
+        self.assertEqual(Menu.objects.next_order_num(module=module1), 5)
+        self.assertEqual(Menu.objects.next_order_num(parent=menu1), 8)
+
+    def test_delete_menu_remove_children_counter(self):
+        module1 = ModuleFactory()
+        menu1 = Menu.objects.execute_create(name='Menu 1', module=module1)
+        Menu.objects.next_order_num(parent=menu1)
+
+        Menu.objects.execute_delete(pk=menu1.pk)
+
+        self.assertQuerysetEqual(
+            SiblingCounter.objects.values_list('parent_key', flat=True), [0])
+
+    def test_delete_last_menu_release_order(self):
+        module1 = ModuleFactory()
+        menu1 = Menu.objects.execute_create(name='Menu 1', module=module1)
+        menu2 = Menu.objects.execute_create(name='Menu 2', module=module1)
+        menu1_1 = Menu.objects.execute_create(name='Menu 1.1', parent=menu1)
+
+        Menu.objects.execute_delete(pk=menu2.pk)
+        Menu.objects.execute_delete(pk=menu1_1.pk)
+
+        self.assertEqual(Menu.objects.execute_create(name='Menu 3', module=module1).order, 2)
+        self.assertEqual(Menu.objects.execute_create(name='Menu 1.2', parent=menu1).order, 1)
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_delete_last_menu_release_position(self):
+        module1 = ModuleFactory()
+        menu1 = Menu.objects.execute_create(name='Menu 1', module=module1)
+        menu2 = Menu.objects.execute_create(name='Menu 2', module=module1)
+        Menu.objects.change_order_to(pk=menu1.pk, new_order=2)
+
+        Menu.objects.execute_delete(pk=Menu.objects.get(pk=menu1.pk).pk)
+        menu3 = Menu.objects.execute_create(name='Menu 3', module=module1)
+
+        self.assertGreater(menu3.position, Menu.objects.get(pk=menu2.pk).position)
+        self.assertEqual(SiblingCounter.objects.get(module=module1, parent_key=0).last_order,
+                         menu3.position // 65536)
+
+    def test_counter_stays_bounded(self):
+        module1 = ModuleFactory()
+        menu1 = Menu.objects.execute_create(name='Menu 1', module=module1)
+        for _ in range(3):
+            Menu.objects.execute_delete(pk=Menu.objects.execute_create(name='Menu 2', module=module1).pk)
+
+        self.assertEqual(SiblingCounter.objects.get(module=module1, parent_key=0).last_order, menu1.order)
+
+    def test_order_above_small_integer(self):
+        menu1 = MenuFactory(order=40000)
+        self.assertEqual(Menu.objects.next_order_num(module=menu1.module), 40001)
+
+
+class TestMenuOrderConcurrency(TransactionTestCase):
+
+    def create_menus(self, parent, num_menus, barrier, errors):
+        try:
+            barrier.wait()
+            for num in range(num_menus):
+                Menu.objects.execute_create(name=f'Menu {num}', parent=parent)
+        except Exception as ex:  # pragma: no cover
+            errors.append(ex)
+        finally:
+            connections.close_all()
+
+    def test_concurrent_create_dont_repeat_order(self):
+        module1 = Module.objects.create(name='Module 1')
+        parent = Menu.objects.execute_create(name='Menu 1', module=module1)
+        num_threads, num_menus = 8, 10
+        barrier = threading.Barrier(num_threads)
+        errors = []
+
+        threads = [threading.Thread(target=self.create_menus, args=(parent, num_menus, barrier, errors))
+                   for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        orders = sorted(Menu.objects.filter(parent=parent).values_list('order', flat=True))
+        self.assertEqual(orders, list(range(1, num_threads * num_menus + 1)))
+
+
+class TestMenuChangeOrderAutocommit(TransactionTestCase):
+    # Sin ATOMIC_REQUESTS ni transaccion externa: cada UPDATE haria commit por separado
+
+    @override_settings(MENUS_ORDERING='dense')
+    def test_change_order_outside_transaction(self):
+        module1 = Module.objects.create(name='Module 1')
+        parent = Menu.objects.execute_create(name='Parent', module=module1)
+        x, y, z = [Menu.objects.execute_create(name=name, parent=parent) for name in ('X', 'Y', 'Z')]
+
+        Menu.objects.change_order_to(y.pk, 3)
+
+        menus = Menu.objects.filter(parent=parent).order_by('order')
+        self.assertEqual([(menu.name, menu.order) for menu in menus], [('X', 1), ('Z', 2), ('Y', 3)])
+        self.assertEqual(len({menu.position for menu in menus}), 3)
+
+    @override_settings(MENUS_ORDERING='gap')
+    def test_move_between_gaps_outside_transaction(self):
+        module1 = Module.objects.create(name='Module 1')
+        parent = Menu.objects.execute_create(name='Parent', module=module1)
+        x, y, z = [Menu.objects.execute_create(name=name, parent=parent) for name in ('X', 'Y', 'Z')]
+
+        Menu.objects.change_order_to(x.pk, 3)
+
+        names = list(Menu.objects.filter(parent=parent).order_by('position').values_list('name', flat=True))
+        self.assertEqual(names, ['Y', 'Z', 'X'])
+
+
+class TestMenuIndexes(TestCase):
+    # Pocos menus bastan: sin seq scan el planner solo puede elegir un indice que sirva;
+    # los tiempos con volumen se miden con el comando benchmark_menus
+    NUM_MODULES, NUM_ROOTS, NUM_CHILDREN = 3, 4, 5
+
+    @classmethod
+    def setUpTestData(cls):
+        modules = [Module.objects.create(name=f'Module {num}') for num in range(1, cls.NUM_MODULES + 1)]
+        cls.module = modules[1]
+        for module in modules:
+            roots = [MenuFactory(module=module, order=order) for order in range(1, cls.NUM_ROOTS + 1)]
+            for root in roots:
+                for order in range(1, cls.NUM_CHILDREN + 1):
+                    MenuFactory(module=module, parent=root, order=order)
+        cls.parent = roots[2]
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertIndexScan(self, plan):
+        self.assertIn('Index', plan)
+        self.assertNotIn('Seq Scan on menus_menu', plan)
+
+    def test_list_tree_use_index(self):
+        queryset = Menu.objects.filter(module=self.module).order_by('module', 'parent', 'order')
+        self.assertIndexScan(queryset.explain())
+
+    def test_change_order_use_index(self):
+        siblings = Menu.objects.filter(module=self.module, parent=self.parent, order__gte=2, order__lte=4)
+        roots = Menu.objects.filter(module=self.module, parent=None, order__gte=2, order__lte=4)
+
+        self.assertIndexScan(siblings.explain())
+        self.assertIndexScan(roots.explain())
+
+    def test_gap_neighbors_use_index(self):
+        siblings = Menu.objects.filter(module=self.module, parent=self.parent).order_by('position', 'id')[2:4]
+        roots = Menu.objects.filter(module=self.module, parent=None).order_by('position', 'id')[2:4]
+
+        self.assertIndexScan(siblings.explain())
+        self.assertIndexScan(roots.explain())
+
+    def test_next_order_use_index(self):
+        with self.assertNumQueries(2):
+            order = Menu.objects.next_order_num(parent=self.parent)
+        plan = Menu.objects.filter(module=self.module, parent=self.parent).explain()
+
+        self.assertIndexScan(plan)
+        self.assertEqual(order, self.NUM_CHILDREN + 1)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'EXPLAIN UPDATE menus_siblingcounter SET last_order = last_order + 1 '
+                'WHERE module_id = %s AND parent_key = %s', [self.module.pk, self.parent.pk])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn('Index', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+
+class CountingNode(SimpleNamespace):
+    # Cuenta las lecturas de atributos de todos los nodos
+    reads = 0
+
+    def __getattribute__(self, name):
+        type(self).reads += 1
+        return super().__getattribute__(name)
+
+
+class CountingList(list):
+    # Cuenta las veces que se recorre la lista de nodos
+    passes = 0
+
+    def __iter__(self):
+        type(self).passes += 1
+        return super().__iter__()
+
+
+class TestBuildTreeMenuScaling(SimpleTestCase):
+
+    def make_nodes(self, num_nodes, fan_out=10):
+        # Arbol balanceado, ya ordenado por padre como en get_tree_complete
+        return CountingList(CountingNode(id=pk, module_id=1, name='Menu', order=0, depth=0,
+                                         parent_id=(pk - 2) // fan_out + 1 if pk > 1 else None)
+                            for pk in range(1, num_nodes + 1))
+
+    def reads_per_node(self, num_nodes):
+        nodes = self.make_nodes(num_nodes)
+        CountingNode.reads, CountingList.passes = 0, 0
+        tree = Menu.objects.build_tree_menu(nodes, None)
+        self.assertEqual(len(tree), 1)
+        self.assertEqual(CountingList.passes, 1)
+        return CountingNode.reads / num_nodes
+
+    def test_build_tree_menu_deep_chain_without_recursion(self):
+        nodes = [SimpleNamespace(id=pk, module_id=1, name=f'Menu {pk}', order=1, depth=pk - 1,
+                                 parent_id=pk - 1 if pk > 1 else None)
+                 for pk in range(1, 20001)]
+
+        tree = Menu.objects.build_tree_menu(nodes, None)
+
+        node, level = tree[0], 0
+        while node.sub_menu:
+            node, level = node.sub_menu[0], level + 1
+        self.assertEqual(node.pk, 20000)
+        self.assertEqual(node.deep, level)
+
+    def test_build_tree_menu_scales_linearly(self):
+        # Cada nodo se lee las mismas veces sin importar el tamano del arbol;
+        # los tiempos se miden con el comando benchmark_menus
+        self.assertEqual(self.reads_per_node(100), self.reads_per_node(10000))
+
+
+class TestMenuTreeCache(TestCase):
+
+    def setUp(self):
+        self.module1 = ModuleFactory()
+        self.module2 = ModuleFactory()
+        # Los on_commit se ejecutan como si la transaccion terminara
+        with self.captureOnCommitCallbacks(execute=True):
+            self.menu1 = Menu.objects.execute_create(name='Menu 1', module=self.module1)
+            Menu.objects.execute_create(name='Menu 1.1', parent=self.menu1)
+            Menu.objects.execute_create(name='Menu 2', module=self.module2)
+
+    def test_tree_cached_equals_tree_complete(self):
+        tree_complete = Menu.objects.get_tree_complete(Menu.objects.all())
+        self.assertEqual(Menu.objects.get_tree_cached(), tree_complete)
+        self.assertEqual(Menu.objects.get_tree_cached(), tree_complete)
+        self.assertEqual(Menu.objects.get_tree_cached(self.module2.pk), tree_complete[1:])
+
+    def test_tree_cached_skip_database(self):
+        Menu.objects.get_tree_cached()
+
+        with self.assertNumQueries(0):
+            tree, = Menu.objects.get_tree_cached(self.module1.pk)
+        with self.assertNumQueries(1):
+            Menu.objects.get_tree_cached()
+
+        self.assertEqual(tree.menus[0].sub_menu[0].name, 'Menu 1.1')
+
+    def test_write_invalidate_tree_on_commit(self):
+        Menu.objects.get_tree_cached(self.module1.pk)
+        versions = tree_cache.get_module_versions([self.module1.pk, self.module2.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Menu.objects.execute_update(self.menu1.pk, 'Menu 10')
+            self.assertEqual(tree_cache.get_module_versions([self.module1.pk]),
+                             {self.module1.pk: versions[self.module1.pk]})
+
+        tree, = Menu.objects.get_tree_cached(self.module1.pk)
+        self.assertEqual(tree.menus[0].name, 'Menu 10')
+        new_versions = tree_cache.get_module_versions([self.module1.pk, self.module2.pk])
+        self.assertNotEqual(new_versions[self.module1.pk], versions[self.module1.pk])
+        self.assertEqual(new_versions[self.module2.pk], versions[self.module2.pk])
+
+    def test_pending_write_bypass_cache(self):
+        Menu.objects.get_tree_cached(self.module1.pk)
+
+        Menu.objects.execute_create(name='Menu 3', module=self.module1)
+
+        with self.assertNumQueries(1):
+            tree, = Menu.objects.get_tree_cached(self.module1.pk)
+        self.assertEqual([menu.name for menu in tree.menus], ['Menu 1', 'Menu 3'])
+
+    def test_rollback_dont_invalidate(self):
+        versions = tree_cache.get_module_versions([self.module1.pk])
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(ValidationError):
+                with transaction.atomic():
+                    Menu.objects.change_order_to(pk=self.menu1.pk, new_order=1)
+                    Menu.objects.execute_create(name='', module=self.module1)
+            self.assertEqual(tree_cache.pending_invalidations(), set())
+
+            with transaction.atomic():
+                Menu.objects.change_order_to(pk=self.menu1.pk, new_order=1)
+                transaction.set_rollback(True)
+            self.assertEqual(tree_cache.pending_invalidations(), set())
+
+        self.assertEqual(callbacks, [])
+        self.assertEqual(tree_cache.get_module_versions([self.module1.pk]), versions)
+
+    def test_module_write_invalidate(self):
+        versions = tree_cache.get_module_versions([self.module2.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Module.objects.execute_update(self.module2.pk, 'Module 20')
+            self.assertEqual(tree_cache.pending_invalidations(), {self.module2.pk})
+        self.assertEqual(tree_cache.pending_invalidations(), set())
+
+        self.assertNotEqual(tree_cache.get_module_versions([self.module2.pk]), versions)
+
+    def test_unknown_module_dont_create_stamps(self):
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                self.assertEqual(Menu.objects.get_tree_cached(999999), [])
+        self.assertIsNone(cache.get(tree_cache.VERSION_KEY.format(999999)))
+        self.assertIsNone(cache.get(tree_cache.MODIFIED_KEY.format(999999)))
+
+
+class TestMenuBenchmarks(TestCase):
+    def test_synthetic_shapes(self):
+        for shape, depth in (('wide', 1), ('deep', 99), ('balanced', 2)):
+            module = create_module_tree(f'Shape {shape}', shape, 300)
+            menus = Menu.objects.filter(module=module)
+            self.assertEqual(menus.count(), 300)
+            self.assertEqual(menus.aggregate(depth=Max('depth'))['depth'], depth)
+            for menu in menus.exclude(parent=None).select_related('parent')[:20]:
+                self.assertEqual(menu.path, menu.parent.path_children())
+
+    def test_benchmark_command_json(self):
+        out = StringIO()
+        call_command('benchmark_menus', shapes='wide,deep', sizes='120', repeat=2, stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['meta']['repeat'], 2)
+        self.assertEqual({(result['shape'], result['operation']) for result in report['results']},
+                         {(shape, operation) for shape in ('wide', 'deep')
+                          for operation in ('build_tree_menu', 'get_tree_complete', 'menu_tree_serializer',
+                                            'api_menus_cold', 'api_menus_warm', 'api_menus_flat_cold',
+                                            'api_menus_flat_warm', 'next_order_num', 'change_order_to')})
+        for result in report['results']:
+            self.assertLessEqual(result['min'], result['median'])
+            self.assertLessEqual(result['median'], result['max'])
+            if result['operation'].startswith('api_menus'):
+                self.assertGreater(result['bytes'], 0)
+        # Los datos sinteticos no quedan en la base
+        self.assertFalse(Module.objects.filter(name__startswith='B').exists())
+
+    def test_benchmark_command_unknown_shape(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_menus', shapes='round', sizes='10')
+
+
+class TestGenerateMenus(TestCase):
+    def tree_signature(self, module):
+        # Estructura del arbol sin depender de los ids generados
+        orders = {}
+        for menu in Menu.objects.filter(module=module).order_by('depth', 'id'):
+            orders[menu.pk] = orders.get(menu.parent_id, ()) + (menu.order,)
+        return sorted(orders.values())
+
+    def test_generate_consistent_trees(self):
+        call_command('generate_menus', modules=2, nodes=500, roots=3, fan_out=4, depth=5, seed=7, stdout=StringIO())
+        modules = Module.objects.filter(name__in=['Load 1', 'Load 2'])
+        self.assertEqual(len(modules), 2)
+
+        for module in modules:
+            menus = Menu.objects.filter(module=module).select_related('parent')
+            self.assertEqual(len(menus), 500)
+            self.assertEqual(menus.filter(parent=None).count(), 3)
+            self.assertEqual(menus.aggregate(depth=Max('depth'))['depth'], 4)
+            siblings = {}
+            for menu in menus:
+                expected_path = menu.parent.path_children() if menu.parent else ''
+                self.assertEqual((menu.path, menu.depth), (expected_path, menu.path.count('/')))
+                self.assertEqual(menu.position, menu.order * 65536)
+                siblings.setdefault(menu.parent_id, []).append(menu.order)
+            for orders in siblings.values():
+                self.assertEqual(sorted(orders), list(range(1, len(orders) + 1)))
+
+        # La secuencia de ids sigue disponible para el ORM
+        menu = Menu.objects.execute_create(name='After', module=modules[0])
+        self.assertEqual(menu.order, 4)
+
+    def test_same_seed_same_trees(self):
+        call_command('generate_menus', nodes=300, fan_out=5, depth=4, seed=1, prefix='A', stdout=StringIO())
+        call_command('generate_menus', nodes=300, fan_out=5, depth=4, seed=1, prefix='B', stdout=StringIO())
+        call_command('generate_menus', nodes=300, fan_out=5, depth=4, seed=2, prefix='C', stdout=StringIO())
+        first, second, other = (self.tree_signature(Module.objects.get(name=f'{prefix} 1')) for prefix in 'ABC')
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+    def test_generate_existing_modules(self):
+        Module.objects.create(name='Load 1')
+        with self.assertRaises(CommandError):
+            call_command('generate_menus', nodes=10, stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('generate_menus', nodes=10, prefix='A very long prefix', stdout=StringIO())
+
+
+class TestImportMenus(TestCase):
+    def setUp(self):
+        self.module = ModuleFactory()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(content)
+        return path
+
+    def test_import_nested_file(self):
+        path = self.write('menus.json', json.dumps([{'name': 'a', 'sub_menu': [{'name': 'b'}, {'name': 'c'}]}]))
+        stdout = StringIO()
+        call_command('import_menus', path, module=self.module.pk, stdout=stdout)
+
+        self.assertIn('Imported 3 menus', stdout.getvalue())
+        root = Menu.objects.get(module=self.module, parent=None)
+        self.assertEqual(root.name, 'A')
+        self.assertEqual(list(root.menu_set.order_by('order').values_list('name', 'order', 'depth')),
+                         [('B', 1, 1), ('C', 2, 1)])
+
+    def test_import_ndjson_file(self):
+        lines = [{'pk': 10, 'parent': None, 'name': 'root', 'order': 1},
+                 {'pk': 11, 'parent': 10, 'name': 'child', 'order': 1}]
+        path = self.write('menus.ndjson', ''.join(json.dumps(line) + '\n' for line in lines))
+        call_command('import_menus', path, name='From file', stdout=StringIO())
+
+        child = Menu.objects.get(module__name='From file', name='Child')
+        self.assertEqual(child.parent.name, 'Root')
+
+    def test_import_invalid_file(self):
+        path = self.write('menus.json', json.dumps({'menus': [{'name': 'ok'}, {'name': ''}]}))
+        with self.assertRaisesMessage(CommandError, 'menus[1]: name:'):
+            call_command('import_menus', path, module=self.module.pk, stdout=StringIO())
+        self.assertFalse(Menu.objects.exists())
+
+        with self.assertRaises(CommandError):
+            call_command('import_menus', self.write('broken.json', '{'), module=self.module.pk)
@@ -0,0 +1,59 @@
+import time
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class PhaseTimer:
+    """
+    Accumulate the time spent on each named phase of a request.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def finish(self):
+        self.phases['total'] = time.perf_counter() - self.start
+        return self.phases
+
+    def header(self):
+        return ', '.join(f'{name};dur={duration * 1000:.2f}' for name, duration in self.phases.items())
+
+
+class NullTimer:
+    # Con la medicion apagada cada fase es un nullcontext compartido
+    enabled = False
+    null_phase = nullcontext()
+
+    def phase(self, name):
+        return self.null_phase
+
+
+NULL_TIMER = NullTimer()
+
+
+@lru_cache(maxsize=None)
+def load_timing_hook(path):
+    return import_string(path) if path else None
+
+
+def get_timing_hook():
+    return load_timing_hook(getattr(settings, 'MENUS_TIMING_HOOK', None))
+
+
+def new_timer():
+    if getattr(settings, 'MENUS_SERVER_TIMING', False) or get_timing_hook() is not None:
+        return PhaseTimer()
+    return NULL_TIMER
@@ -0,0 +1,164 @@
+import hashlib
+import threading
+import time
+import weakref
+
+from django.core.cache import cache
+from django.db import transaction
+
+from menus import metrics
+
+VERSION_KEY = 'menus:module:{}:version'
+MODIFIED_KEY = 'menus:module:{}:modified'
+ENTRY_KEY = 'menus:module:{}:{}:{}'
+PAYLOAD_KEY = 'menus:payload:{}:{}'
+# Pseudo modulo que cambia cuando se crean o eliminan modulos
+CATALOG = 'catalog'
+
+# Invalidaciones registradas en la transaccion de cada conexion. Solo se guardan
+# referencias debiles: cuando Django descarta un on_commit por un rollback la
+# invalidacion deja de existir y sale de aqui
+registered = threading.local()
+
+
+class ModuleInvalidation:
+    # Se registra con on_commit; si la transaccion hace rollback Django la descarta
+    def __init__(self, module_ids):
+        self.module_ids = set(module_ids)
+        self.executed = False
+
+    def __call__(self):
+        bump_module_versions(self.module_ids)
+        self.executed = True
+
+
+def new_version():
+    # Un valor nuevo nunca coincide con versiones anteriores aunque el
+    # backend haya expulsado el contador
+    return time.time_ns()
+
+
+def get_module_versions(module_ids):
+    keys = {VERSION_KEY.format(module_id): module_id for module_id in module_ids}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, new_version(), timeout=None)
+        versions[key] = cache.get(key)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def has_module_version(module_id):
+    # Solo los modulos existentes reciben version; ver MenuManager.get_module_ids
+    return cache.get(VERSION_KEY.format(module_id)) is not None
+
+
+def get_module_stamps(module_ids):
+    # {module_id: (version, modified)} con una sola lectura al cache
+    keys = {}
+    for module_id in module_ids:
+        keys[VERSION_KEY.format(module_id)] = (module_id, new_version)
+        keys[MODIFIED_KEY.format(module_id)] = (module_id, time.time)
+    values = cache.get_many(keys)
+    for key in keys.keys() - values.keys():
+        cache.add(key, keys[key][1](), timeout=None)
+        values[key] = cache.get(key)
+    return {module_id: (values.get(VERSION_KEY.format(module_id)), values.get(MODIFIED_KEY.format(module_id)))
+            for module_id in module_ids}
+
+
+def bump_module_versions(module_ids):
+    cache.set_many({MODIFIED_KEY.format(module_id): time.time() for module_id in module_ids}, timeout=None)
+    for module_id in module_ids:
+        key = VERSION_KEY.format(module_id)
+        try:
+            if cache.incr(key) is not None:
+                continue
+        except ValueError:
+            pass
+        cache.set(key, new_version(), timeout=None)
+
+
+def registered_invalidations(connection):
+    by_alias = registered.__dict__.setdefault('by_alias', {})
+    return by_alias.setdefault(connection.alias, weakref.WeakSet())
+
+
+def invalidate_modules(*module_ids, using=None):
+    module_ids = [module_id for module_id in module_ids if module_id is not None]
+    if not module_ids:
+        return
+    invalidation = ModuleInvalidation(module_ids)
+    connection = transaction.get_connection(using)
+    if connection.in_atomic_block:
+        registered_invalidations(connection).add(invalidation)
+    transaction.on_commit(invalidation, using=using)
+
+
+def pending_invalidations(using=None):
+    # Modulos escritos en la transaccion actual que aun no hacen commit
+    connection = transaction.get_connection(using)
+    invalidations = registered_invalidations(connection)
+    if not connection.in_atomic_block:
+        invalidations.clear()
+        return set()
+    pending = set()
+    for invalidation in list(invalidations):
+        if not invalidation.executed:
+            pending |= invalidation.module_ids
+    return pending
+
+
+def get_or_build(kind, module_ids, build):
+    """
+    Return {module_id: value} for the given kind of cached entry, calling
+    build(missing_module_ids) for the modules not cached at their current version.
+    """
+    module_ids = list(module_ids)
+    if not module_ids:
+        return {}
+
+    pending = pending_invalidations()
+    versions = get_module_versions(module_ids)
+    keys = {module_id: ENTRY_KEY.format(module_id, kind, versions.get(module_id))
+            for module_id in module_ids}
+    cached = cache.get_many(keys.values())
+
+    result = {}
+    missing = []
+    for module_id, key in keys.items():
+        if module_id not in pending and key in cached:
+            result[module_id] = cached[key]
+        else:
+            missing.append(module_id)
+
+    metrics.observe_cache(kind, len(result), len(missing))
+    if missing:
+        with metrics.BUILD_SECONDS.labels(kind).time():
+            built = build(missing)
+        cache.set_many({keys[module_id]: built[module_id] for module_id in missing
+                        if module_id not in pending and versions.get(module_id) is not None})
+        result.update(built)
+    return result
+
+
+def get_or_build_payload(kind, module_ids, build, variant=''):
+    """
+    Return the rendered bytes for a response made of the given modules, where
+    build() renders them. Entries are keyed by every module version and by
+    the variant of the representation (e.g. its query parameters).
+    """
+    module_ids = list(module_ids)
+    pending = pending_invalidations()
+    versions = get_module_versions(module_ids)
+    cacheable = not pending.intersection(module_ids) and None not in versions.values()
+
+    stamp = variant + ','.join(f'{module_id}:{versions.get(module_id)}' for module_id in module_ids)
+    key = PAYLOAD_KEY.format(kind, hashlib.sha1(stamp.encode()).hexdigest())
+    content = cache.get(key) if cacheable else None
+    metrics.observe_cache(kind, content is not None, content is None)
+    if content is None:
+        with metrics.BUILD_SECONDS.labels(kind).time():
+            content = build()
+        if cacheable:
+            cache.set(key, content)
+    return content
@@ -1,8 +1,22 @@
+import hmac
+import re
 
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.generics import GenericAPIView
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
+from menus import exports, imports, metrics, tree_cache
+from menus.consts import ExportLayout
 from menus.mixins_custom import (
     CreateModelMixinCustom,
     DestroyModelMixinCustom,
@@ -11,34 +25,339 @@ from menus.mixins_custom import (
     UpdateModelMixinCustom,
 )
 from menus.models import Menu, Module
-from menus.serializers import MenuSerializer, MenuTreeSerializer, ModuleSerializer
+from menus.models.menus import TreeModule
+from menus.renderers import FlatTreeRenderer
+from menus.serializers import (
+    ChildMenuSerializer,
+    ChildrenQuerySerializer,
+    DestroyQuerySerializer,
+    ExportQuerySerializer,
+    ItemTreeSerializer,
+    MenuListQuerySerializer,
+    MenuSerializer,
+    MenuTreeSerializer,
+    ModuleSerializer,
+    MoveSerializer,
+    ReorderSerializer,
+    TreeQuerySerializer,
+    encode_cursor,
+)
 
 # Create your views here.
 
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+
+def metrics_view(request):
+    # Las metricas no son publicas: el endpoint solo existe con MENUS_METRICS_TOKEN
+    token = getattr(settings, 'MENUS_METRICS_TOKEN', None)
+    if not token:
+        raise Http404
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        response = HttpResponse(status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    content, content_type = metrics.render_metrics()
+    return HttpResponse(content, content_type=content_type)
+
+
+class MenuChildrenMixin:
+    """
+    One level of a menu tree per request, paged by keyset cursors.
+    """
+
+    def children_response(self, module_id, parent_id):
+        query = ChildrenQuerySerializer(data=self.request.query_params)
+        query.is_valid(raise_exception=True)
 
-class ModuleViewSetApi(CreateModelMixinCustom, ListModelMixinCustom, RetrieveModelMixinCustom, UpdateModelMixinCustom, DestroyModelMixinCustom, viewsets.GenericViewSet):
+        validators = self.get_validators([module_id])
+        not_modified = self.get_not_modified(validators)
+        if not_modified is not None:
+            return not_modified
+
+        with self.phase('perform_list'):
+            menus, cursor = Menu.objects.get_children_page(module_id, parent_id, **query.validated_data)
+        with self.phase('serialize'):
+            data = {'results': ChildMenuSerializer(menus, many=True).data, 'next': None}
+        if cursor is not None:
+            data['next'] = replace_query_param(self.request.build_absolute_uri(), 'cursor', encode_cursor(cursor))
+        return self.set_validators(Response(data), validators)
+
+
+class ModuleViewSetApi(MenuChildrenMixin, CreateModelMixinCustom, ListModelMixinCustom, RetrieveModelMixinCustom, UpdateModelMixinCustom, DestroyModelMixinCustom, viewsets.GenericViewSet):
     queryset = Module.objects.all()
     serializer_class = ModuleSerializer
     model_operations = Module
+    # Consultas maximas por accion, sin contar savepoints
+    query_budgets = {
+        'list': 2,
+        'retrieve': 1,
+        'create': 3,
+        'update': 4,
+        'partial_update': 4,
+        'destroy': 4,
+        # El nombre se valida en el serializer y en full_clean; los menus se copian con cuatro sentencias
+        'clone': 8,
+        'children': 2,
+    }
+
+    def get_list_module_ids(self):
+        return Module.objects.get_module_ids() + [tree_cache.CATALOG]
 
+    def get_instance_module_ids(self, instance):
+        return [instance.pk]
 
-class MenuViewSetApi(CreateModelMixinCustom, ListModelMixinCustom, RetrieveModelMixinCustom, UpdateModelMixinCustom, DestroyModelMixinCustom, viewsets.GenericViewSet):
+    @action(detail=True, methods=['get'])
+    def children(self, request, pk=None):
+        try:
+            with self.phase('queryset'):
+                module = Module.objects.find_by_pk(pk)
+        except Module.DoesNotExist as e:
+            return Response({'message': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        return self.children_response(module.pk, None)
+
+    @action(detail=True, methods=['post'])
+    def clone(self, request, pk=None):
+        with self.phase('validate'):
+            serializer = self.get_serializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+        try:
+            with self.phase('perform'):
+                module = Module.objects.execute_clone(pk=pk, **serializer.validated_data)
+        except Module.DoesNotExist as e:
+            return Response({'message': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        with self.phase('serialize'):
+            return Response(self.get_serializer(module).data, status=status.HTTP_201_CREATED)
+
+
+class MenuViewSetApi(MenuChildrenMixin, CreateModelMixinCustom, ListModelMixinCustom, RetrieveModelMixinCustom, UpdateModelMixinCustom, DestroyModelMixinCustom, viewsets.GenericViewSet):
     queryset = Menu.objects.all().select_related('module')
     serializer_class = MenuSerializer
     model_operations = Menu
     dict_serializer_classes = {
         'list': MenuTreeSerializer,
+        'tree': ItemTreeSerializer,
     }
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['module__id']
+    lookup_value_regex = '[0-9]+'
+    # ?format=flat elige el FlatTreeRenderer
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, FlatTreeRenderer]
+    # max_depth y fields validados del list
+    tree_query = {}
+    # Consultas maximas por accion, sin contar savepoints
+    query_budgets = {
+        'list': 2,
+        'retrieve': 1,
+        'tree': 1,
+        'children': 2,
+        # Las consultas del export corren mientras se envia la respuesta; el presupuesto cubre todo el stream
+        'export': 1,
+        # Un INSERT por nivel del arbol importado; los documentos de prueba tienen tres
+        'import_tree': 10,
+        'reorder': 2,
+        'move': 8,
+        'create': 8,
+        'update': 2,
+        'partial_update': 5,
+        # Dos sentencias bajan el contador de hermanos al ultimo orden en uso
+        'destroy': 6,
+    }
 
     def get_serializer_class(self):
         serializer = self.dict_serializer_classes.get(
             self.action, self.serializer_class)
         return serializer
 
+    def list(self, request, *args, **kwargs):
+        # Se valida antes de comparar el ETag para no responder 304 a parametros invalidos
+        self.tree_query = self.get_tree_query()
+        return super().list(request, *args, **kwargs)
+
+    def get_tree_query(self):
+        query = TreeQuerySerializer(data=self.request.query_params)
+        query.is_valid(raise_exception=True)
+        return query.validated_data
+
+    def get_tree_variant(self):
+        variant = 'flat|' if self.accepts_flat() else ''
+        if not self.tree_query:
+            return variant
+        return f"{variant}{self.tree_query.get('max_depth', '')}|{','.join(self.tree_query.get('fields', ()))}|"
+
+    def accepts_flat(self):
+        return isinstance(getattr(self.request, 'accepted_renderer', None), FlatTreeRenderer)
+
+    def get_filter_module_id(self):
+        # Un module__id vacio no filtra, igual que en el filterset
+        module_id = self.request.query_params.get('module__id')
+        query = MenuListQuerySerializer(data={'module__id': module_id} if module_id else {})
+        query.is_valid(raise_exception=True)
+        return query.validated_data.get('module__id')
+
     def perform_list(self, queryset):
-        return Menu.objects.get_tree_complete(queryset)
+        return Menu.objects.get_tree_cached(self.get_filter_module_id())
+
+    def build_list_data(self, module_ids):
+        with self.phase('perform_list'):
+            trees = Menu.objects.get_trees_by_module(module_ids)
+        with self.phase('serialize'):
+            return {module_id: self.get_serializer(TreeModule(module=module_id, menus=trees[module_id])).data
+                    if trees[module_id] else None
+                    for module_id in module_ids}
+
+    def get_list_data(self, queryset):
+        return self.get_list_data_by_module(self.get_list_module_ids())
+
+    def get_list_data_by_module(self, module_ids):
+        module_ids = [module_id for module_id in module_ids if module_id != tree_cache.CATALOG]
+        if self.accepts_flat():
+            return self.get_flat_list_data(module_ids)
+        if self.tree_query:
+            return self.get_projected_list_data(module_ids)
+        list_data = tree_cache.get_or_build('data', module_ids, self.build_list_data)
+        return [list_data[module_id] for module_id in module_ids if list_data[module_id] is not None]
+
+    def get_projected_list_data(self, module_ids):
+        # Los niveles y columnas que no se piden no se leen de la base de datos
+        with self.phase('perform_list'):
+            trees = Menu.objects.get_projected_trees(module_ids, **self.tree_query)
+        return [{'module': module_id, 'menus': trees[module_id]} for module_id in module_ids if trees[module_id]]
+
+    def get_flat_list_data(self, module_ids):
+        # Arreglos por columna en orden de profundidad, sin armar objetos del arbol; fields no aplica
+        with self.phase('perform_list'):
+            trees = Menu.objects.get_flat_trees(module_ids, self.tree_query.get('max_depth'))
+        return [dict(module=module_id, **trees[module_id]) for module_id in module_ids if trees[module_id]['ids']]
+
+    def accepts_plain_json(self):
+        # Solo se sirve el contenido ya renderizado con el JSONRenderer sin parametros
+        renderer = self.request.accepted_renderer
+        return isinstance(renderer, JSONRenderer) and ';' not in self.request.accepted_media_type
+
+    def list_response(self, queryset):
+        if not self.accepts_plain_json():
+            return super().list_response(queryset)
+
+        module_ids = self.get_list_module_ids()
+        content = tree_cache.get_or_build_payload('list', module_ids, lambda: self.render_list(module_ids),
+                                                  variant=self.get_tree_variant())
+
+        response = HttpResponse(content, content_type=JSONRenderer.media_type)
+        response['Content-Length'] = len(content)
+        return response
+
+    def render_list(self, module_ids):
+        data = self.get_list_data_by_module(module_ids)
+        with self.phase('render'):
+            return JSONRenderer().render(data)
+
+    def get_list_module_ids(self):
+        # Se usa para los validadores y para el contenido; se consulta una sola vez
+        if getattr(self, 'list_module_ids', None) is None:
+            module_id = self.get_filter_module_id()
+            module_ids = Menu.objects.get_module_ids(module_id)
+            self.list_module_ids = module_ids if module_id is not None else module_ids + [tree_cache.CATALOG]
+        return self.list_module_ids
+
+    def get_instance_module_ids(self, instance):
+        return [instance.module_id]
+
+    @action(detail=True, methods=['get'])
+    def tree(self, request, pk=None):
+        query = self.get_tree_query()
+
+        try:
+            with self.phase('queryset'):
+                if 'fields' in query:
+                    # Ya sale como diccionario, con solo las columnas pedidas
+                    return Response(Menu.objects.get_projected_subtree(pk, **query))
+                subtree = self.model_operations.objects.execute_retrieve(pk=pk, **query)
+        except Menu.DoesNotExist as e:
+            return Response({'message': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+
+        with self.phase('serialize'):
+            data = self.get_serializer(subtree).data
+        return Response(data)
+
+    @action(detail=True, methods=['get'])
+    def children(self, request, pk=None):
+        try:
+            with self.phase('queryset'):
+                menu = Menu.objects.find_by_pk(pk)
+        except Menu.DoesNotExist as e:
+            return Response({'message': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        return self.children_response(menu.module_id, menu.pk)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        query = ExportQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        layout = query.validated_data['layout']
+        module_id = query.validated_data.get('module__id')
+
+        # Los menus se leen y se envian a medida que el cliente los recibe
+        content = exports.export_catalog(None if module_id is None else [module_id], layout)
+        gzip = ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        response = StreamingHttpResponse(compress_sequence(content) if gzip else content,
+                                         content_type=ExportLayout.CONTENT_TYPES[layout])
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        extension = 'ndjson' if layout == ExportLayout.NDJSON else 'json'
+        response['Content-Disposition'] = f'attachment; filename="menus.{extension}"'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def destroy(self, request, *args, **kwargs):
+        query = DestroyQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        if not query.validated_data['cascade']:
+            return super().destroy(request, *args, **kwargs)
+
+        try:
+            with self.phase('perform'):
+                deleted = Menu.objects.execute_delete_subtree(kwargs['pk'])
+        except Menu.DoesNotExist as e:
+            return Response({'message': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'deleted': deleted})
+
+    @action(detail=True, methods=['post'])
+    def move(self, request, pk=None):
+        with self.phase('validate'):
+            serializer = MoveSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+        try:
+            with self.phase('perform'):
+                menu = Menu.objects.execute_move(pk=pk, new_parent=serializer.validated_data['parent'],
+                                                 position=serializer.validated_data['position'])
+        except Menu.DoesNotExist as e:
+            return Response({'message': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        except ValidationError as e:
+            return Response({'message': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        with self.phase('serialize'):
+            return Response(MenuSerializer(menu).data)
+
+    @action(detail=False, methods=['put'])
+    def reorder(self, request):
+        with self.phase('validate'):
+            serializer = ReorderSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+        try:
+            with self.phase('perform'):
+                moved = Menu.objects.execute_reorder(**serializer.validated_data)
+        except ValidationError as e:
+            return Response({'message': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(dict(serializer.validated_data, moved=moved))
+
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_tree(self, request):
+        try:
+            with self.phase('perform'):
+                result = imports.import_menus(request.data)
+        except imports.MenuImportError as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_201_CREATED)
 
 
 ''' 